@@ -1,11 +1,17 @@
 import numpy as np
-import os, common, kfit
+import os, time, common, kfit, datafile
+try:
+    from concurrent import futures
+except ImportError:
+    # Python 2 without the futures backport: process_level_meter_s11 runs in a single process
+    futures = None
 from matplotlib import pyplot as plt
 
 try:
     from data_cache import dataCacheProxy
 except:
-    print "data_cache module could not be loaded"
+    # Stand-in for the slab data_cache module, which implements the methods used in this module
+    from datafile import DataCache as dataCacheProxy
 
 def dcbias_sweep(df, do_plot=True, fitspan=2E6):
     """
@@ -64,8 +70,9 @@ def dcbias_sweep(df, do_plot=True, fitspan=2E6):
     return np.array(biasV), np.array(meanw0s), np.array(meanQs), np.array(stdw0s), np.array(stdQs)
 
 
-def vibrations_from_helium(dfs, reps_per_puff, fitspan=2E6, fitfunction=kfit.fitlor, fitguess=None, domains=[],
-                           color='purple', puff_offsets=None, showfits=False, savename=None):
+def vibrations_from_helium(dfs, reps_per_puff, fitspan=2E6, fitfunction=kfit.fit_lor, fitguess=None, domains=[],
+                           color='purple', puff_offsets=None, showfits=False, savename=None, tracking=False,
+                           results=None):
     """
     dfs : List of filenames that are loaded. Files are stitched in the order they appear in the list
     reps_per_puff : number of traces that are taken each puff
@@ -75,10 +82,17 @@ def vibrations_from_helium(dfs, reps_per_puff, fitspan=2E6, fitfunction=kfit.fit
     puff_offsets : list of puff offsets that are applied to the x-axis of the graphs. Must have the same length as dfs
     showfits : show the fits
     savename : filename (if figure should be saved) or None
+    tracking : seed each fit with the result of the previous trace and center the fit window on the previous
+               resonance frequency (see kfit.fit_tracking). Falls back to a fresh fit only if a fit diverges.
+    results : kfit.FitResults instance with 4 parameters to which the result of every single fit is appended, or None.
+              The parameters are stored in the order [offset, amplitude, f0, HWHM].
     """
     if puff_offsets is None:
         puff_offsets = np.zeros(len(dfs))
 
+    # Last converged fit parameters, used to warm start the fits if tracking is True
+    seed = None
+
     McRuO2 = list()
     HundredmK = list()
 
@@ -93,20 +107,13 @@ def vibrations_from_helium(dfs, reps_per_puff, fitspan=2E6, fitfunction=kfit.fit
     for d, df in enumerate(dfs):
         # Get access to the data file
         if '.h5' in df:
-            data = dataCacheProxy(expInst='level_meter_expt', filepath=df)
-
-            stacks = data.index()
-
-        idxs = list()
-        for idx, s in enumerate(stacks):
-            if 'stack_' in s:
-                idxs.append(idx)
-
-        stacks = np.array(stacks)[np.array(idxs)]
+            # Read the metadata of all stacks in a single pass over the file. The traces are read one stack at a time.
+            stacks, stack_data, stack_dicts = datafile.load_stacks(df, ['fpoints', 'mags', 'phases', 'puff_nr'],
+                                                                   dicts=['Temperatures'],
+                                                                   lazy=['fpoints', 'mags', 'phases'])
 
-        Phases = np.zeros([len(stacks), 1601], dtype=np.float64)
-        Mags = np.zeros([len(stacks), 1601], dtype=np.float64)
-        #Puffs = np.zeros([len(stacks)], dtype=np.float64)
+        Phases = np.zeros([len(stacks), stack_data['phases'].shape[-1]], dtype=np.float64)
+        Mags = np.zeros([len(stacks), stack_data['mags'].shape[-1]], dtype=np.float64)
 
         plt.figure(figsize=(12., 4.))
 
@@ -115,58 +122,90 @@ def vibrations_from_helium(dfs, reps_per_puff, fitspan=2E6, fitfunction=kfit.fit
             start_idx = (idx * reps_per_puff)
             end_idx = (idx + 1) * reps_per_puff
 
-            data.current_stack = stack
-
-            freq = data.get('fpoints')
-            mag = data.get('mags')
-            phi = data.get('phases')
+            freq = stack_data['fpoints'][idx]
+            mag = stack_data['mags'][idx]
+            phi = stack_data['phases'][idx]
 
             Mags[idx, :] = np.mean(mag, axis=0)
             Phases[idx, :] = np.mean(phi, axis=0)
-
-            data.current_stack = stack
-            Puffs.append(data.get('puff_nr')[0]+puff_offsets[d])
-            Ts = data.get_dict('Temperatures')
-            McRuO2.append(Ts['MC RuO2'])
-            HundredmK.append(Ts['100mK Plate'])
+            Puffs.append(stack_data['puff_nr'][idx][0]+puff_offsets[d])
+            McRuO2.append(stack_dicts['Temperatures']['MC RuO2'][idx])
+            HundredmK.append(stack_dicts['Temperatures']['100mK Plate'][idx])
 
             # Fitting
             w0 = list()
             gamma = list()
             errs = list()
 
-            for j, i in enumerate(range(start_idx, end_idx)):
-
-                try:
-                    ctr = freq[j, :][np.argmax(mag[j, :])]
-                    fitparams, fiterrs = fitfunction(np.array(freq[j, :], dtype=np.float64),
-                                                     np.array(common.dBm_to_W(mag[j, :]), dtype=np.float64),
-                                                     fitparams=fitguess, showfit=showfits,
-                                                     domain=[ctr - fitspan / 2., ctr + fitspan / 2.],
-                                                     mark_data='.k', verbose=False)
-
-                    if fitfunction == kfit.fit_fano:
-                        fitparams_new = [fitparams[2], fitparams[3], fitparams[0], fitparams[1]/2.]
-                        fiterrs_new = [fiterrs[2], fiterrs[3], fiterrs[0], fiterrs[1]/2.]
-                        fitparams = fitparams_new
-                        fiterrs=fiterrs_new
-
-                except:
-                    print "fit %d failed"%idx
-                    fitparams = [np.nan, np.nan, ctr, np.nan]
-                    fiterrs = [np.nan, np.nan, np.nan, np.nan]
-
+            if tracking:
+                center_idx = 0 if fitfunction == kfit.fit_fano else 2
+                t0 = time.time()
+                fit_info = dict()
+                fitparams, fiterrs = kfit.fit_tracking(np.array(freq[:reps_per_puff, :], dtype=np.float64),
+                                                       np.array(common.dBm_to_W(mag[:reps_per_puff, :]), dtype=np.float64),
+                                                       fitfunction=fitfunction, center_idx=center_idx, fitspan=fitspan,
+                                                       fitparams=fitguess, seed=seed, showfit=showfits, mark_data='.k',
+                                                       info=fit_info)
+                if np.shape(fitparams)[1] == 0:
+                    fitparams = np.full((len(fitparams), 4), np.nan)
+                    fiterrs = np.full((len(fiterrs), 4), np.nan)
+
+                converged = np.isfinite(fitparams[:, center_idx])
+                if np.any(converged):
+                    seed = fitparams[converged][-1]
+                for j in np.where(np.logical_not(converged))[0]:
+                    print "fit %d failed" % j
+
+                if fitfunction == kfit.fit_fano:
+                    fitparams = np.transpose([fitparams[:, 2], fitparams[:, 3], fitparams[:, 0], fitparams[:, 1]/2.])
+                    fiterrs = np.transpose([fiterrs[:, 2], fiterrs[:, 3], fiterrs[:, 0], fiterrs[:, 1]/2.])
+
+                if results is not None:
+                    results.extend(fitparams, fiterrs, rsquare=fit_info['rsquare'], nfev=fit_info['nfev'],
+                                   walltime=(time.time() - t0) / len(fitparams))
+
+                w0 = list(fitparams[:, 2])
+                gamma = list(fitparams[:, 3])
+                errs = list(fiterrs)
+            else:
+                for j, i in enumerate(range(start_idx, end_idx)):
+                    t0 = time.time()
+                    fit_info = {'rsquare': np.nan, 'nfev': -1}
                     try:
-                        ctr = freq[0, :][np.argmax(mag[j, :])]
-                        fitparams, fiterrs = fitfunction(freq[0, :], common.dBm_to_W(mag[j, :]), fitparams=fitguess,
-                                                          showfit=showfits, domain=[ctr - fitspan / 2., ctr + fitspan / 2.],
-                                                          mark_data='.k', verbose=False)
-                    except:
-                        pass
+                        ctr = freq[j, :][np.argmax(mag[j, :])]
+                        fitparams, fiterrs = fitfunction(np.array(freq[j, :], dtype=np.float64),
+                                                         np.array(common.dBm_to_W(mag[j, :]), dtype=np.float64),
+                                                         fitparams=fitguess, showfit=showfits,
+                                                         domain=[ctr - fitspan / 2., ctr + fitspan / 2.],
+                                                         mark_data='.k', verbose=False, info=fit_info)
+
+                        if fitfunction == kfit.fit_fano:
+                            fitparams_new = [fitparams[2], fitparams[3], fitparams[0], fitparams[1]/2.]
+                            fiterrs_new = [fiterrs[2], fiterrs[3], fiterrs[0], fiterrs[1]/2.]
+                            fitparams = fitparams_new
+                            fiterrs=fiterrs_new
 
-                w0.append(fitparams[2])
-                gamma.append(fitparams[3])
-                errs.append(fiterrs)
+                    except:
+                        print "fit %d failed"%idx
+                        fitparams = [np.nan, np.nan, ctr, np.nan]
+                        fiterrs = [np.nan, np.nan, np.nan, np.nan]
+
+                        try:
+                            ctr = freq[0, :][np.argmax(mag[j, :])]
+                            fitparams, fiterrs = fitfunction(freq[0, :], common.dBm_to_W(mag[j, :]), fitparams=fitguess,
+                                                              showfit=showfits, domain=[ctr - fitspan / 2., ctr + fitspan / 2.],
+                                                              mark_data='.k', verbose=False, info=fit_info)
+                        except:
+                            pass
+
+                    w0.append(fitparams[2])
+                    gamma.append(fitparams[3])
+                    errs.append(fiterrs)
+
+                    if results is not None:
+                        status = kfit.FitResults.OK if np.all(np.isfinite(fitparams)) else kfit.FitResults.FAILED
+                        results.append(fitparams, fiterrs, rsquare=fit_info['rsquare'], nfev=fit_info['nfev'],
+                                       walltime=time.time() - t0, status=status)
 
             meanw0s.append(np.mean(w0))
             meangammas.append(np.mean(gamma))
@@ -174,6 +213,9 @@ def vibrations_from_helium(dfs, reps_per_puff, fitspan=2E6, fitfunction=kfit.fit
             stdw0s.append(np.std(w0))
             stdgammas.append(np.std(gamma))
 
+        for key in ['fpoints', 'mags', 'phases']:
+            stack_data[key].close()
+
     Puffs = np.array(Puffs, dtype=np.float64)
     meanw0s = np.array(meanw0s, dtype=np.float64)
     meangammas = np.array(meangammas, dtype=np.float64)
@@ -298,6 +340,26 @@ def plot_nwa_scan(df, span=1E6):
     return f0, Q
 
 
+def iter_stacks(data, stacks, keys):
+    """
+    Generator that reads the first row of datasets from the stacks of a data file, one stack at a time. Use this to
+    process sweeps that are too large to load at once. data.current_stack is set to the stack that is yielded, such
+    that more data can be read from it.
+    :param data: data_file instance
+    :param stacks: List of stack names
+    :param keys: List of dataset names, e.g. ['temperature', 'fpoints', 'mags']
+    :return: Yields idx, stack, list with the first row of each dataset in keys. Stacks that cannot be read are skipped.
+    """
+    for idx, stack in enumerate(stacks):
+        try:
+            data.current_stack = stack
+            rows = [data.get(key)[0] for key in keys]
+        except:
+            print "Failed to get data from %s" % stack
+            continue
+        yield idx, stack, rows
+
+
 def spectrum_sweep(data_dir, fref=None, magref=None, do_plot=True, carrier=0, start_stack=None, stop_stack=None):
     """
     :param data_dir:
@@ -331,13 +393,11 @@ def spectrum_sweep(data_dir, fref=None, magref=None, do_plot=True, carrier=0, st
     # print len(stacks)
     #print idxs
 
-    Fpts = np.zeros([len(stacks), 1601], dtype=np.float64)
-    Mags = np.zeros([len(stacks), 1601], dtype=np.float64)
-
-    f = np.zeros(0)
-    m = np.zeros(0)
-
-    temperature = list()
+    # The buffers are sized from the first stack
+    Fpts = None
+    Mags = None
+    valid = np.zeros(len(stacks), dtype=bool)
+    temperature = np.full(len(stacks), np.nan)
     try:
         fdrive = data.get('fdrive')[0][np.array(idxs[1:])]
         label = 'Capacitor drive frequency (kHz)'
@@ -346,27 +406,31 @@ def spectrum_sweep(data_dir, fref=None, magref=None, do_plot=True, carrier=0, st
         label = ''
         print "Did not succeed in retrieving drive frequency. You might want to specify it yourself..."
 
-    for idx, stack in enumerate(stacks):
+    for idx, stack, (temp, freq, mag) in iter_stacks(data, stacks, ['temperature', 'fpoints', 'mags']):
         try:
-            #print stack
-            data.current_stack = stack
-            temperature.append(data.get('temperature')[0])
-
             if idx == 0:
                 sa_cfg = data.get_dict('sa_config')
                 carrier = sa_cfg['sa_center']
 
-            freq = data.get('fpoints')[0]
-            mag = data.get('mags')[0]
+            if Mags is None:
+                Fpts = np.zeros([len(stacks), len(freq)], dtype=np.float64)
+                Mags = np.zeros([len(stacks), len(mag)], dtype=np.float64)
 
+            temperature[idx] = temp
             Mags[idx, :] = mag
             Fpts[idx, :] = freq
-
-            f = np.concatenate((f, Fpts[idx, :]), axis=0)
-            m = np.concatenate((m, Mags[idx, :]), axis=0)
+            valid[idx] = True
         except:
             print "Failed to get data from %s" % stack
 
+    if Mags is None:
+        Fpts = np.zeros([len(stacks), 0], dtype=np.float64)
+        Mags = np.zeros([len(stacks), 0], dtype=np.float64)
+
+    # All traces of the stacks that could be read, one after the other
+    f = Fpts[valid].flatten()
+    m = Mags[valid].flatten()
+
     #print "Temperature shape"
     #print len(temperature)
     #print len(fdrive)
@@ -442,35 +506,38 @@ def spectrum_sweep_updated(data, fref=None, magref=None, do_plot=True, carrier=0
     stacks = np.array(stacks)[np.array(idxs)]
     print "A total of %d of %d stacks will be plotted!" % (len(stack_nrs), total_idxs - 12)
 
-    Fpts = np.zeros([len(stacks), 1601], dtype=np.float64)
-    Mags = np.zeros([len(stacks), 1601], dtype=np.float64)
-
-    f = np.zeros(0)
-    m = np.zeros(0)
-
-    temperature = list()
+    # The buffers are sized from the first stack
+    Fpts = None
+    Mags = None
+    valid = np.zeros(len(stacks), dtype=bool)
+    temperature = np.full(len(stacks), np.nan)
 
     fdrive = data.get('fdrive')[0][np.array(stack_nrs)]
     carrier_f = data.get('sa_carrier_fpoints')[0]
     carrier_m = data.get('sa_carrier_mags')[0]
     label = 'Capacitor drive frequency (kHz)'
 
-    for idx, stack in enumerate(stacks):
+    for idx, stack, (temp, freq, mag) in iter_stacks(data, stacks, ['temperature', 'fpoints', 'mags']):
         try:
-            data.current_stack = stack
-            temperature.append(data.get('temperature')[0])
-
-            freq = data.get('fpoints')[0]
-            mag = data.get('mags')[0]
+            if Mags is None:
+                Fpts = np.zeros([len(stacks), len(freq)], dtype=np.float64)
+                Mags = np.zeros([len(stacks), len(mag)], dtype=np.float64)
 
+            temperature[idx] = temp
             Mags[idx, :] = mag
             Fpts[idx, :] = freq
-
-            f = np.concatenate((f, Fpts[idx, :]), axis=0)
-            m = np.concatenate((m, Mags[idx, :]), axis=0)
+            valid[idx] = True
         except:
             print "Failed to get data from %s" % stack
 
+    if Mags is None:
+        Fpts = np.zeros([len(stacks), 0], dtype=np.float64)
+        Mags = np.zeros([len(stacks), 0], dtype=np.float64)
+
+    # All traces of the stacks that could be read, one after the other
+    f = Fpts[valid].flatten()
+    m = Mags[valid].flatten()
+
     if do_plot:
         fig3 = plt.figure(figsize=(10., 12.));
         common.configure_axes(13)
@@ -555,25 +622,28 @@ def integrate_peakpower(F, Mags, starts_and_stops, fdrive, includes_carrier=True
     return som
 
 
-def fit_integrated_peakpower(fdrive, som, init_guess, plot_separate=True, print_fitresult=True, **kwargs):
+def fit_integrated_peakpower(fdrive, som, init_guess=None, plot_separate=True, print_fitresult=True, npeaks=None,
+                             **kwargs):
     """
 
     :param fdrive: xdata
     :param som: ydata in dBm
-    :param init_guess: initial guesses for fit
+    :param init_guess: initial guesses for fit. If None, the peaks are found automatically (see kfit.fit_N_gauss)
+    :param npeaks: number of peaks to fit if init_guess is None. Default is None, i.e. all peaks that are found.
     :return:
     """
-    fitres = kfit.fit_N_gauss(fdrive, common.dBm_to_W(np.array(som)), fitparams=init_guess)
-    plt.plot(fdrive, 10 * np.log10(kfit.Ngaussfunc(fitres, fdrive)), lw=2.0, **kwargs)
+    fitres, fiterrs = kfit.fit_N_gauss(fdrive, common.dBm_to_W(np.array(som)), fitparams=init_guess, npeaks=npeaks)
+    fitres = np.array(fitres)
+    plt.plot(fdrive, 10 * np.log10(kfit.Ngaussfunc(fdrive, *fitres)), lw=2.0, **kwargs)
 
-    for q in range(int((len(init_guess) - 1) / 3.)):
+    for q in range(int((len(fitres) - 1) / 3.)):
         if plot_separate:
-            plt.plot(fdrive, 10 * np.log10(kfit.gaussfunc(fitres[[0, 3 * q + 1, 3 * q + 2, 3 * q + 3]], fdrive)),
+            plt.plot(fdrive, 10 * np.log10(kfit.gaussfunc(fdrive, *fitres[[0, 3 * q + 1, 3 * q + 2, 3 * q + 3]])),
                      color='m', lw=2.0, alpha=0.3)
         if print_fitresult:
             print "--------------------------------"
             print "Q%d = %.2f" % (q + 1, fitres[3 * q + 2] / (2 * np.sqrt(2 * np.log(2)) * fitres[3 * q + 3]))
-            print "f%d = %.2f kHz" % (q + 1, fitres[3 * q + 2])
+            print "f%d = %.2f kHz" % (q + 1, fitres[3 * q + 2] / 1E3)
             print "--------------------------------"
 
     return fitres
@@ -595,6 +665,9 @@ def alazar_sweep(df, min_fft_freq, max_fft_freq, ylim=None, do_imshow=False, thr
         if 'stack' in I:
             stacks.append(I)
 
+    # Only the selected FFT points are read from disk
+    averaged_fft = datafile.StackArray(df, 'averaged_fft', stacks=stacks)
+
     # Retrieve initial cavity spectrum
     fpoints = data_file.get('nwa_fpoints')[0]
     mags = data_file.get('nwa_mags')[0]
@@ -632,10 +705,9 @@ def alazar_sweep(df, min_fft_freq, max_fft_freq, ylim=None, do_imshow=False, thr
         pump_freq.append(data_file.get('pump_frequency'))
         mc_temp.append(temp)
 
-        FFT = data_file.get('averaged_fft')[0]
-        freq = data_file.get('fft_points')[0]
-
         if idx == 0:
+            # The FFT points are the same for all stacks
+            freq = data_file.get('fft_points')[0]
             print "Number of FFT points: %d" % (len(freq))
             min_fft_idx = common.find_nearest(freq, min_fft_freq)
             max_fft_idx = common.find_nearest(freq, max_fft_freq)
@@ -643,9 +715,11 @@ def alazar_sweep(df, min_fft_freq, max_fft_freq, ylim=None, do_imshow=False, thr
             print "Only taking data from idx %d to %d" % (min_fft_idx, max_fft_idx)
 
             fft_freq = freq[min_fft_idx:max_fft_idx]
-            fft = np.zeros([0, len(fft_freq)])
+            fft = np.zeros([len(stacks), len(fft_freq)])
+
+        fft[idx, :] = np.abs(averaged_fft[idx, 0, min_fft_idx:max_fft_idx]) ** 2
 
-        fft = np.vstack((fft, np.abs(FFT[min_fft_idx:max_fft_idx]) ** 2))
+    averaged_fft.close()
 
     drivepts = np.array(drivepts)
     pump_freq = np.array(pump_freq)
@@ -744,10 +818,11 @@ def plot_alazar_sweep(fft_freq, fft, drivepts, min_fft_freq, savepath=None, thre
         fig4 = plt.figure(figsize=(8.,6.), facecolor='white')
         color.cycle_cmap(length=np.shape(selected_fft)[0], cmap=plt.cm.jet)
         ax = plt.gca()
-        for idx, i in enumerate(range(np.shape(selected_fft)[0])):
-            ax.plot(fft_freq[np.logical_and(fft_freq>xlim[0]*1E3, fft_freq<xlim[1]*1E3)] / 1E3, selected_fft[i,:])
-            plt.ylim(ylim)
-            plt.xlim(xlim)
+        # All traces in one call, downsampled to the resolution of the figure
+        common.plot_downsampled(fft_freq[np.logical_and(fft_freq>xlim[0]*1E3, fft_freq<xlim[1]*1E3)] / 1E3,
+                                selected_fft, ax=ax)
+        plt.ylim(ylim)
+        plt.xlim(xlim)
         plt.xlabel('FFT frequency (kHz)')
         plt.ylabel('PSD (dBm/Hz)')
 
@@ -850,16 +925,16 @@ def anal_cavityS21_expt(df, ch1range, ch2range, verbose=True, do_log=False, ylim
     ch1 = data.get('ch1')
     ch2 = data.get('ch2')
 
-    Ych1 = np.zeros((np.shape(ch1)[0], np.shape(ch1)[1]/2))
-    Ych2 = np.zeros((np.shape(ch2)[0], np.shape(ch2)[1]/2))
+    # All stacks are transformed at once
+    T = np.sqrt(np.max(t, axis=1))[:, np.newaxis]
+    f, Y = common.get_spectrum(ch1, t, workers=-1)
+    Ych1 = np.abs(Y) * T * multiply
 
-    for stack in range(np.shape(ch1)[0]):
-        print "stack %d/%d" % (stack+1, np.shape(ch1)[0])
-        f, Y = common.plot_spectrum(ch1[stack,:], t[stack,:], ret=True, do_plot=False, verbose=verbose)
-        Ych1[stack,:] = np.abs(Y) * np.sqrt(np.max(t[stack,:])) * multiply
+    f, Y = common.get_spectrum(ch2, t, workers=-1)
+    Ych2 = np.abs(Y) * T
 
-        f, Y = common.plot_spectrum(ch2[stack,:], t[stack,:], ret=True, do_plot=False, verbose=verbose)
-        Ych2[stack,:] = np.abs(Y) * np.sqrt(np.max(t[stack,:]))
+    if verbose:
+        print "Processed %d stacks" % np.shape(ch1)[0]
 
     meanYch1 = np.mean(Ych1, axis=0)
     meanYch2 = np.mean(Ych2, axis=0)
@@ -882,22 +957,162 @@ def anal_cavityS21_expt(df, ch1range, ch2range, verbose=True, do_log=False, ylim
     return t, ch1, ch2, f, meanYch1, meanYch2
 
 
+def _fit_level_meter_stack(freq, mag, phi, reps_per_puff, fitspan, fitmode, fitguess, showfits, tracking, seed,
+                           results):
+    """
+    Fit the traces of a single stack (puff) for process_level_meter_s11.
+    :param freq, mag, phi: Arrays of shape (reps_per_puff, N) with the traces of the stack
+    :param seed: Last converged fit parameters if tracking is True, or None
+    :param results: kfit.FitResults instance or None
+    :return: f0, Qc, Qi, df (lists with an entry for every successful fit), seed
+    """
+    f0 = list(); Qc = list(); Qi = list(); df = list();
+
+    if fitmode == 'circle':
+        for j in range(reps_per_puff):
+            ctr = freq[j, :][np.argmin(mag[j, :])]
+            t0 = time.time()
+            try:
+                sdata = 10**(mag[j, :]/20.) * np.exp(1j * np.pi * phi[j, :] / 180.)
+                fitparams, fiterrs, fit_info = kfit.fit_complex_resonator(np.array(freq[j, :], dtype=np.float64),
+                                                                          sdata, mode='reflection', showfit=showfits,
+                                                                          domain=[ctr - fitspan / 2., ctr + fitspan / 2.],
+                                                                          verbose=False, full_output=True)
+                # fitparams = [f0, Qc, Qi, Ql]
+                f0.append(fitparams[0])
+                Qc.append(fitparams[1])
+                Qi.append(fitparams[2])
+                df.append(np.nan)
+
+                if results is not None:
+                    results.append(fitparams, fiterrs, rsquare=fit_info['rsquare'], nfev=fit_info['nfev'],
+                                   walltime=time.time() - t0)
+            except:
+                if results is not None:
+                    results.append(None, None, walltime=time.time() - t0, status=kfit.FitResults.FAILED)
+    elif tracking:
+        t0 = time.time()
+        fit_info = dict()
+        normalized_mags = common.dBm_to_W(mag[:reps_per_puff, :] -
+                                          np.mean(mag[:reps_per_puff, :-100], axis=1)[:, np.newaxis])*1E3
+        fitparams, fiterrs = kfit.fit_tracking(np.array(freq[:reps_per_puff, :], dtype=np.float64),
+                                               np.sqrt(normalized_mags), fitfunction=kfit.fit_s11,
+                                               center_idx=0, fitspan=fitspan, fitparams=fitguess, seed=seed,
+                                               peak='min', mode=fitmode, showfit=showfits, mark_data='.k',
+                                               info=fit_info)
+
+        if results is not None:
+            walltime = (time.time() - t0) / len(fitparams)
+            if np.any(np.isfinite(fitparams)):
+                results.extend(fitparams, fiterrs, rsquare=fit_info['rsquare'], nfev=fit_info['nfev'],
+                               walltime=walltime)
+            else:
+                # All fits failed, fitparams may not even have the right number of columns
+                failed = np.full((len(fitparams), results.nparams), np.nan)
+                results.extend(failed, failed, status=kfit.FitResults.FAILED, walltime=walltime)
+
+        # Failed fits are skipped, like in the loop below
+        if np.any(np.isfinite(fitparams)):
+            fitparams = fitparams[np.isfinite(fitparams[:, 0])]
+            seed = fitparams[-1]
+
+            f0 = list(fitparams[:, 0])
+            df = list(fitparams[:, 3])
+            if fitmode == "twoport":
+                Qc = list(fitparams[:, 1])
+                Qi = list(fitparams[:, 2])
+            elif fitmode == "oneport":
+                Qc = list(fitparams[:, 0]/(fitparams[:, 1]))
+                Qi = list(fitparams[:, 0]/(2*fitparams[:, 2]))
+    else:
+        for j in range(reps_per_puff):
+
+            ctr = freq[j, :][np.argmin(mag[j, :])]
+            t0 = time.time()
+            fit_info = dict()
+            # This part is still quite specific to fit_s11 from kfit
+            try:
+                normalized_mags = common.dBm_to_W(mag[j, :]-np.mean(mag[j,:-100]))*1E3
+                fitparams, fiterrs = kfit.fit_s11(np.array(freq[j, :], dtype=np.float64),
+                                                   np.sqrt(normalized_mags), mode=fitmode,
+                                                   fitparams=fitguess, showfit=showfits,
+                                                   domain=[ctr - fitspan / 2., ctr + fitspan / 2.],
+                                                   mark_data='.k', verbose=False, info=fit_info)
+
+                if fitmode == "twoport":
+                    # fitparams = [f0, Qc, Qi, df, scale]
+                    f0.append(fitparams[0])
+                    Qc.append(fitparams[1])
+                    Qi.append(fitparams[2])
+                    df.append(fitparams[3])
+                elif fitmode == "oneport":
+                    # fitparams = [f0, kr, eps, df, scale]
+                    f0.append(fitparams[0])
+                    Qc.append(fitparams[0]/(fitparams[1]))
+                    Qi.append(fitparams[0]/(2*fitparams[2]))
+                    df.append(fitparams[3])
+
+                if results is not None:
+                    results.append(fitparams, fiterrs, rsquare=fit_info['rsquare'], nfev=fit_info['nfev'],
+                                   walltime=time.time() - t0)
+            except:
+                if results is not None:
+                    results.append(None, None, walltime=time.time() - t0, status=kfit.FitResults.FAILED)
+
+    return f0, Qc, Qi, df, seed
+
+
+def _level_meter_job(job):
+    """
+    Read and fit a single stack in a worker process, for process_level_meter_s11 with max_workers > 1.
+    :param job: Tuple (filename, stack, reps_per_puff, fitspan, fitmode, fitguess, tracking, nparams). If nparams is
+    not None, the results of the single fits are collected in a kfit.FitResults instance with nparams parameters.
+    :return: fpoints, mean magnitude, mean phase, (f0, Qc, Qi, df), FitResults or None
+    """
+    Df, stack, reps_per_puff, fitspan, fitmode, fitguess, tracking, nparams = job
+    stacks, stack_data, stack_dicts = datafile.load_stacks(Df, ['fpoints', 'mags', 'phases'], stacks=[stack])
+    freq, mag, phi = stack_data['fpoints'][0], stack_data['mags'][0], stack_data['phases'][0]
+
+    results = kfit.FitResults(nparams) if nparams is not None else None
+    # Tracking starts from scratch in every stack, because the stacks are fitted independently
+    f0, Qc, Qi, df, seed = _fit_level_meter_stack(freq, mag, phi, reps_per_puff, fitspan, fitmode, fitguess, False,
+                                                  tracking, None, results)
+    return freq[0, :], np.mean(mag, axis=0), np.mean(phi, axis=0), (f0, Qc, Qi, df), results
+
+
 def process_level_meter_s11(dfs, reps_per_puff, fitspan=2E6, fitmode='twoport', fitguess=None,
-                            puff_offsets=None, showfits=False):
+                            puff_offsets=None, showfits=False, tracking=False, results=None, max_workers=1,
+                            progress=None):
     """
     Process the level meter data measured in a Hybrid setup, measuring reflection from the caviy.
     :param dfs: List of data files containing level meter data
     :param reps_per_puff: Repetitions per helium puff
     :param fitspan: Fit span in Hz
-    :param fitmode: 'twoport' or 'oneport'
+    :param fitmode: 'twoport', 'oneport' or 'circle'. 'circle' uses the magnitude and the phase (assumed to be in
+    degrees) in a circle fit in the complex plane, see kfit.fit_complex_resonator. This is much faster than the other
+    modes, which fit only the magnitude. df is not determined in this mode.
     :param fitguess: Default is None, If supplied has to be a list [f0, Qc, Qi, df, scale]
     :param puff_offsets: List
     :param showfits: True/False
+    :param tracking: True/False. Seed each fit with the result of the previous trace and center the fit window on the
+    previous resonance frequency (see kfit.fit_tracking). Falls back to a fresh fit only if a fit diverges.
+    :param results: kfit.FitResults instance to which the result of every single fit is appended, or None. The
+    parameters are stored as returned by kfit.fit_s11 (5 parameters), or kfit.fit_complex_resonator (4 parameters)
+    if fitmode='circle'.
+    :param max_workers: Number of processes. Default is 1, which fits all stacks in the current process. For
+    max_workers > 1 (or None, for the number of processors) the stacks of all files are fitted in parallel. The
+    results are merged in puff order. showfits is then ignored, and with tracking=True every stack starts without a
+    seed, because the stacks are fitted independently. On Windows the calling script needs an
+    if __name__ == '__main__' guard. Under Python 2 this requires the futures backport.
+    :param progress: Function progress(done, total) that is called after every stack, e.g. to update a progress bar.
     :return: Puffs, mean_fitparams, err_fitparams
     """
     if puff_offsets is None:
         puff_offsets = np.zeros(len(dfs))
 
+    # Last converged fit parameters, used to warm start the fits if tracking is True
+    seed = None
+
     McRuO2 = list()
     HundredmK = list()
 
@@ -905,88 +1120,65 @@ def process_level_meter_s11(dfs, reps_per_puff, fitspan=2E6, fitmode='twoport',
     err_fitparams = {"f0" : list(), "Qc" : list(), "Qi" : list(), "df" : list()}
 
     Puffs = list()
+    Fpoints = list()
+    Mags = list()
+    Phases = list()
 
+    # Read the metadata of all files first
+    files = list()
     for d, Df in enumerate(dfs):
         # Get access to the data file
         if '.h5' in Df:
-            data = dataCacheProxy(expInst='level_meter_expt', filepath=Df)
-
-            stacks = data.index()
-
-        idxs = list()
-        for idx, s in enumerate(stacks):
-            if 'stack_' in s:
-                idxs.append(idx)
-
-        stacks = np.array(stacks)[np.array(idxs)]
-
-        Phases = np.zeros([len(stacks), 1601], dtype=np.float64)
-        Mags = np.zeros([len(stacks), 1601], dtype=np.float64)
-        Fpoints = np.zeros([len(stacks), 1601], dtype=np.float64)
-
-        plt.figure(figsize=(12., 4.))
-
-        for idx, stack in enumerate(stacks):
-            print idx,
-            start_idx = (idx * reps_per_puff)
-            end_idx = (idx + 1) * reps_per_puff
-
-            data.current_stack = stack
-
-            freq = data.get('fpoints')
-            mag = data.get('mags')
-            phi = data.get('phases')
-
-            Mags[idx, :] = np.mean(mag, axis=0)
-            Phases[idx, :] = np.mean(phi, axis=0)
-            Fpoints[idx, :] = freq[0,:]
-
-            data.current_stack = stack
-            Puffs.append(data.get('puff_nr')[0]+puff_offsets[d])
-            Ts = data.get_dict('Temperatures')
-            McRuO2.append(Ts['MC RuO2'])
-            HundredmK.append(Ts['100mK Plate'])
-
-            # Fitting
-            f0 = list(); Qc = list(); Qi = list(); df = list();
-
-            for j, i in enumerate(range(start_idx, end_idx)):
-
-                ctr = freq[j, :][np.argmin(mag[j, :])]
-                # This part is still quite specific to fit_s11 from kfit
-                try:
-                    normalized_mags = common.dBm_to_W(mag[j, :]-np.mean(mag[j,:-100]))*1E3
-                    fitparams, fiterrs = kfit.fit_s11(np.array(freq[j, :], dtype=np.float64),
-                                                       np.sqrt(normalized_mags), mode=fitmode,
-                                                       fitparams=fitguess, showfit=showfits,
-                                                       domain=[ctr - fitspan / 2., ctr + fitspan / 2.],
-                                                       mark_data='.k', verbose=False)
-
-                    if fitmode == "twoport":
-                        # fitparams = [f0, Qc, Qi, df, scale]
-                        f0.append(fitparams[0])
-                        Qc.append(fitparams[1])
-                        Qi.append(fitparams[2])
-                        df.append(fitparams[3])
-                    elif fitmode == "oneport":
-                        # fitparams = [f0, kr, eps, df, scale]
-                        f0.append(fitparams[0])
-                        Qc.append(fitparams[0]/(fitparams[1]))
-                        Qi.append(fitparams[0]/(2*fitparams[2]))
-                        df.append(fitparams[3])
-
-                except:
-                    pass
-
-            mean_fitparams['f0'].append(np.mean(f0))
-            mean_fitparams['Qc'].append(np.mean(Qc))
-            mean_fitparams['Qi'].append(np.mean(Qi))
-            mean_fitparams['df'].append(np.mean(df))
-
-            err_fitparams['f0'].append(np.std(f0))
-            err_fitparams['Qc'].append(np.std(Qc))
-            err_fitparams['Qi'].append(np.std(Qi))
-            err_fitparams['df'].append(np.std(df))
+            stacks, stack_data, stack_dicts = datafile.load_stacks(Df, ['puff_nr'], dicts=['Temperatures'])
+
+        files.append((Df, stacks))
+        Puffs += list(stack_data['puff_nr'][:, 0] + puff_offsets[d])
+        McRuO2 += list(stack_dicts['Temperatures']['MC RuO2'])
+        HundredmK += list(stack_dicts['Temperatures']['100mK Plate'])
+
+    total = len(Puffs)
+
+    def add_stack(fpoints, mag, phi, fits):
+        Fpoints.append(fpoints)
+        Mags.append(mag)
+        Phases.append(phi)
+        for key, values in zip(["f0", "Qc", "Qi", "df"], fits):
+            mean_fitparams[key].append(np.mean(values))
+            err_fitparams[key].append(np.std(values))
+        if progress is not None:
+            progress(len(Mags), total)
+
+    if max_workers == 1 or futures is None:
+        for Df, stacks in files:
+            # The traces are read one stack at a time
+            traces = datafile.load_stacks(Df, ['fpoints', 'mags', 'phases'], stacks=stacks,
+                                          lazy=['fpoints', 'mags', 'phases'])[1]
+
+            plt.figure(figsize=(12., 4.))
+
+            for idx in range(len(stacks)):
+                freq = traces['fpoints'][idx]
+                mag = traces['mags'][idx]
+                phi = traces['phases'][idx]
+
+                f0, Qc, Qi, df, seed = _fit_level_meter_stack(freq, mag, phi, reps_per_puff, fitspan, fitmode,
+                                                              fitguess, showfits, tracking, seed, results)
+                add_stack(freq[0, :], np.mean(mag, axis=0), np.mean(phi, axis=0), (f0, Qc, Qi, df))
+
+            for key in ['fpoints', 'mags', 'phases']:
+                traces[key].close()
+    else:
+        nparams = results.nparams if results is not None else None
+        jobs = [(Df, stack, reps_per_puff, fitspan, fitmode, fitguess, tracking, nparams)
+                for Df, stacks in files for stack in stacks]
+        with futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+            # map returns the stacks in the order of the jobs, i.e. in puff order
+            for fpoints, mag, phi, fits, job_results in executor.map(_level_meter_job, jobs):
+                if results is not None and len(job_results):
+                    data = job_results.data
+                    results.extend(data['params'], data['errors'], rsquare=data['rsquare'], nfev=data['nfev'],
+                                   status=data['status'], walltime=data['walltime'])
+                add_stack(fpoints, mag, phi, fits)
 
     # Make sure they're numpy arrays instead of lists
     Puffs = np.array(Puffs, dtype=np.float64)
@@ -1007,6 +1199,7 @@ def process_level_meter_s11(dfs, reps_per_puff, fitspan=2E6, fitmode='twoport',
     plt.title('Temperature during measurements')
 
     if len(dfs) == 1:
+        Fpoints, Mags = np.array(Fpoints), np.array(Mags)
         plt.subplot(122)
         plt.pcolormesh(Puffs, np.transpose(Fpoints), np.transpose(Mags), cmap=plt.cm.viridis)
         plt.colorbar()
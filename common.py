@@ -1,68 +1,331 @@
 import numpy as np
 from matplotlib import pyplot as plt
 import matplotlib
-import cmath, csv, os
+import csv, os, json, hashlib
+try:
+    from concurrent import futures
+except ImportError:
+    # Python 2 without the futures backport: the parallel functions run in a single process
+    futures = None
 from tabulate import tabulate
-from scipy.signal import convolve2d
+from scipy import signal
+try:
+    import scipy.fft as scipy_fft
+except ImportError:
+    # scipy < 1.4, e.g. under Python 2: numpy's FFT is used, which has no workers argument
+    import scipy.fftpack
+    scipy_fft = None
+
+def _rfft(y, axis=-1, workers=None):
+    """
+    Real FFT with scipy.fft, or with numpy.fft if scipy.fft is not available.
+    """
+    if scipy_fft is None:
+        return np.fft.rfft(y, axis=axis)
+    return scipy_fft.rfft(y, axis=axis, workers=workers)
 
-def load_csv(filename, header_length=7, footer_length=2, ncols=3):
+def _parse_csv_rows(lines, ncols, invalid='zero', first_line=0):
+    """
+    Parse lines of comma separated numbers into an array. The lines are parsed in bulk by np.loadtxt, only if that
+    fails the lines are parsed one by one to find the malformed rows. Blank lines count as malformed rows.
+    :param lines: List of lines (strings)
+    :param ncols: Number of columns that is read from each line. Further columns are ignored.
+    :param invalid: What to do with rows that can't be converted to ncols floats: 'zero' (fill with zeros), 'nan'
+    (fill with nan), 'skip' (leave out) or 'raise' (raise a ValueError).
+    :param first_line: Line number of the first line in the file, used in messages.
+    :return: Array of shape (number of rows, ncols)
     """
-    Load a csv file into a numpy array.
+    if invalid not in ['zero', 'nan', 'skip', 'raise']:
+        raise ValueError("invalid should be 'zero', 'nan', 'skip' or 'raise'")
+
+    if len(lines) == 0:
+        return np.zeros([0, ncols])
+
+    # np.loadtxt silently skips blank lines, so these are handled as malformed rows below
+    if all(line.strip() for line in lines):
+        try:
+            return np.loadtxt(lines, delimiter=',', usecols=range(ncols), ndmin=2, comments=None)
+        except (ValueError, IndexError):
+            pass
+
+    data = np.zeros([len(lines), ncols])
+    keep = np.ones(len(lines), dtype=bool)
+    bad_lines = list()
+    for idx, row in enumerate(csv.reader(lines)):
+        try:
+            data[idx, :] = [float(row[k]) for k in range(ncols)]
+        except (ValueError, IndexError):
+            if invalid == 'raise':
+                raise ValueError("Line %d can't be converted to %d numbers: %s" % (first_line + idx + 1, ncols, row))
+            bad_lines.append(first_line + idx + 1)
+            if invalid == 'nan':
+                data[idx, :] = np.nan
+            elif invalid == 'skip':
+                keep[idx] = False
+            else:
+                data[idx, :] = 0.
+
+    if bad_lines:
+        print("Warning: %d malformed rows (lines %s) were handled with invalid='%s'"
+              % (len(bad_lines), ", ".join(str(l) for l in bad_lines[:10]) + (", ..." if len(bad_lines) > 10 else ""),
+                 invalid))
+    return data[keep]
+
+def load_csv(filename, header_length=7, footer_length=2, ncols=3, invalid='zero'):
+    """
+    Load a csv file into a numpy array. The file is read once, and the numbers are parsed in bulk.
     :param datafile: filename of the .csv file
     :param header_length: number of header rows that are no data
     :param footer_length: number footer rows that are no data
     :param ncols: Number of columns in the data
-    :return:
+    :param invalid: What to do with rows that can't be converted to numbers: 'zero' (fill with zeros, default),
+    'nan' (fill with nan), 'skip' (leave the row out) or 'raise' (raise a ValueError). A warning is printed for
+    malformed rows, unless invalid='raise'.
+    :return: Array of shape (number of rows, ncols)
     """
     with open(filename, 'r') as f:
-        reader = csv.reader(f)
-        len_data = sum(1 for row in reader) - header_length - footer_length
+        lines = f.read().splitlines()
+
+    lines = lines[header_length:len(lines) - footer_length]
+    return _parse_csv_rows(lines, ncols, invalid=invalid, first_line=header_length)
 
+def iter_csv(filename, header_length=7, footer_length=2, ncols=3, chunksize=100000, invalid='zero'):
+    """
+    Streaming version of load_csv for files that don't fit in memory. Yields the data in chunks of at most chunksize
+    rows. The footer is recognized by keeping the last footer_length lines in a buffer.
+    Example:
+        for chunk in iter_csv(filename):
+            process(chunk)
+    :param filename: filename of the .csv file
+    :param header_length: number of header rows that are no data
+    :param footer_length: number footer rows that are no data
+    :param ncols: Number of columns in the data
+    :param chunksize: Maximum number of rows per chunk
+    :param invalid: See load_csv
+    :return: Generator of arrays of shape (chunksize, ncols), the last chunk may be shorter
+    """
     with open(filename, 'r') as f:
-        reader = csv.reader(f)
         for k in range(header_length):
-            next(reader, None)
-
-
-        for idx,row in enumerate(reader):
-            if idx == 0:
-                data = np.zeros([len_data, ncols])
-
-            try:
-                for k in range(ncols):
-                    data[idx,k] = float(row[k])
-            except:
-                pass
-
-    return data
+            f.readline()
+
+        line_nr = header_length
+        lookahead = list()
+        chunk = list()
+        for line in f:
+            lookahead.append(line)
+            if len(lookahead) > footer_length:
+                chunk.append(lookahead.pop(0))
+            if len(chunk) == chunksize:
+                yield _parse_csv_rows(chunk, ncols, invalid=invalid, first_line=line_nr)
+                line_nr += len(chunk)
+                chunk = list()
+
+        if len(chunk) > 0:
+            yield _parse_csv_rows(chunk, ncols, invalid=invalid, first_line=line_nr)
+
+def _write_h5_row(h5file, name, row):
+    """
+    Write a 1D array as the first row of a chunked, compressed dataset of shape (1, N) that can grow along the first
+    axis, i.e. the same layout as dataCacheProxy.append creates.
+    """
+    N = len(row)
+    h5file.create_dataset(name, data=np.reshape(row, (1, N)), maxshape=(None, N), chunks=(1, min(N, 2**20)),
+                          compression='gzip', compression_opts=4, shuffle=True)
 
-def csv_to_h5(filename, data_cache, **kwargs):
+def csv_to_h5(filename, data_cache=None, overwrite=False, **kwargs):
     """
     Convert a .csv file from the PNAX to a h5 file with the same name
     :param filename: Filename of the file that needs to be converted
-    :return:
+    :param data_cache: data_cache module. If None (default), the file is written directly with h5py, using chunked,
+    gzip compressed datasets fpts, mags and phases of shape (1, N).
+    :param overwrite: True/False. Convert the file even if the .h5 file already exists.
+    :param kwargs: Keyword arguments for load_csv
+    :return: Filename of the .h5 file
     """
-    data = load_csv(filename, **kwargs)
     h5_filename = filename[:-4]+'.h5'
-    if not os.path.isfile(h5_filename):
+    if not os.path.isfile(h5_filename) or overwrite:
         print("%s ..."%h5_filename)
-        myfile = data_cache.dataCacheProxy(filepath=h5_filename, expInst=None)
-        myfile.append("fpts", data[:,0])
-        myfile.append("mags", data[:,1])
-        myfile.append("phases", data[:,2])
+        data = load_csv(filename, **kwargs)
+        if data_cache is None:
+            import h5py
+            with h5py.File(h5_filename, 'w') as f:
+                _write_h5_row(f, "fpts", data[:,0])
+                _write_h5_row(f, "mags", data[:,1])
+                _write_h5_row(f, "phases", data[:,2])
+        else:
+            if os.path.isfile(h5_filename):
+                os.remove(h5_filename)
+            myfile = data_cache.dataCacheProxy(filepath=h5_filename, expInst=None)
+            myfile.append("fpts", data[:,0])
+            myfile.append("mags", data[:,1])
+            myfile.append("phases", data[:,2])
     else:
         print("%s <-- already exists, skipping..."%h5_filename)
 
-def get_phase(array):
+    return h5_filename
+
+def _file_sha1(filename, blocksize=2**20):
+    """
+    sha1 hash of the contents of a file, read in blocks.
+    """
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def _csv_to_h5_job(filename, kwargs):
+    """
+    Convert a single file for csv_to_h5_batch. Exceptions are returned instead of raised, such that one bad file does
+    not stop the batch.
+    :return: (filename, manifest entry) or (filename, exception)
+    """
+    try:
+        stat = os.stat(filename)
+        entry = {"size": stat.st_size, "mtime": stat.st_mtime, "sha1": _file_sha1(filename)}
+        csv_to_h5(filename, data_cache=None, overwrite=True, **kwargs)
+        return filename, entry
+    except Exception as e:
+        return filename, e
+
+def csv_to_h5_batch(directory, manifest_name='csv_to_h5_manifest.json', max_workers=None, **kwargs):
+    """
+    Convert all .csv files in a directory tree to .h5 files (see csv_to_h5), using a pool of processes. A manifest
+    with the size, modification time and sha1 hash of each converted file is kept in the directory, such that only
+    new or changed files are converted when the function is run again. A file whose modification time changed but
+    whose contents (hash) did not is not converted again.
+    Note: on Windows the calling script needs an if __name__ == '__main__' guard.
+    :param directory: Top directory. All subdirectories are searched as well.
+    :param manifest_name: Filename of the manifest, relative to directory
+    :param max_workers: Number of processes. Default is the number of processors on the machine. If max_workers=1 the
+    files are converted in the current process. This is also the case under Python 2 if the futures backport is not
+    installed.
+    :param kwargs: Keyword arguments for load_csv, e.g. header_length
+    :return: List of files that were converted
+    """
+    manifest_filename = os.path.join(directory, manifest_name)
+    manifest = dict()
+    if os.path.isfile(manifest_filename):
+        with open(manifest_filename, 'r') as f:
+            manifest = json.load(f)
+
+    todo = list()
+    for root, dirs, files in os.walk(directory):
+        for name in sorted(files):
+            if not name.lower().endswith('.csv'):
+                continue
+            filename = os.path.join(root, name)
+            key = os.path.relpath(filename, directory)
+            entry = manifest.get(key)
+            if entry is not None and os.path.isfile(filename[:-4]+'.h5'):
+                stat = os.stat(filename)
+                if stat.st_size == entry["size"] and stat.st_mtime == entry["mtime"]:
+                    continue
+                if stat.st_size == entry["size"] and _file_sha1(filename) == entry["sha1"]:
+                    # Touched, but not changed
+                    entry["mtime"] = stat.st_mtime
+                    continue
+            todo.append(filename)
+
+    print("Converting %d of the .csv files in %s" % (len(todo), directory))
+    if max_workers == 1 or futures is None:
+        results = [_csv_to_h5_job(filename, kwargs) for filename in todo]
+    else:
+        with futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(_csv_to_h5_job, todo, [kwargs] * len(todo)))
+
+    converted = list()
+    for filename, entry in results:
+        if isinstance(entry, Exception):
+            print("%s <-- failed: %s" % (filename, entry))
+        else:
+            manifest[os.path.relpath(filename, directory)] = entry
+            converted.append(filename)
+
+    # Write to a temporary file first, such that an interrupted run does not leave a corrupt manifest
+    with open(manifest_filename + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    if hasattr(os, 'replace'):
+        os.replace(manifest_filename + '.tmp', manifest_filename)
+    else:
+        # Python 2: os.rename does not overwrite an existing file on Windows
+        if os.path.isfile(manifest_filename):
+            os.remove(manifest_filename)
+        os.rename(manifest_filename + '.tmp', manifest_filename)
+
+    return converted
+
+def get_phase(array, out=None):
     """
-    Returns the phase of a complex array.
+    Returns the phase of a complex array. Works on arrays of any shape.
     :param array: Array filled with complex numbers
-    :return: Array
+    :param out: Optional float array of the same shape to store the result in.
+    :return: Array with phases in rad, between -pi and pi
     """
-    phase_out = np.zeros([len(array)])
-    for idx,k in enumerate(array):
-        phase_out[idx] = cmath.phase(k)
-    return phase_out
+    array = np.asarray(array)
+    return np.arctan2(array.imag, array.real, out=out)
+
+def unwrap_phase(phase, axis=-1, discont=np.pi, out=None):
+    """
+    Unwraps a phase trace (in rad) by adding multiples of 2 pi wherever it jumps by more than discont.
+    :param phase: Array with phases in rad. Complex arrays are converted with get_phase first.
+    :param axis: Axis along which to unwrap.
+    :param discont: Maximum jump between two consecutive points.
+    :param out: Optional float array of the same shape to store the result in.
+    :return: Unwrapped phase
+    """
+    phase = np.asarray(phase)
+    if np.iscomplexobj(phase):
+        phase = get_phase(phase)
+    unwrapped = np.unwrap(phase, discont=discont, axis=axis)
+    if out is None:
+        return unwrapped
+    out[...] = unwrapped
+    return out
+
+def get_group_delay(xdata, ydata, axis=-1):
+    """
+    Group delay -d(phase)/d(omega) of a trace.
+    :param xdata: Frequency points in Hz, along axis
+    :param ydata: Complex data, or phase in rad. The phase is unwrapped first.
+    :param axis: Axis of ydata that corresponds to xdata.
+    :return: Group delay in s, same shape as ydata
+    """
+    phase = unwrap_phase(ydata, axis=axis)
+    return -np.gradient(phase, 2 * np.pi * np.asarray(xdata, dtype=np.float64), axis=axis)
+
+def remove_electrical_delay(xdata, ydata, delay, out=None):
+    """
+    Removes an electrical delay (cable length) from complex data: ydata * exp(2j * pi * xdata * delay)
+    :param xdata: Frequency points in Hz, along the last axis of ydata
+    :param ydata: Complex data
+    :param delay: Electrical delay in s. May be an array that broadcasts against ydata[..., 0] for a delay per trace.
+    :param out: Optional complex array of the same shape to store the result in. May be ydata itself.
+    :return: Complex data with the delay removed
+    """
+    delay = np.asarray(delay, dtype=np.float64)[..., np.newaxis]
+    rotation = np.exp(2j * np.pi * np.asarray(xdata, dtype=np.float64) * delay)
+    return np.multiply(ydata, rotation, out=out)
+
+def estimate_electrical_delay(xdata, ydata, edge=0.1):
+    """
+    Estimate the electrical delay from the slope of the phase in the first and last part of the trace, where the
+    phase of a resonator is almost flat.
+    :param xdata: Frequency points in Hz, along the last axis of ydata
+    :param ydata: Complex data. For 2D data the delay of every row is estimated.
+    :param edge: Fraction of the points on each side that is used
+    :return: Electrical delay in s, such that it is removed by remove_electrical_delay(xdata, ydata, delay)
+    """
+    xdata = np.asarray(xdata, dtype=np.float64)
+    phase = unwrap_phase(ydata)
+    n = max(int(edge * len(xdata)), 2)
+    slopes = list()
+    for s in [slice(None, n), slice(-n, None)]:
+        x = xdata[s] - np.mean(xdata[s])
+        y = phase[..., s]
+        y = y - np.mean(y, axis=-1)[..., np.newaxis]
+        slopes.append(np.sum(x * y, axis=-1) / np.sum(x ** 2))
+    return -(slopes[0] + slopes[1]) / (4 * np.pi)
 
 def remove_offset(xdata, ydata, f0=None):
     """
@@ -106,23 +369,74 @@ def find_nearest(array, value):
     idx=(np.abs(array-value)).argmin()
     return np.int(idx)
 
-def moving_average(ydata, window_size):
+def moving_average(ydata, window_size, axis=-1):
     """
     Outputs the moving average of a function interval over a window_size. Output is 
-    the same size as the input. 
+    the same size as the input. The result is identical to np.convolve(ydata, window, 'same') with a box window,
+    i.e. the data is padded with zeros at the edges, but it is calculated from a cumulative sum, such that the
+    time does not depend on window_size. For N-D arrays a window that is larger than ydata gives the same result as
+    convolve2d(..., mode='same').
+    :param ydata: Array
+    :param window_size: Number of points in the window
+    :param axis: Axis along which to average. For a 2D array, axis=-1 averages every row.
+    :return: Array with the same shape as ydata
     """
-    window = np.ones(int(window_size))/float(window_size)
-    return np.convolve(ydata, window, 'same')
-
-def moving_average_2d(ydata, window_size):
+    ydata = np.asarray(ydata)
+    w = int(window_size)
+    n = ydata.shape[axis]
+    if ydata.ndim == 1 and w > n:
+        # np.convolve returns more points than ydata in this case
+        window = np.ones(w)/float(window_size)
+        return np.convolve(ydata, window, 'same')
+
+    y = np.moveaxis(ydata, axis, -1)
+    cumsum = np.zeros(y.shape[:-1] + (n+1,), dtype=np.result_type(y.dtype, np.float64))
+    np.cumsum(y, axis=-1, out=cumsum[..., 1:])
+    # Sum over the points idx - w/2 ... idx + (w-1)/2, which is where np.convolve centers the window
+    idx = np.arange(n)
+    hi = np.minimum(idx + (w-1)//2 + 1, n)
+    lo = np.maximum(idx - w//2, 0)
+    averaged = (cumsum[..., hi] - cumsum[..., lo]) / float(window_size)
+    return np.moveaxis(averaged, -1, axis)
+
+def moving_average_2d(ydata, window_size, axes=(-2, -1)):
     """
     Convolve the 2D array ydata with a uniform window. This acts as a 2D low pass filter.
-    :param ydata: N x M array to apply the window to
-    :param window_size: Tuple: (Nrows, Ncols) where Ncols is the number of columns and NRows is the number of rows
+    The result is identical to convolve2d(ydata, window, mode='same'), but the window is applied as two running means
+    (see moving_average), such that the time does not depend on window_size.
+    :param ydata: N x M array to apply the window to. May also be a stack of 2D arrays, see axes.
+    :param window_size: Tuple: (Ncols, Nrows) where Ncols is the number of columns and Nrows is the number of rows
+    :param axes: Axes of the rows and columns, e.g. a stack of K x N x M can be filtered in one call.
     :return: N x M array (ydata convoluted with the window)
     """
-    window = np.ones((int(window_size[1]),int(window_size[0])))/float(window_size[0]*window_size[1])
-    return convolve2d(ydata, window, mode='same')
+    averaged = moving_average(ydata, window_size[1], axis=axes[0])
+    return moving_average(averaged, window_size[0], axis=axes[1])
+
+def fft_smooth(ydata, kernel, axes=-1):
+    """
+    Convolve ydata with an arbitrary kernel using FFTs (scipy.signal.fftconvolve). Output is the same size as the
+    input, with the same edge behavior as np.convolve and convolve2d with mode 'same'. This is much faster than direct
+    convolution for large kernels.
+    :param ydata: Array
+    :param kernel: Array with one dimension for each of the axes. The kernel is not normalized, e.g. use
+    np.hanning(51)/np.sum(np.hanning(51)) to smooth with a Hanning window.
+    :param axes: Axis or tuple of axes along which to convolve. E.g. a stack of K x N x M arrays is smoothed with a 2D
+    kernel if axes=(-2, -1).
+    :return: Array with the same shape as ydata
+    """
+    ydata = np.asarray(ydata)
+    kernel = np.asarray(kernel)
+    axes = np.atleast_1d(axes) % ydata.ndim
+    if kernel.ndim != len(axes):
+        raise ValueError("kernel should have one dimension for each of the axes")
+
+    # fftconvolve needs the kernel to have the same number of dimensions as ydata
+    order = np.argsort(axes)
+    kernel = np.transpose(kernel, order)
+    shape = np.ones(ydata.ndim, dtype=int)
+    shape[axes[order]] = kernel.shape
+    kernel = np.reshape(kernel, shape)
+    return signal.fftconvolve(ydata, kernel, mode='same', axes=tuple(axes))
 
 def dBm_to_W(Pdbm):
     """
@@ -194,58 +508,155 @@ def save_figure(fig, save_path=None, open_explorer=False):
 
 
 def mapped_color_plot(xdata, ydata, cmap=plt.cm.viridis, clim=None, scale_type='sequential', log_scaling=False,
-                      colorbar=False, **kwarg):
+                      colorbar=False, density=False, bins=500, **kwarg):
     """
     Plot points in a data set with different color. The value of the color is determined either by the x-value or the
-    y-value and can be scaled linearly or logarithmically.
+    y-value and can be scaled linearly or logarithmically. All points are drawn as a single scatter plot.
     :param xdata: x-points
     :param ydata: y-points
     :param cmap: plt.cm instance
     :param clim: Tuple (cmin, cmax). Default is None.
     :param scale_type: Either 'x', 'y', 'sequential' or 'external'
     :param log_scaling: Scale data logarithmically
-    :return:
+    :param colorbar: True/False. Adds a colorbar.
+    :param density: True/False. Instead of plotting individual points, the points are binned on a grid (see bins) and
+    every pixel gets the average color value of the points inside it. Pixels without points are transparent. Use this
+    for millions of points.
+    :param bins: Number of bins in x and y, or (nx, ny), for density=True
+    :param kwarg: Keyword arguments for plt.scatter, or plt.imshow if density=True. The plt.plot style keywords ms,
+    markersize, mec, markeredgecolor, mew and markeredgewidth are converted for plt.scatter, such that e.g.
+    **plot_opt('r') can be used. The face color always comes from cmap: mfc (markerfacecolor) 'none' draws hollow
+    markers with colored edges, other face colors and color are ignored. Other keywords that plt.scatter does not
+    accept (e.g. markevery) are ignored with a warning.
+    :return: The PathCollection (density=False) or AxesImage (density=True)
     """
+    xdata = np.asarray(xdata)
+    ydata = np.asarray(ydata)
+    if scale_type == 'x':
+        cdata = np.log10(xdata) if log_scaling else xdata
+    elif scale_type == 'sequential':
+        cdata = np.arange(len(xdata))
+    else:
+        cdata = np.log10(ydata) if log_scaling else ydata
+
     if clim is None:
-        if scale_type == 'x':
-            if log_scaling:
-                vmin, vmax = np.min(np.log10(xdata)), np.max(np.log10(xdata))
-            else:
-                vmin, vmax = np.min(xdata), np.max(xdata)
-        elif scale_type == 'sequential':
-            vmin, vmax = 0, len(xdata)-1
-        elif scale_type == 'y':
-            if log_scaling:
-                vmin, vmax = np.min(np.log10(ydata)), np.max(np.log10(ydata))
-            else:
-                vmin, vmax = np.min(ydata), np.max(ydata)
+        vmin, vmax = np.min(cdata), np.max(cdata)
     else:
         vmin, vmax = clim
 
-    import matplotlib
     norm = matplotlib.colors.Normalize(vmin=vmin, vmax=vmax)
     m = plt.cm.ScalarMappable(norm=norm, cmap=cmap)
 
-    #plt.scatter(xdata, ydata, c=)
-    idx = 0
-    for x, y in zip(xdata, ydata):
-        if scale_type == 'x':
-            if log_scaling:
-                plt.plot(x, y, 'o', color=m.to_rgba(np.log10(x)), **kwarg)
-            else:
-                plt.plot(x, y, 'o', color=m.to_rgba(x), **kwarg)
-        elif scale_type == 'sequential':
-            plt.plot(x, y, 'o', color=m.to_rgba(idx), **kwarg)
+    if density:
+        counts, xedges, yedges = np.histogram2d(xdata, ydata, bins=bins)
+        sums = np.histogram2d(xdata, ydata, bins=[xedges, yedges], weights=cdata)[0]
+        with np.errstate(invalid='ignore'):
+            image = np.ma.masked_invalid(sums / counts)
+        artist = plt.imshow(image.T, origin='lower', aspect='auto', interpolation='nearest', cmap=cmap, norm=norm,
+                            extent=[xedges[0], xedges[-1], yedges[0], yedges[-1]], **kwarg)
+    else:
+        # Translate the keywords that were used with plt.plot
+        conversions = {'ms': 's', 'markersize': 's', 'mec': 'edgecolors', 'markeredgecolor': 'edgecolors',
+                       'mew': 'linewidths', 'markeredgewidth': 'linewidths'}
+        scatter_keys = ['s', 'marker', 'alpha', 'linewidths', 'edgecolors', 'vmin', 'vmax', 'verts', 'plotnonfinite']
+        hollow = False
+        for key in list(kwarg.keys()):
+            if key in conversions:
+                kwarg[conversions[key]] = kwarg.pop(key)
+            elif key in ['mfc', 'markerfacecolor']:
+                hollow = str(kwarg.pop(key)).lower() == 'none'
+            elif key == 'color':
+                kwarg.pop(key)
+            elif key not in scatter_keys and not hasattr(matplotlib.collections.PathCollection, 'set_' + key):
+                print("Warning: mapped_color_plot ignores the keyword %s, which plt.scatter does not accept" % key)
+                kwarg.pop(key)
+        if 's' in kwarg:
+            kwarg['s'] = np.asarray(kwarg['s']) ** 2
+        kwarg.setdefault('marker', 'o')
+        if hollow:
+            # The colors are mapped onto the edges
+            kwarg['edgecolors'] = m.to_rgba(cdata)
+            artist = plt.scatter(xdata, ydata, facecolors='none', **kwarg)
         else:
-            if log_scaling:
-                plt.plot(x, y, 'o', color=m.to_rgba(np.log10(y)), **kwarg)
-            else:
-                plt.plot(x, y, 'o', color=m.to_rgba(y), **kwarg)
-        idx+=1
+            artist = plt.scatter(xdata, ydata, c=cdata, cmap=cmap, norm=norm, **kwarg)
 
     if colorbar:
-        m._A = []
-        plt.colorbar(m)
+        m.set_array([])
+        plt.colorbar(m, ax=plt.gca())
+
+    return artist
+
+def downsample_minmax(xdata, ydata, npoints=2000):
+    """
+    Reduce a long trace to about npoints points for plotting. The trace is divided in npoints/2 buckets and of every
+    bucket only the minimum and the maximum are kept, such that peaks stay visible. The first and last point are
+    always kept.
+    :param xdata: 1D array
+    :param ydata: 1D array with the same length as xdata, or 2D array with one trace per row.
+    :param npoints: Approximate number of points in the output. Twice the width of the plot in pixels is plenty.
+    :return: x, y. For 2D ydata, x is also 2D with one row per trace, because every trace keeps different points.
+    """
+    xdata = np.asarray(xdata)
+    ydata = np.asarray(ydata)
+    n = len(xdata)
+    nbuckets = max(int(npoints) // 2, 1)
+    if n <= 2*nbuckets:
+        return np.broadcast_to(xdata, ydata.shape), ydata
+
+    size = int(np.ceil(n / float(nbuckets)))
+    nbuckets = int(np.ceil(n / float(size)))
+    y = np.reshape(ydata, (-1, n))
+    # Repeat the last point to fill the last bucket
+    buckets = np.pad(y, ((0, 0), (0, nbuckets*size-n)), mode='edge').reshape(len(y), nbuckets, size)
+    offsets = np.arange(nbuckets) * size
+    ends = np.broadcast_to([0, n-1], (len(y), 2))
+    idx = np.concatenate((ends, np.argmin(buckets, axis=-1) + offsets, np.argmax(buckets, axis=-1) + offsets), axis=-1)
+    idx = np.sort(np.minimum(idx, n-1), axis=-1)
+
+    x = xdata[idx]
+    y = np.take_along_axis(y, idx, axis=-1)
+    if ydata.ndim == 1:
+        return x[0], y[0]
+    return x, y
+
+def plot_downsampled(xdata, ydata, *args, **kwargs):
+    """
+    Plot long traces with plt.plot, after reducing them with downsample_minmax. When the x-axis is zoomed or panned,
+    the visible part of the traces is downsampled again from the full data, such that no detail is lost.
+    :param xdata: 1D array, sorted
+    :param ydata: 1D array with the same length as xdata, or 2D array with one trace per row.
+    :param args: Format string, e.g. '-r'
+    :param npoints: Number of points per trace. Default is twice the width of the axes in pixels.
+    :param ax: Axes to plot in. Default is the current axes.
+    :param kwargs: Keyword arguments for plt.plot
+    :return: List of lines
+    """
+    npoints = kwargs.pop('npoints', None)
+    ax = kwargs.pop('ax', None)
+    if ax is None:
+        ax = plt.gca()
+    xdata = np.asarray(xdata)
+    ydata = np.asarray(ydata)
+
+    def get_npoints():
+        return npoints if npoints is not None else max(2*int(ax.bbox.width), 100)
+
+    x, y = downsample_minmax(xdata, ydata, get_npoints())
+    lines = ax.plot(x.T, y.T, *args, **kwargs)
+
+    if len(xdata) > 1 and np.all(np.diff(xdata) >= 0):
+        def update(ax):
+            xmin, xmax = sorted(ax.get_xlim())
+            # Include one point outside the axes, such that the lines continue to the edge
+            start = max(np.searchsorted(xdata, xmin, side='left') - 1, 0)
+            stop = np.searchsorted(xdata, xmax, side='right') + 1
+            x, y = downsample_minmax(xdata[start:stop], ydata[..., start:stop], get_npoints())
+            for line, x_trace, y_trace in zip(lines, np.atleast_2d(x), np.atleast_2d(y)):
+                line.set_data(x_trace, y_trace)
+
+        ax.callbacks.connect('xlim_changed', update)
+
+    return lines
 
 def configure_axes(fontsize):
     """
@@ -309,8 +720,55 @@ def setup_twinax(color1='black', color2='black'):
 
     return ax, ax2
 
+def get_spectrum(y, t, norm='amplitude', window=False, dtype=None, workers=None):
+    """
+    Single-sided spectrum of a real signal y(t), computed with a real FFT along the last axis. For 2D input
+    (records x samples) all records are transformed at once. t should have evenly spaced entries, i.e. constant dt.
+    :param y: Amplitude in V. 1D array or 2D array with one record per row.
+    :param t: Time in seconds. 1D array, or 2D array with one row per record, in which case the first row is used.
+    :param norm: 'amplitude' normalizes by 1/n (as in plot_spectrum), 'density' normalizes by sqrt(T)/n (as in get_psd)
+    :param window: True/False. Multiplies each record with a Hanning window. y itself is not modified.
+    :param dtype: np.float32 or np.float64. Default is float32 for float32 input and float64 otherwise. float32 halves
+    the memory and is faster, at the cost of precision.
+    :param workers: Number of threads used for the FFT, see scipy.fft. -1 uses all processors. Default is 1.
+    :return: Frequency, complex spectrum with n/2 points along the last axis
+    """
+    t = np.asarray(t)
+    if t.ndim > 1:
+        t = t.reshape(-1, t.shape[-1])[0]
+    if len(t) < 2:
+        raise ValueError("Length of t is smaler than 2, cannot compute FFT.")
+
+    y = np.asarray(y)
+    if dtype is None:
+        dtype = np.float32 if y.dtype == np.float32 else np.float64
+    y = y.astype(dtype, copy=False)
+
+    dt = t[1]-t[0]
+    n = y.shape[-1] # length of the signal
+    T = n*dt
+    frq = np.arange(int(n/2))/float(T) # one side frequency range
+
+    if window:
+        y = y * np.hanning(n).astype(dtype)
+
+    # The real FFT only computes the positive frequencies, which is all we need for real input signals
+    Y = _rfft(y, axis=-1, workers=workers)[..., :int(n/2)]
+    if norm == 'amplitude':
+        Y *= dtype(1./n)
+    elif norm == 'density':
+        Y *= dtype(np.sqrt(T)/n)
+    else:
+        raise ValueError("norm should be 'amplitude' or 'density'")
+
+    return frq, Y
+
+def _print_max_contribution(frq, Y):
+    idx = np.unravel_index(np.argmax(np.abs(Y)), np.shape(Y))
+    print("Maximum contribution to signal is %.2e for a frequency of %.2e Hz" % (np.abs(Y[idx]), frq[idx[-1]]))
+
 def plot_spectrum(y, t, ret=True, do_plot=True, freqlim='auto', ylim='auto', logscale=True, linear=True, type=None,
-                  verbose=True, do_phase=False):
+                  verbose=True, do_phase=False, workers=None):
     """
     Plots a Single-Sided Amplitude Spectrum of y(t). t should have evenly spaced entries, i.e. constant dt.
     Returns the spectrum.
@@ -323,7 +781,7 @@ def plot_spectrum(y, t, ret=True, do_plot=True, freqlim='auto', ylim='auto', log
 
     Should produce a peak at 1 Hz.
 
-    :param y: Amplitude in V.
+    :param y: Amplitude in V. May be a 2D array with one record per row, see get_spectrum.
     :param t: Time in seconds.
     :param ret: True/False. Default is True. Set to false if returning spectral data is not desired.
     :param do_plot: True/False. Plot the spectrum.
@@ -335,84 +793,73 @@ def plot_spectrum(y, t, ret=True, do_plot=True, freqlim='auto', ylim='auto', log
     :param type: 'psd' or 'asd'. Default is 'asd'
     :param verbose: True/False, Prints the maximum contribution in the spectrum.
     :param do_phase: True/False. Plots a second figure with the Phase spectral density.
+    :param workers: Number of threads used for the FFT, see get_spectrum.
     :return: Frequency, ASD (complex) for type='asd', Frequency, PSD (real) for type='psd'
     """
-    
-    if len(t) < 2: 
-        raise ValueError("Length of t is smaler than 2, cannot compute FFT.")
-    else:
-        dt = t[1]-t[0]
-        n = len(y) # length of the signal
-        T = n*dt
-        frq = np.arange(n)/float(T) # two sides frequency range
-        frq = frq[range(int(n/2))] # one side frequency range
-
-        Y = np.fft.fft(y)/float(n) # fft computing and normalization
-        Y = Y[range(int(n/2))] # maps the negative frequencies on the positive ones. Only works for real input signals!
-
-        if do_plot:
-            plt.figure(figsize = (6.,4.))
-            ax1 = plt.subplot(111)
-            configure_axes(13)
-            if linear:
-                if type == 'psd':
-                    ax1.plot(frq, np.abs(Y)**2, 'r')
-                    ax1.set_ylabel(r'Power spectral density (V$^2$)')
-                else:
-                    ax1.plot(frq, np.abs(Y), 'r') # plotting the spectrum
-                    ax1.set_ylabel(r'Amplitude spectral density (V)')
-                scientific_axes = 'both'
+    frq, Y = get_spectrum(y, t, norm='amplitude', workers=workers)
+
+    if do_plot:
+        plt.figure(figsize = (6.,4.))
+        ax1 = plt.subplot(111)
+        configure_axes(13)
+        if linear:
+            if type == 'psd':
+                plot_downsampled(frq, np.abs(Y)**2, 'r', ax=ax1)
+                ax1.set_ylabel(r'Power spectral density (V$^2$)')
             else:
-                if type == 'psd':
-                    ax1.plot(frq, 20*np.log10(np.abs(Y)), 'r')
-                    ax1.set_ylabel(r'Power spectral density (V$^2$)')
-                else:
-                    ax1.plot(frq, 10*np.log10(np.abs(Y)), 'r')
-                    ax1.set_ylabel(r'Amplitude spectral density (V)')
-
-                logscale = False
-                scientific_axes = 'x'
-
-            ax1.ticklabel_format(style='sci', axis=scientific_axes, scilimits=(0,0))
-
-            if do_phase:
-                plt.figure(figsize=(6.,4.))
-                ax2 = plt.subplot(111)
-                ax2.plot(frq, get_phase(Y), 'lightgreen')
-                ax2.set_ylabel('Phase density (rad)')
-                ax2.set_xlabel('$f$ (Hz)')
-
-            ax1.set_xlabel('$f$ (Hz)')
-
-            if logscale:
-                ax1.set_yscale('log')
-
-            if freqlim != 'auto':
-                try:
-                    ax1.set_xlim(freqlim)
-                    if do_phase:
-                        ax2.set_xlim(freqlim)
-                except:
-                    print("Not a valid xlim, please specify as [min, max]")
-
-            if ylim != 'auto':
-                try:
-                    ax1.set_ylim(ylim)
-                    if do_phase:
-                        ax2.set_ylim(ylim)
-                except:
-                    print("Not a valid ylim, please specify as [min, max]")
+                plot_downsampled(frq, np.abs(Y), 'r', ax=ax1) # plotting the spectrum
+                ax1.set_ylabel(r'Amplitude spectral density (V)')
+            scientific_axes = 'both'
+        else:
+            if type == 'psd':
+                plot_downsampled(frq, 20*np.log10(np.abs(Y)), 'r', ax=ax1)
+                ax1.set_ylabel(r'Power spectral density (V$^2$)')
+            else:
+                plot_downsampled(frq, 10*np.log10(np.abs(Y)), 'r', ax=ax1)
+                ax1.set_ylabel(r'Amplitude spectral density (V)')
 
+            logscale = False
+            scientific_axes = 'x'
 
-        if verbose:
-            print("Maximum contribution to signal is %.2e for a frequency of %.2e Hz"\
-                    %(np.max(np.abs(Y)), frq[np.where(np.max(np.abs(Y)))[0]]))
-    
-        if ret:
-            if type!='psd':
-                return frq,Y
-            else:
-                return frq, np.abs(Y)**2
+        ax1.ticklabel_format(style='sci', axis=scientific_axes, scilimits=(0,0))
+
+        if do_phase:
+            plt.figure(figsize=(6.,4.))
+            ax2 = plt.subplot(111)
+            plot_downsampled(frq, get_phase(Y), 'lightgreen', ax=ax2)
+            ax2.set_ylabel('Phase density (rad)')
+            ax2.set_xlabel('$f$ (Hz)')
+
+        ax1.set_xlabel('$f$ (Hz)')
+
+        if logscale:
+            ax1.set_yscale('log')
+
+        if freqlim != 'auto':
+            try:
+                ax1.set_xlim(freqlim)
+                if do_phase:
+                    ax2.set_xlim(freqlim)
+            except:
+                print("Not a valid xlim, please specify as [min, max]")
+
+        if ylim != 'auto':
+            try:
+                ax1.set_ylim(ylim)
+                if do_phase:
+                    ax2.set_ylim(ylim)
+            except:
+                print("Not a valid ylim, please specify as [min, max]")
+
+
+    if verbose:
+        _print_max_contribution(frq, Y)
+
+    if ret:
+        if type!='psd':
+            return frq,Y
+        else:
+            return frq, np.abs(Y)**2
 
 def split_power(power_in, conversion_loss):
     """
@@ -472,44 +919,79 @@ def simple_beep():
     """
     winsound.PlaySound('SystemAsterisk', winsound.SND_ALIAS)
 
+def find_fwhm(fpoints, magnitudes, start_idx=None, dB=True):
+    """
+    Find the full width at half maximum of a transmission peak, for every row of a 2D array at once. The two crossings
+    of the half maximum (the -3 dB points) closest to the peak are linearly interpolated between the frequency points.
+    This is a fast estimate, e.g. to screen many traces before fitting or to get initial guesses for kfit.fit_lor
+    (hwhm = fwhm/2).
+    :param fpoints: Frequency in Hz. 1D array, or 2D array with the same shape as magnitudes.
+    :param magnitudes: Magnitude of the transmission peak. 1D array, or 2D array with one trace per row.
+    :param start_idx: Index of the peak, int or array with one index per row. Default is the maximum of each trace.
+    :param dB: True if the magnitudes are in dB, in which case the -3 dB points are found. False for linear power, in
+    which case the points halfway between the peak and the minimum of the trace are found.
+    :return: f0, fwhm, Q. Floats for 1D input, arrays for 2D input. fwhm and Q are nan for traces where one of the
+    crossings is not found.
+    """
+    magnitudes = np.asarray(magnitudes, dtype=np.float64)
+    m = np.atleast_2d(magnitudes)
+    f = np.broadcast_to(np.asarray(fpoints, dtype=np.float64), magnitudes.shape).reshape(m.shape)
+    rows = np.arange(m.shape[0])
+    idx = np.arange(m.shape[1])
+
+    if start_idx is None:
+        start_idx = np.argmax(m, axis=1)
+    start_idx = np.broadcast_to(start_idx, rows.shape)
+    peak = m[rows, start_idx]
+    if dB:
+        level = peak - 3.
+    else:
+        level = (peak + np.min(m, axis=1)) / 2.
+    below = m <= level[:, np.newaxis]
+
+    # First point below the level on the right side and last point below the level on the left side of the peak
+    right = below & (idx > start_idx[:, np.newaxis])
+    left = below & (idx < start_idx[:, np.newaxis])
+    found = np.any(right, axis=1) & np.any(left, axis=1)
+    j_right = np.argmax(right, axis=1)
+    j_left = m.shape[1] - 1 - np.argmax(left[:, ::-1], axis=1)
+
+    def crossing(j0, j1):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            t = (level - m[rows, j0]) / (m[rows, j1] - m[rows, j0])
+        return f[rows, j0] + np.nan_to_num(t) * (f[rows, j1] - f[rows, j0])
+
+    f_right = crossing(np.maximum(j_right - 1, 0), j_right)
+    f_left = crossing(np.minimum(j_left + 1, m.shape[1] - 1), j_left)
+
+    f0 = f[rows, start_idx]
+    fwhm = np.where(found, f_right - f_left, np.nan)
+    Q = f0 / fwhm
+
+    if magnitudes.ndim == 1:
+        return f0[0], fwhm[0], Q[0]
+    return f0, fwhm, Q
+
 def q_finder(magnitudes, fpoints, debug=False, start_idx=None):
     """
-    Method to find the Q factor of a frequency vs magnitude (dB) trace.
-    :param magnitudes: Magnitude of the transmission peak in dB
+    Method to find the Q factor of a frequency vs magnitude (dB) trace. The -3 dB points are interpolated, see
+    find_fwhm.
+    :param magnitudes: Magnitude of the transmission peak in dB. 1D array, or 2D array with one trace per row.
     :param fpoints: Frequency in Hz
-    :param debug: Prints the magnitude at the current time step
+    :param debug: Prints the peak frequency and the -3 dB width of every trace
     :param start_idx: Point at which the searching for the -3dB points should begin. Default is the maximum of the curve.
-    :return: Q
-    """
-    if start_idx is None: 
-        start_idx = np.where(magnitudes == np.max(magnitudes))[0][0]
-    else: 
-        pass 
-
-    max_mag = magnitudes[start_idx]
-    if debug: print("Maximum magnitude is %.2f"%max_mag)
-    f0 = fpoints[start_idx]
-    walking_magnitude = max_mag
-    k=1
-
-    while abs(walking_magnitude-max_mag) < 3:
-        walking_magnitude = magnitudes[start_idx+k]
-        if debug: print(walking_magnitude)
-        k+=1
-
-    threedbpointright = fpoints[start_idx+k]
-    if debug: print(threedbpointright)
-    k=1
-
-    while abs(walking_magnitude-max_mag) < 3:
-        walking_magnitude = magnitudes[start_idx-k]
-        k+=1
-    
-    threedbpointleft = fpoints[start_idx-k]
-    if debug: print(threedbpointleft)
-
-    df = threedbpointright-threedbpointleft
-    return f0/df
+    :return: Q, or an array with Q for each row of magnitudes
+    """
+    f0, fwhm, Q = find_fwhm(fpoints, magnitudes, start_idx=start_idx)
+    if debug:
+        for f0_row, fwhm_row in zip(np.ravel(f0), np.ravel(fwhm)):
+            print("Peak at %.6e Hz, -3 dB width is %.3e Hz"%(f0_row, fwhm_row))
+    if np.ndim(Q) == 0 and np.isnan(Q):
+        print("Warning: -3 dB points could not be found on both sides of the peak")
+    elif np.any(np.isnan(Q)):
+        print("Warning: -3 dB points could not be found on both sides of the peak for %d of %d traces"
+              % (np.sum(np.isnan(Q)), np.size(Q)))
+    return Q
 
 def get_thermal_photons(f, T):
     """
@@ -548,82 +1030,233 @@ def get_noof_photons_in_input(P, f):
     P_W = 10**((P-30)/10.)
     return P_W/(hbar*w0**2/(2*np.pi))
 
-def pad_zeros(f, Y, until='auto', verbose=False):
+def pad_zeros(f, Y, until='auto', verbose=False, axis=-1, out=None):
     """
     Fill an array with zeros up to a specific index "until". Until may be "auto" which means the program will
-    add zeros until the size of the new array is a power of two.
+    add zeros until the size of the new array is a power of two, or "fast" which pads to the next length for which the
+    FFT is efficient (see scipy.fft.next_fast_len): only factors 2, 3 and 5 for real Y, and also 7 and 11 for
+    complex Y. With the older scipy.fftpack, which has no scipy.fft, the factors are 2, 3 and 5 in both cases. This
+    length is never longer, and often much shorter, than the next power of two.
     :param f: Frequency domain data (1D array)
-    :param Y: Amplitude data (1D or 2D array)
-    :param until: 'auto' or an integer
+    :param Y: Amplitude data (N-D array). Its length along axis should be the same as the length of f.
+    :param until: 'auto', 'fast' or an integer
     :param verbose: True/False
-    :return:
+    :param axis: Axis of Y along which to pad.
+    :param out: Optional preallocated array with the shape of Y, except along axis where it may be longer than the
+    padded length. Y is copied into out and the padded part is returned as a view of out, such that repeated calls
+    do not allocate new arrays.
+    :return: fnew, Ynew
     """
-    if len(f) != len(Y):
+    Y = np.asarray(Y)
+    axis = axis % Y.ndim
+    Ni = Y.shape[axis]
+    if len(f) != Ni:
         print("Expected arrays of same length, got different size arrays.")
-    else:
-        if until == 'auto':
-            # Pad zeros until the nearest power of 2:
-            Ni = len(Y)
-            Nf = int(2**(np.ceil(np.log2(Ni))))
-        elif isinstance(until, int):
-            Nf = until
+        return
+
+    if until == 'auto':
+        # Pad zeros until the nearest power of 2:
+        Nf = int(2**(np.ceil(np.log2(Ni))))
+    elif until == 'fast':
+        if scipy_fft is None:
+            Nf = scipy.fftpack.next_fast_len(Ni)
         else:
-            raise ValueError('Until may be one of two things: auto or an integer.')
+            Nf = scipy_fft.next_fast_len(Ni, real=not np.iscomplexobj(Y))
+    elif isinstance(until, (int, np.integer)):
+        Nf = int(until)
+    else:
+        raise ValueError('Until may be one of three things: auto, fast or an integer.')
+    if Nf < Ni:
+        raise ValueError('Until should be at least the length of the array (%d).' % Ni)
 
-        if len(Y.shape) > 1:
-            # 2D arrays
-            Ynew = np.zeros((Y.shape[0], Nf))
-            Ynew[:,:Ni] = Y
+    def along_axis(s):
+        return (slice(None),)*axis + (s,)
 
-        else:
-            Ynew = np.zeros(Nf)
-            fnew = np.zeros(Nf)
-            df = np.diff(f)[0]
+    if out is None:
+        shape = list(Y.shape)
+        shape[axis] = Nf
+        Ynew = np.zeros(shape, dtype=np.result_type(Y.dtype, np.float64))
+    else:
+        Ynew = out[along_axis(slice(None, Nf))]
+        if Ynew.shape[axis] != Nf or Ynew.shape[:axis]+Ynew.shape[axis+1:] != Y.shape[:axis]+Y.shape[axis+1:]:
+            raise ValueError("out has the wrong shape")
+        Ynew[along_axis(slice(Ni, None))] = 0
+    Ynew[along_axis(slice(None, Ni))] = Y
 
-            Ynew[:Ni] = Y
-            fnew[:Ni] = f
-            fnew[Ni:Nf] = np.linspace(f[-1]+df, f[0]+Nf*df, Nf-Ni)
+    fnew = np.zeros(Nf)
+    df = f[1]-f[0]
+    fnew[:Ni] = f
+    fnew[Ni:] = f[-1] + df*np.arange(1, Nf-Ni+1)
 
-        if verbose:
-            try:
-                print("New shape of array is (%d x %d)" % (Ynew.shape[0], Ynew.shape[1]))
-            except:
-                print("New length of array is %d" % (Ynew.shape[0]))
+    if verbose:
+        print("New shape of array is (%s)" % " x ".join(str(n) for n in Ynew.shape))
 
-        return fnew, Ynew
+    return fnew, Ynew
 
-def get_psd(t, y, verbose=False, window=True):
+def get_psd(t, y, verbose=False, window=True, workers=None):
     """
     Computes the periodogram Only for real signals.
     :param t: Time in seconds
-    :param y: Amplitude in V
+    :param y: Amplitude in V. May be a 2D array with one record per row, see get_spectrum. y is not modified.
     :param verbose: True/False. This will print(the value of the largest contribution to the PSD
     :param window: This will multiply the FFT with a Hanning window to reduce influence from the finite measurement time.
                    The defult is True. The Hanning window's efficiency is largest for finite size time traces.
                    More on Hanning windows here: https://en.wikipedia.org/wiki/Window_function#Hann_.28Hanning.29_window
+    :param workers: Number of threads used for the FFT, see get_spectrum.
     :return: frequency, PSD
     """
 
-    if len(t) < 2:
-        raise ValueError("Length of t is smaler than 2, cannot compute FFT.")
-    else:
-        dt = t[1]-t[0]
-        n = len(y) # length of the signal
-        T = n*dt
-        frq = np.arange(n)/float(T) # two sides frequency range
-        frq = frq[range(int(n/2))] # one side frequency range
+    frq, Y = get_spectrum(y, t, norm='density', window=window, workers=workers)
+
+    if verbose:
+        _print_max_contribution(frq, Y)
+
+    return frq, np.abs(Y)**2
+
+class WelchPSD(object):
+    """
+    Streaming PSD estimate using Welch's method: the signal is cut into overlapping segments, each segment is
+    windowed and Fourier transformed, and the periodograms are averaged. Data is fed in blocks of arbitrary length
+    with update(), so that only one segment (plus the block that is being processed) has to be in memory. This
+    makes it possible to process recordings that are larger than memory, e.g. from a generator or a np.memmap.
+    The normalization is that of scipy.signal.welch with scaling='density', i.e. a single-sided PSD in V^2/Hz.
+
+    Example usage:
 
-        if window:
-            y *= np.hanning(n)
+    welch = WelchPSD(dt, nperseg=2**14)
+    for block in iter_blocks:
+        welch.update(block)
+        print(welch.nsegments)
+    f, psd = welch.result()
+    """
 
-        Y = np.fft.fft(y)*np.sqrt(T)/float(n) # fft computing and normalization
-        Y = Y[range(int(n/2))] # maps the negative frequencies on the positive ones. Only works for real input signals!
+    def __init__(self, dt, nperseg=4096, noverlap=None, window='hann', detrend='constant', dtype=np.float64,
+                 workers=None):
+        """
+        :param dt: Time step in seconds
+        :param nperseg: Number of points per segment. Sets the frequency resolution 1/(nperseg*dt).
+        :param noverlap: Number of points that consecutive segments overlap. Default is nperseg/2.
+        :param window: Window name for scipy.signal.get_window, or an array of length nperseg.
+        :param detrend: 'constant' to subtract the mean of each segment, or False.
+        :param dtype: np.float32 or np.float64. Precision of the FFTs. The PSD is always accumulated in float64.
+        :param workers: Number of threads used for the FFT, see scipy.fft.
+        """
+        if noverlap is None:
+            noverlap = nperseg // 2
+        if not 0 <= noverlap < nperseg:
+            raise ValueError("noverlap should be smaller than nperseg")
+        if detrend not in ['constant', False, None]:
+            raise ValueError("detrend should be 'constant' or False")
+
+        self.dt = dt
+        self.nperseg = nperseg
+        self.noverlap = noverlap
+        self.step = nperseg - noverlap
+        self.detrend = detrend
+        self.dtype = dtype
+        self.workers = workers
+
+        if isinstance(window, str) or isinstance(window, tuple):
+            window = signal.get_window(window, nperseg)
+        window = np.asarray(window, dtype=dtype)
+        if window.shape != (nperseg,):
+            raise ValueError("window should have length nperseg")
+        self.window = window
+
+        self.scale = 2. * dt / np.sum(window.astype(np.float64) ** 2)
+        self.frequencies = np.fft.rfftfreq(nperseg, dt)
+        self.reset()
+
+    def reset(self):
+        """
+        Discard all data.
+        """
+        self.nsegments = 0
+        self._sum = None
+        self._buffer = None
+
+    def update(self, block):
+        """
+        Add a block of data. The last axis is time, leading axes (e.g. channels) should be the same for every block.
+        Samples that do not fill a complete segment are kept until the next call.
+        :param block: Array of voltages
+        :return: Number of segments that have been averaged so far
+        """
+        block = np.asarray(block, dtype=self.dtype)
+        if self._buffer is not None:
+            block = np.concatenate((self._buffer, block), axis=-1)
+
+        n = block.shape[-1]
+        if n >= self.nperseg:
+            nseg = (n - self.nperseg) // self.step + 1
+            # Overlapping segments as a view of block, without copying
+            segments = np.lib.stride_tricks.as_strided(block, shape=block.shape[:-1] + (nseg, self.nperseg),
+                                                       strides=block.strides[:-1] + (self.step * block.strides[-1],
+                                                                                     block.strides[-1]),
+                                                       writeable=False)
+            if self.detrend:
+                segments = segments - np.mean(segments, axis=-1, keepdims=True)
+            Y = _rfft(segments * self.window, axis=-1, workers=self.workers)
+            power = np.sum(np.abs(Y) ** 2, axis=-2, dtype=np.float64)
+            if self._sum is None:
+                self._sum = power
+            else:
+                self._sum += power
+            self.nsegments += nseg
+            block = block[..., nseg * self.step:]
+
+        # Copy, such that the buffer does not keep a (memory mapped) block alive
+        self._buffer = np.array(block)
+        return self.nsegments
+
+    @property
+    def psd(self):
+        """
+        Running average of the single-sided PSD in V^2/Hz, or None if no complete segment has been processed.
+        """
+        if self._sum is None:
+            return None
+        psd = self._sum * (self.scale / self.nsegments)
+        # DC and Nyquist frequency appear only once in the single-sided spectrum
+        psd[..., 0] /= 2.
+        if self.nperseg % 2 == 0:
+            psd[..., -1] /= 2.
+        return psd
+
+    def result(self):
+        """
+        :return: frequency, PSD
+        """
+        if self._sum is None:
+            raise ValueError("Not enough data for a single segment of %d points" % self.nperseg)
+        return self.frequencies, self.psd
+
+def get_welch_psd(y, dt, nperseg=4096, noverlap=None, window='hann', blocksize=2**22, verbose=False, **kwargs):
+    """
+    Averaged PSD of a long recording using Welch's method, see WelchPSD. The recording is processed in blocks, such
+    that y may be a np.memmap or a generator that yields blocks.
+    :param y: Array (or memory mapped array) with time along the last axis, or an iterable of such blocks.
+    :param dt: Time step in seconds
+    :param nperseg: Number of points per segment
+    :param noverlap: Number of points that consecutive segments overlap. Default is nperseg/2.
+    :param window: Window name or array, see WelchPSD
+    :param blocksize: Number of points per block if y is an array.
+    :param verbose: True/False. Prints the number of averaged segments after every block.
+    :param kwargs: Other keyword arguments for WelchPSD, e.g. dtype or workers.
+    :return: frequency, PSD in V^2/Hz
+    """
+    welch = WelchPSD(dt, nperseg=nperseg, noverlap=noverlap, window=window, **kwargs)
+    if isinstance(y, np.ndarray):
+        blocks = (y[..., k:k + blocksize] for k in range(0, y.shape[-1], blocksize))
+    else:
+        blocks = y
 
+    for block in blocks:
+        nsegments = welch.update(block)
         if verbose:
-            print("Maximum contribution to signal is %.2e for a frequency of %.2e Hz"\
-                    %(np.max(np.abs(Y)), frq[np.where(np.max(np.abs(Y)))[0]]))
+            print("%d segments averaged" % nsegments)
 
-        return frq, np.abs(Y)**2
+    return welch.result()
 
 def get_circular_points(radius, npts, theta_offset=0, do_plot=True):
     """
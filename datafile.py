@@ -0,0 +1,442 @@
+import numpy as np
+import h5py
+from collections import OrderedDict
+
+def _stack_sort_key(name):
+    suffix = name[len('stack_'):]
+    if suffix.isdigit():
+        return (0, int(suffix), name)
+    return (1, 0, name)
+
+def get_stacks(h5file):
+    """
+    Names of the stack groups in a file, in numerical order.
+    :param h5file: Open h5py.File
+    :return: List of group names that start with 'stack_'
+    """
+    return sorted([name for name in h5file.keys() if name.startswith('stack_')], key=_stack_sort_key)
+
+def read_dict(item):
+    """
+    Read a dictionary that was saved in a h5 file. The dictionary may be stored as the attributes of a group, as
+    datasets in a group (one per key) or a combination of both.
+    :param item: h5py.Group
+    :return: Dictionary
+    """
+    d = dict(item.attrs)
+    for key, value in item.items():
+        if isinstance(value, h5py.Dataset):
+            d[key] = value[()]
+    for key, value in d.items():
+        if isinstance(value, bytes):
+            d[key] = value.decode()
+    return d
+
+def _dict_table(dicts):
+    """
+    Convert a list of dictionaries with (mostly) the same keys into a structured array with one field per key.
+    Numerical values are stored as float64, other values as objects. Missing values are nan or None.
+    """
+    keys = list()
+    for d in dicts:
+        keys += [key for key in d.keys() if key not in keys]
+
+    formats = list()
+    for key in keys:
+        values = [d[key] for d in dicts if key in d]
+        numeric = all(np.ndim(v) == 0 and isinstance(v, (int, float, np.number)) for v in values)
+        formats.append(np.float64 if numeric else object)
+
+    table = np.zeros(len(dicts), dtype={'names': keys, 'formats': formats})
+    for key, fmt in zip(keys, formats):
+        table[key] = [d.get(key, np.nan if fmt is np.float64 else None) for d in dicts]
+    return table
+
+def load_stacks(filename, keys, stacks=None, dicts=None, dtype=None, lazy=None):
+    """
+    Read datasets from all stacks in a data file at once. The file is opened once, and each dataset is read into
+    one contiguous, preallocated array with the stack as first axis. This replaces loops of the form
+
+    for stack in stacks:
+        data.current_stack = stack
+        mags = data.get('mags')
+        Ts = data.get_dict('Temperatures')
+
+    :param filename: Filename of the .h5 file
+    :param keys: List of dataset names, e.g. ['fpoints', 'mags', 'phases', 'puff_nr']. Every stack should contain
+    these datasets, with the same shape in every stack.
+    :param stacks: List of stack names. Default is all stacks in the file, see get_stacks.
+    :param dicts: List of names of dictionaries that are saved in each stack, e.g. ['Temperatures'].
+    :param dtype: dtype of the output arrays. Default is the dtype in the file.
+    :param lazy: List of keys that are not read, but returned as StackArray, e.g. for datasets that do not fit in
+    memory. These should be closed with StackArray.close() when done.
+    :return: stacks, data, metadata. data is a dictionary with an array of shape (len(stacks), ...) for each key.
+    metadata is a dictionary with a structured array of length len(stacks) for each name in dicts, which has a field
+    for each key of the dictionary, e.g. metadata['Temperatures']['MC RuO2'].
+    """
+    with h5py.File(filename, 'r') as f:
+        if stacks is None:
+            stacks = get_stacks(f)
+        groups = [f[stack] for stack in stacks]
+
+        data = dict()
+        for key in keys:
+            if lazy is not None and key in lazy:
+                data[key] = StackArray(filename, key, stacks=stacks)
+                continue
+
+            path = key.replace('.', '/')
+            if len(groups):
+                shape, file_dtype = groups[0][path].shape, groups[0][path].dtype
+            else:
+                shape, file_dtype = (), np.float64
+            out = np.empty((len(groups),) + shape, dtype=dtype if dtype is not None else file_dtype)
+            for idx, group in enumerate(groups):
+                dataset = group[path]
+                if dataset.shape != shape:
+                    raise ValueError("Shape of %s in %s is %s, expected %s. Load these stacks separately."
+                                     % (key, stacks[idx], dataset.shape, shape))
+                if dataset.size and dataset.dtype == out.dtype:
+                    dataset.read_direct(out[idx, ...])
+                else:
+                    out[idx] = dataset[()]
+            data[key] = out
+
+        metadata = dict()
+        for name in (dicts if dicts is not None else list()):
+            path = name.replace('.', '/')
+            metadata[name] = _dict_table([read_dict(group[path]) for group in groups])
+
+    return list(stacks), data, metadata
+
+def _check_index(idx, n):
+    """
+    Raise an IndexError if idx is out of bounds for an axis of length n, like numpy does.
+    :return: int(idx)
+    """
+    idx = int(idx)
+    if not -n <= idx < n:
+        raise IndexError("index %d is out of bounds for axis with size %d" % (idx, n))
+    return idx
+
+class StackArray(object):
+    """
+    Array-like view of a dataset in all stacks of a data file, with the stack as first axis, that is read lazily.
+    Indexing reads only the requested part from disk, e.g. stack_array[:, 0, 1000:2000] reads points 1000 to 2000 of
+    the first row in every stack. Data is read in blocks along the last axis, which contain only the requested rows
+    (integer indices and slices along the other axes), and the most recently used blocks are kept in memory up to
+    cache_size bytes, such that repeated access to the same region is fast. This makes it possible to analyze files
+    that are much larger than the available memory.
+
+    Example usage:
+
+    ffts = StackArray('alazar_sweep.h5', 'averaged_fft')
+    print(ffts.shape)
+    selection = ffts[:, 0, min_idx:max_idx]
+    ffts.close()
+    """
+    # Default number of points per block along the last axis for datasets that are not chunked
+    default_blocksize = 2**16
+
+    def __init__(self, source, key, stacks=None, cache_size=2**28, blocksize=None):
+        """
+        :param source: Filename of the .h5 file or an open h5py.File
+        :param key: Name of the dataset in each stack, e.g. 'mags'. It should have the same shape in every stack.
+        :param stacks: List of stack names. Default is all stacks in the file, see get_stacks.
+        :param cache_size: Maximum size of the cached blocks in bytes
+        :param blocksize: Number of points along the last axis per block. Default is the chunk size of the dataset
+        along the last axis, or default_blocksize for datasets that are not chunked.
+        """
+        if isinstance(source, h5py.File):
+            self._file = source
+            self._owns_file = False
+        else:
+            self._file = h5py.File(source, 'r')
+            self._owns_file = True
+        self.key = key
+        self.stacks = get_stacks(self._file) if stacks is None else list(stacks)
+        self._path = key.replace('.', '/')
+
+        first = self._dataset(0)
+        self.shape = (len(self.stacks),) + first.shape
+        self.dtype = first.dtype
+        if len(first.shape) == 0:
+            raise ValueError("StackArray needs datasets with at least one dimension, use load_stacks for scalars")
+        if blocksize is None:
+            if first.chunks is not None:
+                blocksize = first.chunks[-1]
+            else:
+                blocksize = min(first.shape[-1], self.default_blocksize)
+        self.blocksize = max(int(blocksize), 1)
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._cached_bytes = 0
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self[:], dtype=dtype)
+
+    def close(self):
+        self._cache.clear()
+        self._cached_bytes = 0
+        if self._owns_file:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _dataset(self, stack_idx):
+        dataset = self._file[self.stacks[stack_idx]][self._path]
+        if len(self.stacks) and stack_idx > 0 and dataset.shape != self.shape[1:]:
+            raise ValueError("Shape of %s in %s is %s, expected %s."
+                             % (self.key, self.stacks[stack_idx], dataset.shape, self.shape[1:]))
+        return dataset
+
+    def _block(self, stack_idx, lead, block_idx):
+        """
+        Block number block_idx along the last axis of the dataset in stack stack_idx, from the cache if possible.
+        lead is a tuple with (start, stop, step) of the rows that are read along each of the other axes.
+        """
+        cache_key = (stack_idx, lead, block_idx)
+        if cache_key in self._cache:
+            # Move to the end, i.e. most recently used
+            block = self._cache.pop(cache_key)
+            self._cache[cache_key] = block
+            return block
+
+        selection = tuple(slice(*rows) for rows in lead) + (slice(block_idx*self.blocksize,
+                                                                 (block_idx+1)*self.blocksize),)
+        block = self._dataset(stack_idx)[selection]
+        # The cached blocks are shared by all reads, so these should never be modified
+        block.flags.writeable = False
+        self._cache[cache_key] = block
+        self._cached_bytes += block.nbytes
+        while self._cached_bytes > self.cache_size and len(self._cache) > 1:
+            self._cached_bytes -= self._cache.popitem(last=False)[1].nbytes
+        return block
+
+    def _read(self, stack_idx, lead, start, stop):
+        """
+        Data of one stack in the rows lead (see _block) and between start and stop along the last axis. This is always
+        a new array, never a view of a cached block.
+        """
+        first_block = start // self.blocksize
+        last_block = max(stop - 1, start) // self.blocksize
+        blocks = [self._block(stack_idx, lead, b) for b in range(first_block, last_block + 1)]
+        offset = first_block * self.blocksize
+        if len(blocks) == 1:
+            return blocks[0][..., start-offset:stop-offset].copy()
+        return np.concatenate(blocks, axis=-1)[..., start-offset:stop-offset]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(k is Ellipsis for k in key):
+            idx = [k is Ellipsis for k in key].index(True)
+            key = key[:idx] + (slice(None),) * (self.ndim - len(key) + 1) + key[idx+1:]
+        key = key + (slice(None),) * (self.ndim - len(key))
+        if len(key) > self.ndim:
+            raise IndexError("Too many indices for StackArray with %d dimensions" % self.ndim)
+
+        stack_key, inner_key = key[0], key[1:]
+
+        # Only the range along the last axis that is needed is read
+        n = self.shape[-1]
+        last = inner_key[-1]
+        if isinstance(last, slice):
+            start, stop, step = last.indices(n)
+            if step < 0:
+                start, stop = stop + 1, start + 1
+            stop = max(stop, start)
+            inner_last = slice(0, stop-start, abs(step)) if step > 0 else slice(None, None, step)
+        elif np.ndim(last) == 0:
+            start = _check_index(last, n) % n
+            stop = start + 1
+            inner_last = 0
+        else:
+            last = np.asarray(last)
+            if last.dtype == bool:
+                if len(last) != n:
+                    raise IndexError("boolean index has length %d, expected %d" % (len(last), n))
+                last = np.flatnonzero(last)
+            if len(last):
+                _check_index(np.min(last), n)
+                _check_index(np.max(last), n)
+            last = last % n
+            start, stop = (int(np.min(last)), int(np.max(last)) + 1) if len(last) else (0, 0)
+            inner_last = last - start
+
+        # Only the requested rows along the other axes are read. An integer index is read as a row of length one, such
+        # that the key keeps its structure and numpy's indexing rules apply unchanged to the rows that were read.
+        lead = list()
+        inner_lead = list()
+        for k, dim in zip(inner_key[:-1], self.shape[1:-1]):
+            if isinstance(k, slice) and k.indices(dim)[2] > 0 and len(range(*k.indices(dim))):
+                lead.append(k.indices(dim))
+                inner_lead.append(slice(None))
+            elif not isinstance(k, slice) and np.ndim(k) == 0 and np.asarray(k).dtype != bool:
+                k = _check_index(k, dim) % dim
+                lead.append((k, k + 1, 1))
+                inner_lead.append(0)
+            else:
+                # Negative steps, empty slices and index arrays are applied after reading all rows
+                lead.append((0, dim, 1))
+                inner_lead.append(k)
+        lead = tuple(lead)
+        inner_key = tuple(inner_lead) + (inner_last,)
+
+        if np.ndim(stack_key) == 0 and not isinstance(stack_key, slice):
+            return self._read(_check_index(stack_key, len(self)) % len(self), lead, start, stop)[inner_key]
+
+        stack_idxs = np.arange(len(self))[stack_key]
+        out = None
+        for idx, stack_idx in enumerate(stack_idxs):
+            data = self._read(stack_idx, lead, start, stop)[inner_key]
+            if out is None:
+                out = np.empty((len(stack_idxs),) + np.shape(data), dtype=self.dtype)
+            out[idx] = data
+        if out is None:
+            out = np.empty((0,) + np.shape(self._read(0, lead, start, stop)[inner_key]), dtype=self.dtype)
+        return out
+
+class DataCache(object):
+    """
+    Reader and writer for the h5 data files, which implements the part of slab's dataCacheProxy that is used in this
+    package: index, current_stack, get, get_dict and append (plus set_dict). The file is opened on first use and kept
+    open until close() is called, instead of being opened for every call. By default it is opened read only, and only
+    reopened for writing by append or set_dict. Datasets created by append are chunked and compressed.
+
+    Example usage:
+
+    data = DataCache(filepath='level_meter.h5')
+    for stack in data.index():
+        data.current_stack = stack
+        mags = data.get('mags')
+    data.close()
+    """
+
+    def __init__(self, expInst=None, filepath=None, mode=None, compression='gzip'):
+        """
+        :param expInst: Not used, for compatibility with dataCacheProxy
+        :param filepath: Filename of the .h5 file
+        :param mode: 'a' (read and write, create the file if it does not exist) or 'r' (read only). Default is None,
+        which opens an existing file read only, and reopens it with 'a' on the first call of append or set_dict.
+        :param compression: Compression filter for new datasets, e.g. 'gzip', 'lzf' or None
+        """
+        self.expInst = expInst
+        self.filepath = filepath
+        self.mode = mode
+        self.compression = compression
+        self.current_stack = ''
+        self._file = None
+
+    @property
+    def file(self):
+        """
+        The open h5py.File
+        """
+        if self._file is None:
+            self._file = h5py.File(self.filepath, 'r' if self.mode is None else self.mode)
+        return self._file
+
+    def _writable_file(self):
+        """
+        The open h5py.File, reopened for writing if it was opened read only because mode is None.
+        """
+        if self.mode is None and (self._file is None or self._file.mode == 'r'):
+            self.close()
+            self._file = h5py.File(self.filepath, 'a')
+        return self.file
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    def _route(self, key):
+        route = key if not self.current_stack else self.current_stack + '.' + key
+        return route.replace('.', '/')
+
+    def index(self, key=''):
+        """
+        :param key: Group relative to current_stack. Default is current_stack itself.
+        :return: List of the names in a group, e.g. the stacks in the file if current_stack = ''
+        """
+        route = self._route(key) if key else self.current_stack.replace('.', '/')
+        group = self.file[route] if route else self.file
+        return list(group.keys())
+
+    def get(self, key):
+        """
+        :param key: Name of the dataset in current_stack
+        :return: Array
+        """
+        return self.file[self._route(key)][()]
+
+    def get_dict(self, key):
+        """
+        :param key: Name of the dictionary in current_stack
+        :return: Dictionary, see read_dict
+        """
+        return read_dict(self.file[self._route(key)])
+
+    def set_dict(self, key, d):
+        """
+        Save a dictionary in current_stack, as the attributes of a group.
+        :param key: Name of the dictionary
+        :param d: Dictionary with numbers or strings as values
+        """
+        route = self._route(key)
+        f = self._writable_file()
+        if route in f:
+            del f[route]
+        group = f.create_group(route)
+        for k, v in d.items():
+            group.attrs[k] = v
+
+    def append(self, key, data):
+        """
+        Append data as a new row to a dataset in current_stack. A new dataset of shape (1, ...) is created if it does
+        not exist yet. Every row is a separate chunk, such that reading a single row is fast.
+        :param key: Name of the dataset
+        :param data: Number or array, with the same shape for every call
+        """
+        data = np.asarray(data)
+        route = self._route(key)
+        f = self._writable_file()
+        if route not in f:
+            f.create_dataset(route, data=data[np.newaxis], maxshape=(None,) + data.shape,
+                             chunks=(1,) + data.shape if data.size else True,
+                             compression=self.compression if data.size > 1 else None)
+        else:
+            dataset = f[route]
+            dataset.resize(dataset.shape[0] + 1, axis=0)
+            dataset[-1] = data
+
+# Same name as in slab's data_cache module, such that this module can be used in its place, e.g. in common.csv_to_h5
+dataCacheProxy = DataCache
@@ -3,6 +3,12 @@ import os, sys, time
 from matplotlib import pyplot as plt
 from . import common, kfit
 
+try:
+    from data_cache import dataCacheProxy
+except ImportError:
+    # Stand-in for the slab data_cache module, which implements the methods used in this module
+    from .datafile import DataCache as dataCacheProxy
+
 def get_geophone_constants():
     """
     :return: A dictionary of constants used in the rest of this module
@@ -128,22 +134,13 @@ def get_geophone_spectrum(df, G, freqlim=[1.0, 200.0], Q=1.54, f0=4.55, Z12=31.5
     if np.sum(ch1) == 0:
         print("WARNING: sum of ch1 is 0 for %s" % df)
 
-    psd = np.zeros((np.shape(ch1)[0], np.shape(ch1)[1] / 2))
-    rms = list()
-    for idx in range(np.shape(ch1)[0]):
-        freq, spectral_density = common.plot_spectrum(ch1[idx, :] / np.float(G), t[idx, :], freqlim='auto',
-                                                      linear=False,
-                                                      type='psd', do_plot=False, verbose=False)
-
-        psd[idx, :] = np.abs(spectral_density)
-
-        start = np.where(freq > freqlim[0])[0][0]
-        stop = np.where(freq < freqlim[1])[0][-1]
-        rms.append(get_frequency_rms(
-            get_geophone_displacement(freq[start:stop], 2 * psd[idx, :][start:stop], Q=Q, f0=f0, Z12=Z12)))
+    # All repetitions are transformed at once
+    freq, spectrum = common.get_spectrum(ch1 / float(G), t, workers=-1)
+    psd = np.abs(spectrum) ** 2
 
     start = np.where(freq > freqlim[0])[0][0]
     stop = np.where(freq < freqlim[1])[0][-1]
+    rms = get_frequency_rms(get_geophone_displacement(freq[start:stop], 2 * psd[:, start:stop], Q=Q, f0=f0, Z12=Z12))
 
     if do_meters_per_sqrt_Hz:
         meanpsd = 2 * np.mean(psd, axis=0) * np.sqrt(max(t[0, :]))
@@ -167,7 +164,7 @@ def get_geophone_spectrum(df, G, freqlim=[1.0, 200.0], Q=1.54, f0=4.55, Z12=31.5
     if do_plot:
         fig2 = plt.figure(figsize=(12., 4.))
         common.configure_axes(13)
-        plt.plot(freq[start:stop], calibrated_displacement, '-r')
+        common.plot_downsampled(freq[start:stop], calibrated_displacement, '-r')
         plt.xlabel('FFT frequency (Hz)')
         plt.yscale('log')
         plt.xlim(freqlim)
@@ -241,7 +238,7 @@ def compare_traces(dfs, gains, freqlim, Qs=1.54, f0s=4.552, Z12s=31.58, leg=None
 
         f, cal = get_geophone_spectrum(df, G, freqlim=freqlim, Q=Q, f0=f0, Z12=Z12, do_imshow=False,
                                        do_plot=False, ret=True, name=leg[i], do_meters_per_sqrt_Hz=psd_units)
-        plt.plot(f, cal, label=string)
+        common.plot_downsampled(f, cal, label=string)
 
     plt.xlabel('FFT frequency (Hz)')
     plt.yscale('log')
@@ -306,7 +303,7 @@ def subtract_traces(dfs, gains, freqlim, Qs=1.54, f0s=4.552, Z12s=31.58, leg=Non
         else:
             f, cal = get_geophone_spectrum(df, G, freqlim=freqlim, Q=Q, f0=f0, Z12=Z12, do_imshow=False,
                                            do_plot=False, ret=True, name=leg[i], do_meters_per_sqrt_Hz=psd_units)
-            plt.plot(f, cal-cal0, label=string)
+            common.plot_downsampled(f, cal-cal0, label=string)
 
     plt.xlabel('FFT frequency (Hz)')
     plt.yscale('log')
@@ -13,9 +13,15 @@ fitting procedure.
 import numpy as np
 import math as math
 import matplotlib.pyplot as plt
-import scipy, sys, cmath
+import scipy, sys, cmath, itertools, os, time, hashlib, sqlite3, atexit
 import scipy.fftpack
-from scipy import optimize
+import scipy.signal
+from scipy import optimize, linalg
+try:
+    from concurrent import futures
+except ImportError:
+    # Python 2 without the futures backport: the parallel functions run in a single process
+    futures = None
 from tabulate import tabulate
 from . import common
 
@@ -66,17 +72,393 @@ def plot_fitresult(xdata, ydata, bestfitparams, fitparam_errors, fitparam_names=
     plt.legend(loc=0, frameon=False, prop={'size': 8}, title="Fit result")
     plt.ylim(ylims)
 
+def _hash_code(h, code):
+    """
+    Feeds the byte code and constants of a code object into the hash h, including nested code objects, e.g. of
+    comprehensions, whose repr contains a memory address.
+    """
+    h.update(code.co_code)
+    for const in code.co_consts:
+        if hasattr(const, 'co_code'):
+            _hash_code(h, const)
+        else:
+            h.update(repr(const).encode())
+
+
+def _hash_function(h, func, seen):
+    """
+    Feeds the code and default arguments of func into the hash h, and the code of every function in the same namespace
+    that func calls, such that a change to a helper (e.g. _s11_complex for s11_mag_func) also changes the hash.
+    """
+    code = getattr(func, '__code__', None)
+    if code is None or func in seen:
+        return
+    seen.add(func)
+    _hash_code(h, code)
+    defaults = getattr(func, '__defaults__', None)
+    if defaults:
+        _hash_update(h, defaults)
+    namespace = getattr(func, '__globals__', {})
+    for name in code.co_names:
+        dependency = namespace.get(name)
+        if hasattr(dependency, '__code__'):
+            _hash_function(h, dependency, seen)
+
+
+def _is_cacheable(func):
+    """
+    Lambdas and nested functions can't be identified by their name, and the values captured by a closure are not part
+    of its byte code, so fit results of these are never cached. Python 2 has no __qualname__, so closures are also
+    recognized by their cells.
+    """
+    name = getattr(func, '__qualname__', getattr(func, '__name__', '<'))
+    closure = getattr(func, '__closure__', None) or getattr(func, 'func_closure', None)
+    return '<' not in name and not closure
+
+
+def _hash_update(h, obj):
+    """
+    Feeds obj into the hash h. Arrays are hashed by their contents, functions by their name and byte code, including
+    the byte code of the module level functions they call.
+    """
+    if isinstance(obj, np.ndarray) or (isinstance(obj, (list, tuple)) and len(obj) and
+                                       all(isinstance(o, (int, float, np.number)) for o in obj)):
+        arr = np.ascontiguousarray(obj)
+        h.update(str((arr.dtype.str, arr.shape)).encode())
+        h.update(arr.tobytes())
+    elif isinstance(obj, (list, tuple)):
+        h.update(b'(')
+        for o in obj:
+            _hash_update(h, o)
+        h.update(b')')
+    elif isinstance(obj, dict):
+        for key in sorted(obj.keys()):
+            h.update(str(key).encode())
+            _hash_update(h, obj[key])
+    elif callable(obj):
+        name = getattr(obj, '__qualname__', getattr(obj, '__name__', repr(obj)))
+        h.update(getattr(obj, '__module__', '').encode() + b'.' + name.encode())
+        _hash_function(h, obj, set())
+    else:
+        h.update(repr(obj).encode())
+
+
+class FitCache(object):
+    """
+    On-disk cache for fit results, stored in a SQLite database. Results are keyed on a hash of the x and y data, the
+    fit function (name, byte code and default arguments, including the helpers it calls), the initial guess, the
+    bounds and the keyword arguments of the fit, together with FitCache.version and the scipy version. When the cache
+    grows beyond max_entries, the least recently used results are removed. Fits with lambdas, nested functions or
+    closures are not cached.
+    The time of last access of cache hits is written to the database in batches of flush_every hits, or by flush.
+    Enable the cache for fitbetter, and thereby for all fit_* wrappers that use it, with enable_fit_cache.
+    """
+    # Increase to invalidate all stored results, e.g. when a change in kfit changes the results of existing fits
+    version = 1
+
+    def __init__(self, filename='kfit_cache.sqlite', max_entries=100000, flush_every=100):
+        """
+        :param filename: Filename of the SQLite database. It is created if it does not exist.
+        :param max_entries: Maximum number of fit results that are stored.
+        :param flush_every: Number of cache hits after which the times of last access are written to the database.
+        """
+        self.filename = filename
+        self.max_entries = max_entries
+        self.flush_every = flush_every
+        self.hits = 0
+        self.misses = 0
+        self._connection = None
+        self._pid = None
+        self._count = 0
+        self._accessed = dict()
+
+    def _connect(self):
+        # A connection can't be shared with forked processes (e.g. fitbetter_parallel), so reconnect in a new process
+        if self._connection is None or self._pid != os.getpid():
+            self._connection = sqlite3.connect(self.filename, timeout=30.)
+            self._pid = os.getpid()
+            self._accessed = dict()
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS fits "
+                                     "(key TEXT PRIMARY KEY, params BLOB, errors BLOB, last_access REAL)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS fits_last_access ON fits (last_access)")
+            self._connection.commit()
+            # The number of rows is tracked in memory from now on
+            self._count = self._connection.execute("SELECT COUNT(*) FROM fits").fetchone()[0]
+        return self._connection
+
+    def __len__(self):
+        return self._connect().execute("SELECT COUNT(*) FROM fits").fetchone()[0]
+
+    def __repr__(self):
+        return "FitCache(%s, %d hits, %d misses)" % (self.filename, self.hits, self.misses)
+
+    @staticmethod
+    def key(*args):
+        """
+        Hash of all arguments that determine a fit result.
+        :return: Hexadecimal sha1 digest
+        """
+        h = hashlib.sha1()
+        h.update(("%d %s" % (FitCache.version, scipy.__version__)).encode())
+        for arg in args:
+            _hash_update(h, arg)
+        return h.hexdigest()
+
+    def get(self, key):
+        """
+        Look up a fit result.
+        :param key: Key from FitCache.key
+        :return: (bestfitparams, fitparam_errors) or None if the result is not in the cache
+        """
+        connection = self._connect()
+        row = connection.execute("SELECT params, errors FROM fits WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._accessed[key] = time.time()
+        if len(self._accessed) >= self.flush_every:
+            self.flush()
+        return np.frombuffer(row[0], dtype=np.float64).copy(), np.frombuffer(row[1], dtype=np.float64).copy()
+
+    def flush(self):
+        """
+        Write the times of last access of the cache hits to the database.
+        """
+        if self._accessed and self._pid == os.getpid():
+            self._connection.executemany("UPDATE fits SET last_access = ? WHERE key = ?",
+                                         [(t, key) for key, t in self._accessed.items()])
+            self._connection.commit()
+        self._accessed = dict()
+
+    def put(self, key, bestfitparams, fitparam_errors):
+        """
+        Store a fit result and remove the least recently used results if the cache is full. To limit the number of
+        deletes, the cache is trimmed to 90% of max_entries at once.
+        :param key: Key from FitCache.key
+        :param bestfitparams: Fit parameters
+        :param fitparam_errors: Errors of the fit parameters
+        """
+        connection = self._connect()
+        self._accessed.pop(key, None)
+        row = (sqlite3.Binary(np.asarray(bestfitparams, dtype=np.float64).tobytes()),
+               sqlite3.Binary(np.asarray(fitparam_errors, dtype=np.float64).tobytes()), time.time(), key)
+        cursor = connection.execute("UPDATE fits SET params = ?, errors = ?, last_access = ? WHERE key = ?", row)
+        if cursor.rowcount == 0:
+            connection.execute("INSERT INTO fits (params, errors, last_access, key) VALUES (?, ?, ?, ?)", row)
+            self._count += 1
+        if self._count > self.max_entries:
+            # Other processes may have added rows as well
+            self.flush()
+            self._count = len(self)
+            excess = self._count - int(0.9 * self.max_entries)
+            if excess > 0:
+                cursor = connection.execute("DELETE FROM fits WHERE key IN "
+                                            "(SELECT key FROM fits ORDER BY last_access ASC LIMIT ?)", (excess,))
+                self._count -= cursor.rowcount
+        connection.commit()
+
+    def clear(self):
+        """
+        Remove all fit results from the cache.
+        """
+        connection = self._connect()
+        connection.execute("DELETE FROM fits")
+        connection.commit()
+        self._count = 0
+        self._accessed = dict()
+
+
+_fit_cache = None
+
+
+def enable_fit_cache(filename='kfit_cache.sqlite', max_entries=100000):
+    """
+    Enable the on-disk fit result cache. From now on, fitbetter returns the stored result for a fit that was done
+    before with exactly the same data, fit function, initial guess, bounds and options, instead of fitting again.
+    :param filename: Filename of the SQLite database
+    :param max_entries: Maximum number of fit results that are stored
+    :return: FitCache instance
+    """
+    global _fit_cache
+    if _fit_cache is not None:
+        _fit_cache.flush()
+    _fit_cache = FitCache(filename=filename, max_entries=max_entries)
+    # Write the times of last access that are still pending when Python exits
+    atexit.register(_fit_cache.flush)
+    return _fit_cache
+
+
+def disable_fit_cache():
+    """
+    Disable the fit result cache. The database file is not removed.
+    """
+    global _fit_cache
+    if _fit_cache is not None:
+        _fit_cache.flush()
+    _fit_cache = None
+
+
+def _decode_parname(name):
+    # Parameter names are stored as UTF-8 bytes by FitResults.save
+    return name.decode('utf-8') if isinstance(name, bytes) else name
+
+
+class FitResults(object):
+    """
+    Compact container for the results of many fits, backed by a NumPy structured array with one row per fit. The
+    fields are trace_id, params, errors, rsquare, nfev, status and walltime. Unknown values are nan (or -1 for nfev).
+    The array is preallocated and grows automatically when rows are appended. Use save and FitResults.load to store
+    the results in a .npz or .h5 file.
+    Example:
+        results = FitResults(4, parnames=['Offset', 'Amplitude', 'f0', 'HWHM'])
+        results.append(params, errors, trace_id=0, walltime=0.01)
+        results['params'][:, 2]  # all center frequencies
+    """
+    OK = 0
+    FAILED = 1
+
+    def __init__(self, nparams, size=1024, parnames=None):
+        """
+        :param nparams: Number of fit parameters
+        :param size: Number of rows that is preallocated
+        :param parnames: List of parameter names
+        """
+        self.nparams = nparams
+        self.parnames = parnames if parnames is not None else ["par%d" % k for k in range(nparams)]
+        self.dtype = np.dtype([('trace_id', np.int64), ('params', np.float64, (nparams,)),
+                               ('errors', np.float64, (nparams,)), ('rsquare', np.float64), ('nfev', np.int32),
+                               ('status', np.int8), ('walltime', np.float64)])
+        self._data = np.zeros(max(size, 1), dtype=self.dtype)
+        self._n = 0
+
+    def __len__(self):
+        return self._n
+
+    def __repr__(self):
+        return "FitResults(%d fits, %d parameters)" % (self._n, self.nparams)
+
+    def __getitem__(self, item):
+        return self.data[item]
+
+    @property
+    def data(self):
+        """
+        Structured array with the rows that have been filled.
+        """
+        return self._data[:self._n]
+
+    def _reserve(self, n):
+        # Double the capacity, such that appending is O(1) on average
+        if self._n + n > len(self._data):
+            new_data = np.zeros(max(2 * len(self._data), self._n + n), dtype=self.dtype)
+            new_data[:self._n] = self._data[:self._n]
+            self._data = new_data
+
+    def append(self, params, errors, trace_id=None, rsquare=np.nan, nfev=-1, status=OK, walltime=np.nan):
+        """
+        Add the result of a single fit. If the fit failed, params and errors may be None, these are then set to nan.
+        :param params: Fit parameters
+        :param errors: Errors of the fit parameters
+        :param trace_id: Identifier of the trace. Default is the index of the row.
+        :param rsquare: R squared of the fit, see get_rsquare
+        :param nfev: Number of function evaluations
+        :param status: FitResults.OK or FitResults.FAILED
+        :param walltime: Time that the fit took in s
+        """
+        self._reserve(1)
+        row = self._data[self._n]
+        row['trace_id'] = self._n if trace_id is None else trace_id
+        row['params'] = np.nan if params is None else params
+        row['errors'] = np.nan if errors is None else errors
+        row['rsquare'] = rsquare
+        row['nfev'] = nfev
+        row['status'] = status
+        row['walltime'] = walltime
+        self._n += 1
+
+    def extend(self, params, errors, trace_id=None, rsquare=np.nan, nfev=-1, status=None, walltime=np.nan):
+        """
+        Add the results of many fits at once, e.g. the output of fit_tracking or fit_lor_batch.
+        :param params: Array of shape (M, nparams)
+        :param errors: Array of shape (M, nparams)
+        :param trace_id: Array of length M. Default is the index of the rows.
+        :param rsquare: Scalar or array of length M
+        :param nfev: Scalar or array of length M
+        :param status: Scalar or array of length M. Default is FitResults.FAILED for rows with nan parameters and
+                       FitResults.OK otherwise.
+        :param walltime: Scalar or array of length M
+        """
+        params = np.reshape(params, (-1, self.nparams))
+        n = len(params)
+        self._reserve(n)
+        rows = self._data[self._n:self._n + n]
+        rows['trace_id'] = np.arange(self._n, self._n + n) if trace_id is None else trace_id
+        rows['params'] = params
+        rows['errors'] = np.reshape(errors, (-1, self.nparams))
+        rows['rsquare'] = rsquare
+        rows['nfev'] = nfev
+        if status is None:
+            status = np.where(np.all(np.isfinite(params), axis=1), self.OK, self.FAILED)
+        rows['status'] = status
+        rows['walltime'] = walltime
+        self._n += n
+
+    def save(self, filename):
+        """
+        Save the results to a .npz file, or to a HDF5 file if the filename ends with .h5 or .hdf5.
+        :param filename: Filename
+        """
+        # Stored as UTF-8 bytes, since the registered parameter names contain greek letters (see register_model)
+        parnames = np.array([name.encode('utf-8') for name in self.parnames])
+        if filename.endswith('.h5') or filename.endswith('.hdf5'):
+            import h5py
+            with h5py.File(filename, 'w') as f:
+                f.create_dataset('fits', data=self.data, compression='gzip')
+                f['fits'].attrs['parnames'] = parnames
+        else:
+            np.savez(filename, fits=self.data, parnames=parnames)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Load results that were stored with FitResults.save.
+        :param filename: Filename
+        :return: FitResults instance
+        """
+        if filename.endswith('.h5') or filename.endswith('.hdf5'):
+            import h5py
+            with h5py.File(filename, 'r') as f:
+                data = f['fits'][()]
+                parnames = [_decode_parname(name) for name in f['fits'].attrs['parnames']]
+        else:
+            with np.load(filename) as f:
+                data = f['fits']
+                parnames = [_decode_parname(name) for name in f['parnames']]
+
+        results = cls(data.dtype['params'].shape[0], size=len(data), parnames=parnames)
+        results._data[:len(data)] = data
+        results._n = len(data)
+        return results
+
+
 def fitbetter(xdata, ydata, fitfunc, fitparams, parambounds=None, domain=None, showfit=False, showstartfit=False,
-              showdata=True, mark_data='ko', mark_fit='r-', **kwargs):
+              showdata=True, mark_data='ko', mark_fit='r-', info=None, **kwargs):
     """
     Uses curve_fit from scipy.optimize to fit a non-linear least squares function to ydata, xdata
     Note: when applying bounds the fit method used is a different one than with an unconstrained fit. It's good
     practice to not apply bounds to parameters if it's not needed.
+    Results are taken from the on-disk cache if it is enabled, see enable_fit_cache.
     :param xdata: x-axis
     :param ydata: y-axis
-    :param fitfunc: One of the fitfunctions below
+    :param fitfunc: One of the fitfunctions below. If the fitfunction is registered in fit_models (see get_model), its
+                    analytic Jacobian is passed to curve_fit, unless jac is specified in kwargs.
     :param fitparams: Parameters for the fitfunction
     :param parambounds: Tuple of bounds for each of the parameters: ([par1_min, par2_min, ...], [par1_max, par2_max, ...])
+                        Default are the bounds of the registered model, or no bounds.
     :param domain: Domain for the xdata
     :param showfit: Show the fit
     :param showstartfit: Show the curve with initial guesses
@@ -84,6 +466,8 @@ def fitbetter(xdata, ydata, fitfunc, fitparams, parambounds=None, domain=None, s
     :param label: Label for the data
     :param mark_data: Marker format for the data
     :param mark_fit: Marker format for the fit
+    :param info: Optional dictionary, which is filled with the rsquare of the fit and the number of function
+                 evaluations nfev (0 if the result was taken from the cache). The fit_* wrappers pass it on to fitbetter.
     :return:
     """
     if domain is not None:
@@ -92,6 +476,14 @@ def fitbetter(xdata, ydata, fitfunc, fitparams, parambounds=None, domain=None, s
         fitdatax = xdata
         fitdatay = ydata
 
+    model = get_model(fitfunc)
+    if model is not None:
+        fitfunc = model.func
+        if parambounds is None:
+            parambounds = model.bounds
+        if 'jac' not in kwargs and model.jac is not None:
+            kwargs['jac'] = model.jac
+
     if parambounds is None:
         parambounds = (-np.inf, +np.inf)
 
@@ -102,14 +494,42 @@ def fitbetter(xdata, ydata, fitfunc, fitparams, parambounds=None, domain=None, s
     #   Default is of course (-np.inf, np.inf)
 
     startparams = fitparams
-    bestfitparams, covmatrix = optimize.curve_fit(fitfunc, fitdatax, fitdatay, startparams, bounds=parambounds, **kwargs)
 
-    try:
-        fitparam_errors = np.sqrt(np.diag(covmatrix))
-    except:
-        print(covmatrix)
-        print(
-            "Error encountered in calculating errors on fit parameters. This may result from a very flat parameter space")
+    cache_key = None
+    if _fit_cache is not None and _is_cacheable(fitfunc):
+        cache_key = FitCache.key(np.asarray(fitdatax, dtype=np.float64), np.asarray(fitdatay, dtype=np.float64),
+                                 fitfunc, np.asarray(startparams, dtype=np.float64), parambounds, kwargs)
+        cached = _fit_cache.get(cache_key)
+    else:
+        cached = None
+
+    nfev = [0]
+    if info is not None:
+        def counted_fitfunc(x, *p):
+            nfev[0] += 1
+            return fitfunc(x, *p)
+    else:
+        counted_fitfunc = fitfunc
+
+    if cached is not None:
+        bestfitparams, fitparam_errors = cached
+    else:
+        bestfitparams, covmatrix = optimize.curve_fit(counted_fitfunc, fitdatax, fitdatay, startparams,
+                                                      bounds=parambounds, **kwargs)
+
+        try:
+            fitparam_errors = np.sqrt(np.diag(covmatrix))
+        except:
+            print(covmatrix)
+            print(
+                "Error encountered in calculating errors on fit parameters. This may result from a very flat parameter space")
+
+        if cache_key is not None:
+            _fit_cache.put(cache_key, bestfitparams, fitparam_errors)
+
+    if info is not None:
+        info['nfev'] = nfev[0]
+        info['rsquare'] = get_rsquare(np.asarray(fitdatay), fitfunc(np.asarray(fitdatax), *bestfitparams))
 
     if showfit:
         if showdata:
@@ -121,6 +541,114 @@ def fitbetter(xdata, ydata, fitfunc, fitparams, parambounds=None, domain=None, s
     return bestfitparams, fitparam_errors
 
 
+def _fitbetter_job(job, kwargs):
+    """
+    Runs a single fitbetter job for fitbetter_parallel. Exceptions are returned instead of raised, such that one
+    failing fit does not abort the whole batch.
+    :param job: Tuple (xdata, ydata, fitfunc, fitparams) or (xdata, ydata, fitfunc, fitparams, domain)
+    :param kwargs: Dictionary with keyword arguments for fitbetter
+    :return: (bestfitparams, fitparam_errors) or the exception that was raised
+    """
+    xdata, ydata, fitfunc, fitparams = job[:4]
+    domain = job[4] if len(job) > 4 else None
+    try:
+        return fitbetter(xdata, ydata, fitfunc, fitparams, domain=domain, **kwargs)
+    except Exception as e:
+        return e
+
+
+def fitbetter_parallel(jobs, max_workers=None, chunksize=1, **kwargs):
+    """
+    Runs fitbetter for many independent data sets on a pool of processes. The results are returned in the same order
+    as the jobs. A fit that fails does not stop the batch: its entry in the output is the exception that was raised,
+    which can be checked with isinstance(result, Exception).
+    Notes: fitfunc must be a module level function (e.g. one of the fit functions in this module) such that it can be
+    sent to the worker processes. On Windows the calling script needs an if __name__ == '__main__' guard.
+    Plotting (showfit=True) is not possible from the worker processes.
+    :param jobs: Iterable of tuples (xdata, ydata, fitfunc, fitparams) or (xdata, ydata, fitfunc, fitparams, domain)
+    :param max_workers: Number of processes. Default is the number of processors on the machine. If max_workers=1 the
+                        jobs are run in the current process, which is useful for debugging. This is also the case
+                        under Python 2 if the futures backport is not installed.
+    :param chunksize: Number of jobs that are sent to a worker process at once. For many small fits a chunksize of
+                      10-100 reduces the communication overhead considerably.
+    :param kwargs: Keyword arguments for fitbetter, e.g. parambounds or maxfev. They are the same for all jobs.
+    :return: List with (bestfitparams, fitparam_errors) or an exception for each job.
+    """
+    if max_workers == 1 or futures is None:
+        return [_fitbetter_job(job, kwargs) for job in jobs]
+
+    with futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(_fitbetter_job, jobs, itertools.repeat(kwargs), chunksize=chunksize))
+
+
+def fitlinear(xdata, ydata, fitfunc, nparams, domain=None, showfit=False, showdata=True, mark_data='ko',
+              mark_fit='r-', full_output=False):
+    """
+    Least squares fit of a function that is linear in its parameters, e.g. polyfunc, polyfunc_even or polyfunc_odd.
+    Instead of iterating with curve_fit, the problem is solved directly with a QR decomposition of the design matrix.
+    The design matrix is the Jacobian of the registered model (see get_model), whose columns are scaled to unit norm
+    for numerical stability. The errors are calculated in the same way as curve_fit does, i.e. from the covariance
+    matrix scaled with the reduced chi squared.
+    If ydata is 2D, the same function is fitted to every row of ydata with a single decomposition.
+    :param xdata: x-axis
+    :param ydata: y-axis; 1D array or 2D array of shape (M, N) with one trace per row
+    :param fitfunc: Fit function that is linear in its parameters and is registered with an analytic Jacobian.
+    :param nparams: Number of fit parameters
+    :param domain: Domain for the xdata
+    :param showfit: Show the fit (1D ydata only)
+    :param showdata: Plot the data.
+    :param mark_data: Marker format for the data
+    :param mark_fit: Marker format for the fit
+    :param full_output: True/False. Also return the covariance matrix, of shape (M, nparams, nparams) if ydata is 2D.
+    :return: bestfitparams, fitparam_errors. Arrays of shape (M, nparams) if ydata is 2D.
+    """
+    ydata = np.asarray(ydata)
+    if domain is not None:
+        ind = argselectdomain(xdata, domain)
+        fitdatax = xdata[ind[0]:ind[1]]
+        fitdatay = ydata[..., ind[0]:ind[1]]
+    else:
+        fitdatax = xdata
+        fitdatay = ydata
+
+    model = get_model(fitfunc)
+    if model is None or model.jac is None:
+        raise ValueError("fitfunc should be registered with an analytic Jacobian to be used in fitlinear.")
+
+    # For a linear model the Jacobian does not depend on the parameters and is the design matrix
+    A = model.jac(np.asarray(fitdatax, dtype=np.float64), *np.zeros(nparams))
+    scale = np.sqrt(np.sum(A ** 2, axis=0))
+    scale[scale == 0] = 1.
+    Q, R = np.linalg.qr(A / scale)
+
+    Y = np.transpose(np.atleast_2d(fitdatay))
+    bestfitparams = linalg.solve_triangular(R, np.dot(Q.T, Y)) / scale[:, np.newaxis]
+
+    # Covariance (A^T A)^-1 = (R^T R)^-1 in the scaled parameters
+    Rinv = linalg.solve_triangular(R, np.eye(nparams))
+    cov_scaled = np.dot(Rinv, Rinv.T) / np.outer(scale, scale)
+    dof = max(len(fitdatax) - nparams, 1)
+    residual_sum_of_squares = np.sum((Y - np.dot(A, bestfitparams)) ** 2, axis=0)
+    fitparam_errors = np.sqrt(np.outer(residual_sum_of_squares / dof, np.diag(cov_scaled)))
+    covmatrix = (residual_sum_of_squares / dof)[:, np.newaxis, np.newaxis] * cov_scaled
+
+    bestfitparams = np.transpose(bestfitparams)
+    if np.ndim(fitdatay) == 1:
+        bestfitparams = bestfitparams[0]
+        fitparam_errors = fitparam_errors[0]
+        covmatrix = covmatrix[0]
+
+        if showfit:
+            if showdata:
+                plt.plot(fitdatax, fitdatay, mark_data, label="data")
+            plt.plot(fitdatax, fitfunc(fitdatax, *bestfitparams), mark_fit, label="fit")
+
+    if full_output:
+        return bestfitparams, fitparam_errors, covmatrix
+
+    return bestfitparams, fitparam_errors
+
+
 #######################################################################
 #######################################################################
 #################### WRAPPERS FOR FITFUNCTIONS ########################
@@ -148,35 +676,15 @@ def fit_lor(xdata, ydata, fitparams=None, no_offset=False, domain=None, showfit=
         fitdatax = xdata
         fitdatay = ydata
     if fitparams is None:
-        fitparams = [0, 0, 0, 0]
-        fitparams[0] = (fitdatay[0] + fitdatay[-1]) / 2.
-        fitparams[1] = max(fitdatay) - min(fitdatay)
-        fitparams[2] = fitdatax[np.argmax(fitdatay)]
-        fitparams[3] = (max(fitdatax) - min(fitdatax)) / 10.
+        fitparams = get_model(lorfunc).guess(fitdatax, fitdatay)
 
         if no_offset:
             fitparams.pop(0)
     elif len(fitparams) == 4 and no_offset:
         raise ValueError("no_offset is True, fitparams should be a list of length 3.")
 
-    def lorfunc_jac(x, *p):
-        if no_offset:
-            amp, f0, hwhm = p
-        else:
-            offset, amp, f0, hwhm = p
-
-        df_damp = 1 / (1 + (x-f0)**2 / hwhm**2)
-        df_df0 = 2 * amp * (x-f0) / (hwhm**2 * (1 + (x-f0)**2/hwhm**2)**2)
-        df_dhwhm = 2 * amp * (x-f0)**2 / (hwhm**3 * (1 + (x-f0)**2/hwhm**2)**2)
-
-        if no_offset:
-            return np.transpose(np.vstack([df_damp, df_df0, df_dhwhm]))
-        else:
-            df_doffset = np.ones(len(x))
-            return np.transpose(np.vstack([df_doffset, df_damp, df_df0, df_dhwhm]))
-
     params, param_errs = fitbetter(fitdatax, fitdatay, lorfunc, fitparams, domain=None, showfit=showfit,
-                                   showstartfit=showstartfit, jac=lorfunc_jac, **kwarg)
+                                   showstartfit=showstartfit, **kwarg)
 
     if verbose:
         parnames = ['Offset', 'Amplitude', 'f0', 'HWHM']
@@ -191,6 +699,288 @@ def fit_lor(xdata, ydata, fitparams=None, no_offset=False, domain=None, showfit=
     return params, param_errs
 
 
+def fit_lor_batch(xdata, ydata, fitparams=None, no_offset=False, domain=None, maxiter=200, ftol=1.49012E-8,
+                  xtol=1.49012E-8, full_output=False):
+    """
+    Fit a Lorentzian to every row of ydata at once. Instead of calling curve_fit for each trace, all traces are
+    fitted simultaneously with a vectorized Levenberg-Marquardt loop using the analytic Jacobian lorfunc_jac.
+    Rows that have converged are dropped from the loop. Errors are computed from the covariance matrix in the same
+    way as curve_fit does, i.e. scaled with the reduced chi squared. Rows with non-finite data get nan parameters and
+    errors, and rows whose parameters are undetermined (e.g. a flat trace) get infinite errors. Both, as well as rows
+    for which no downhill step can be found, are reported as not converged.
+    :param xdata: Frequency; 1D array shared by all traces, or 2D array of shape (M, N) with one axis per trace
+    :param ydata: Power in W; 2D array of shape (M, N), one trace per row
+    :param fitparams: [offset,amplitude,center,hwhm], either shared by all traces or an (M, 4) array. If None the initial
+                      guesses are determined for each row in the same way as in fit_lor.
+    :param no_offset: True/False. Fit without an offset, fitparams should then have 3 columns.
+    :param domain: Tuple (shared domain) or (M, 2) array with a domain for each row.
+    :param maxiter: Maximum number of Levenberg-Marquardt iterations.
+    :param ftol: Relative tolerance in the sum of squares for convergence.
+    :param xtol: Relative tolerance in the parameters for convergence.
+    :param full_output: True/False. Also return a dictionary with the number of function evaluations, the convergence
+                        status and the r-squared value of each fit.
+    :return: Fitresult (M, 4), Fiterror (M, 4) [, info]
+    """
+    ydata = np.atleast_2d(np.asarray(ydata, dtype=np.float64))
+    M, N = np.shape(ydata)
+    xdata = np.atleast_2d(np.asarray(xdata, dtype=np.float64))
+    shared_x = np.shape(xdata)[0] == 1
+    x_all = np.broadcast_to(xdata, (M, N))
+    rows = np.arange(M)
+    nparams = 3 if no_offset else 4
+
+    # The domain is implemented as a mask, which works for shared and per-row x-axes alike
+    if domain is None:
+        mask = np.ones((M, N), dtype=bool)
+    else:
+        domain = np.asarray(domain, dtype=np.float64)
+        if domain.ndim == 1:
+            mask = np.logical_and(x_all >= domain[0], x_all < domain[1])
+        else:
+            mask = np.logical_and(x_all >= domain[:, 0:1], x_all < domain[:, 1:2])
+    weights = mask.astype(np.float64)
+    npts = np.sum(mask, axis=1)
+    masked = not np.all(mask)
+
+    if fitparams is None:
+        first = np.argmax(mask, axis=1)
+        last = N - 1 - np.argmax(mask[:, ::-1], axis=1)
+        ymax = np.max(np.where(mask, ydata, -np.inf), axis=1)
+        ymin = np.min(np.where(mask, ydata, np.inf), axis=1)
+        xmax = np.max(np.where(mask, x_all, -np.inf), axis=1)
+        xmin = np.min(np.where(mask, x_all, np.inf), axis=1)
+
+        peak_idx = np.argmax(np.where(mask, ydata, -np.inf), axis=1)
+        f0, fwhm, Q = common.find_fwhm(x_all, np.where(mask, ydata, ymin[:, np.newaxis]), start_idx=peak_idx, dB=False)
+
+        p = np.zeros((M, 4))
+        p[:, 0] = (ydata[rows, first] + ydata[rows, last]) / 2.
+        p[:, 1] = ymax - ymin
+        p[:, 2] = f0
+        p[:, 3] = np.where(np.isfinite(fwhm) & (fwhm > 0), fwhm / 2., (xmax - xmin) / 10.)
+
+        if no_offset:
+            p = p[:, 1:]
+    else:
+        fitparams = np.asarray(fitparams, dtype=np.float64)
+        if np.shape(fitparams)[-1] != nparams:
+            raise ValueError("fitparams should have %d columns for no_offset=%s." % (nparams, no_offset))
+        p = np.array(np.broadcast_to(fitparams, (M, nparams)))
+
+    def residuals(idx, params):
+        x = xdata if shared_x else xdata[idx]
+        res = ydata[idx] - lorfunc(x, *params.T[:, :, np.newaxis])
+        if masked:
+            res *= weights[idx]
+        return res
+
+    def jacobian(idx, params):
+        # Returns the Jacobian with shape (rows, parameters, points), which is contiguous in memory
+        x = xdata if shared_x else xdata[idx]
+        jac = np.moveaxis(lorfunc_jac(x, *params.T[:, :, np.newaxis]), -1, -2)
+        if masked:
+            jac *= weights[idx][:, np.newaxis, :]
+        return jac
+
+    res = residuals(rows, p)
+    cost = np.sum(res ** 2, axis=1)
+    lam = 1E-3 * np.ones(M)
+    nfev = np.ones(M, dtype=np.int64)
+    converged = np.zeros(M, dtype=bool)
+    active = np.isfinite(cost)
+    diag_idx = np.arange(nparams)
+
+    for iteration in range(maxiter):
+        idx = np.flatnonzero(active)
+        if len(idx) == 0:
+            break
+
+        # Work with column-scaled Jacobians: the parameters easily span 18 orders of magnitude (f0 vs. amplitude)
+        J = jacobian(idx, p[idx])
+        JTJ = np.matmul(J, np.transpose(J, (0, 2, 1)))
+        scale = np.sqrt(JTJ[:, diag_idx, diag_idx])
+        scale[scale == 0] = 1.
+        grad = np.matmul(J, res[idx][:, :, np.newaxis])[:, :, 0] / scale
+
+        # Marquardt's damping term proportional to the diagonal of J^T J, which is the identity after scaling
+        A = JTJ / (scale[:, :, np.newaxis] * scale[:, np.newaxis, :])
+        A[:, diag_idx, diag_idx] += lam[idx, np.newaxis]
+        try:
+            step = np.linalg.solve(A, grad[:, :, np.newaxis])[:, :, 0] / scale
+        except np.linalg.LinAlgError:
+            step = np.matmul(np.linalg.pinv(A), grad[:, :, np.newaxis])[:, :, 0] / scale
+
+        p_new = p[idx] + step
+        res_new = residuals(idx, p_new)
+        cost_new = np.sum(res_new ** 2, axis=1)
+        nfev[idx] += 1
+
+        improved = cost_new < cost[idx]
+        better = idx[improved]
+        small_dcost = (cost[better] - cost_new[improved]) <= ftol * cost[better]
+        small_step = np.all(np.abs(step[improved]) <= xtol * (np.abs(p_new[improved]) + xtol), axis=1)
+
+        p[better] = p_new[improved]
+        res[better] = res_new[improved]
+        cost[better] = cost_new[improved]
+        lam[better] /= 10.
+        lam[idx[~improved]] *= 10.
+
+        done = better[np.logical_or(small_dcost, small_step)]
+        converged[done] = True
+        active[done] = False
+        # Stop rows for which no downhill step can be found anymore. These have not converged.
+        stalled = idx[~improved][lam[idx[~improved]] > 1E10]
+        active[stalled] = False
+
+    # Rows with non-finite data (e.g. a single nan) never entered the loop, their parameters are nan
+    finite = np.logical_and(np.isfinite(cost), np.all(np.isfinite(p), axis=1))
+    p[~finite] = np.nan
+    converged[~finite] = False
+    param_errs = np.full((M, nparams), np.nan)
+
+    # Covariance matrix, scaled with the reduced chi squared like curve_fit with absolute_sigma=False
+    idx = np.flatnonzero(finite)
+    if len(idx):
+        J = jacobian(idx, p[idx])
+        JTJ = np.matmul(J, np.transpose(J, (0, 2, 1)))
+        scale = np.sqrt(JTJ[:, diag_idx, diag_idx])
+        scale[scale == 0] = 1.
+        scale2 = scale[:, :, np.newaxis] * scale[:, np.newaxis, :]
+        U, s, Vt = np.linalg.svd(JTJ / scale2)
+        # A singular J^T J (e.g. a flat trace) leaves parameters undetermined: infinite errors, like curve_fit
+        singular = s[:, -1] <= np.finfo(np.float64).eps * nparams * s[:, 0]
+        s[singular] = 1.
+        covmatrix = np.matmul(np.transpose(Vt, (0, 2, 1)) / s[:, np.newaxis, :], np.transpose(U, (0, 2, 1))) / scale2
+        dof = npts[idx] - nparams
+        covmatrix *= np.where(dof > 0, cost[idx] / np.maximum(dof, 1), np.nan)[:, np.newaxis, np.newaxis]
+        param_errs[idx] = np.sqrt(np.abs(covmatrix[:, diag_idx, diag_idx]))
+        param_errs[idx[singular]] = np.inf
+        converged[idx[singular]] = False
+
+    if full_output:
+        ybar = np.sum(weights * ydata, axis=1) / npts
+        total_sum_of_squares = np.sum(weights * (ydata - ybar[:, np.newaxis]) ** 2, axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rsquare = 1 - cost / total_sum_of_squares
+        info = {'nfev': nfev, 'converged': converged, 'rsquare': rsquare}
+        return p, param_errs, info
+
+    return p, param_errs
+
+
+def _tracking_fit(fitfunction, x, y, fitparams, ctr, fitspan, center_idx, max_shift, info, min_rsquare=None,
+                  **kwarg):
+    """
+    Single fit for fit_tracking. Returns None if the fit raised an exception or diverged, which includes an rsquare
+    below min_rsquare, e.g. a fit to noise when the resonance has left the fit window.
+    """
+    domain = None if fitspan is None else [ctr - fitspan / 2., ctr + fitspan / 2.]
+    try:
+        params, param_errs = fitfunction(x, y, fitparams=fitparams, domain=domain, verbose=False, info=info, **kwarg)
+    except Exception:
+        return None
+
+    params = np.asarray(params, dtype=np.float64)
+    param_errs = np.asarray(param_errs, dtype=np.float64)
+    if not (np.all(np.isfinite(params)) and np.all(np.isfinite(param_errs))):
+        return None
+    if max_shift is not None and (abs(params[center_idx] - ctr) > max_shift or param_errs[center_idx] > max_shift):
+        return None
+    if min_rsquare is not None and not info.get('rsquare', np.nan) >= min_rsquare:
+        return None
+
+    return params, param_errs
+
+
+def fit_tracking(xdata, ydata, fitfunction=fit_lor, center_idx=2, fitspan=None, fitparams=None, seed=None,
+                 max_shift=None, min_rsquare_ratio=0.5, peak='max', verbose=False, info=None, **kwarg):
+    """
+    Fit a sequence of traces in which the resonance moves only a little from one trace to the next. Each fit is
+    seeded with the converged parameters of the previous trace and the fit window is centered on the previous center
+    frequency (warm start). This takes far fewer iterations than starting every fit from scratch. Only when a fit
+    diverges (raises, returns non-finite values, the center or its error exceed max_shift, or the rsquare drops below
+    min_rsquare_ratio times the rsquare of the last accepted fit) the trace is fitted again from a cold start: the
+    window is centered on the maximum (or minimum) of the trace and fitparams is used as initial guess. A rejected
+    warm fit is never used as seed.
+    :param xdata: x-data; 1D array shared by all traces, or 2D array of shape (M, N) with one x-axis per trace
+    :param ydata: 2D array of shape (M, N), one trace per row
+    :param fitfunction: One of the fit wrappers in this module that pass info on to fitbetter, e.g. fit_lor, fit_fano
+                        or fit_s11
+    :param center_idx: Index of the center frequency in the fit parameters, e.g. 2 for fit_lor, 0 for fit_s11
+    :param fitspan: Width of the fit window around the center. Default is None, which fits the whole trace.
+    :param fitparams: Initial guess for cold starts. If None, the guess of fitfunction is used.
+    :param seed: Fit parameters to warm start the first trace with, e.g. the last result of a previous call.
+    :param max_shift: Maximum shift of the center with respect to the previous trace. Default is fitspan/2.
+    :param min_rsquare_ratio: A warm fit is rejected if its rsquare is below min_rsquare_ratio times the rsquare of
+                              the last accepted fit, or below min_rsquare_ratio for the first trace. This catches fits
+                              to noise after the resonance jumped. None disables the check.
+    :param peak: 'max' for a peak or 'min' for a dip. Used to center the fit window for cold starts.
+    :param verbose: Print the number of warm starts, cold starts and failed fits.
+    :param info: Optional dictionary, which is filled with arrays 'rsquare' and 'nfev' of length M (nan and -1 for
+                 failed fits), see fitbetter.
+    :param kwarg: Keyword arguments for fitfunction, e.g. mode for fit_s11 or showfit.
+    :return: Arrays of shape (M, P) with the fit parameters and errors. Rows of failed fits are filled with nan.
+    """
+    ydata = np.atleast_2d(ydata)
+    if np.ndim(xdata) == 1:
+        xdata = np.broadcast_to(xdata, np.shape(ydata))
+
+    if max_shift is None and fitspan is not None:
+        max_shift = fitspan / 2.
+
+    results = list()
+    n_cold = 0
+    rsquare = np.full(len(ydata), np.nan)
+    nfev = np.full(len(ydata), -1, dtype=np.int64)
+    # rsquare of the last accepted fit, against which warm fits are checked
+    reference_rsquare = 1.
+    for idx, (x, y) in enumerate(zip(xdata, ydata)):
+        fit_info = dict()
+        result = None
+        if seed is not None:
+            min_rsquare = None if min_rsquare_ratio is None else min_rsquare_ratio * reference_rsquare
+            result = _tracking_fit(fitfunction, x, y, seed, seed[center_idx], fitspan, center_idx, max_shift, fit_info,
+                                   min_rsquare=min_rsquare, **kwarg)
+
+        if result is None:
+            n_cold += 1
+            ctr = x[np.argmax(y)] if peak == 'max' else x[np.argmin(y)]
+            result = _tracking_fit(fitfunction, x, y, fitparams, ctr, fitspan, center_idx, max_shift, fit_info,
+                                   **kwarg)
+
+        if result is not None:
+            seed = result[0]
+            rsquare[idx] = fit_info.get('rsquare', np.nan)
+            nfev[idx] = fit_info.get('nfev', -1)
+            if np.isfinite(rsquare[idx]):
+                reference_rsquare = rsquare[idx]
+        results.append(result)
+
+    if info is not None:
+        info['rsquare'] = rsquare
+        info['nfev'] = nfev
+
+    # The number of fit parameters follows from the first successful fit
+    nparams = 0 if fitparams is None else len(fitparams)
+    for result in results:
+        if result is not None:
+            nparams = len(result[0])
+            break
+
+    params = np.full((len(results), nparams), np.nan)
+    param_errs = np.full((len(results), nparams), np.nan)
+    for idx, result in enumerate(results):
+        if result is not None:
+            params[idx], param_errs[idx] = result
+
+    if verbose:
+        n_failed = sum([result is None for result in results])
+        print("Tracking fit: %d warm starts, %d cold starts, %d failed" % (len(results) - n_cold, n_cold, n_failed))
+
+    return params, param_errs
+
+
 def fit_kinetic_fraction(xdata, ydata, fitparams=None, Tc_fixed=False, domain=None, showfit=False, showstartfit=False,
                          verbose=True, **kwarg):
     """
@@ -218,18 +1008,8 @@ def fit_kinetic_fraction(xdata, ydata, fitparams=None, Tc_fixed=False, domain=No
     if Tc_fixed:
         fitparams = fitparams[:2]
 
-    def kinfunc_jac(x, *p):
-        f0, alpha, Tc = p
-        a = 1 - (x/Tc)**4
-        b = (1 + alpha/a)**(-3/2.)
-
-        df_dalpha = -f0*b/(2*a)
-        df_dTc = 2 * b * f0 * x**4 * alpha / (a**2 * Tc**5)
-        df_df0 = b**(1/3.)
-        return np.transpose(np.vstack([df_df0, df_dalpha, df_dTc]))
-
     params, param_errs = fitbetter(fitdatax, fitdatay, kinfunc, fitparams, domain=None, showfit=showfit,
-                                   showstartfit=showstartfit, jac=kinfunc_jac, **kwarg)
+                                   showstartfit=showstartfit, **kwarg)
 
     if verbose:
         parnames = ['f0', 'Kinetic Inductance fraction', 'Tc']
@@ -278,11 +1058,13 @@ def fit_double_lor(xdata, ydata, fitparams=None, domain=None, showfit=False, sho
 
 
 def fit_N_gauss(xdata, ydata, fitparams=None, domain=None, showfit=False, showstartfit=False,
-                verbose=True, no_offset=False, **kwarg):
+                verbose=True, no_offset=False, npeaks=None, **kwarg):
     """
     Fits a series of N Gaussian peaks or dips.
     If no_offset = True : Uses Ngaussfunc_no_offset
     If no_offset = False : uses Ngaussfunc
+    If no fitparams are given, the peaks are located with scipy.signal.find_peaks, which also determines N unless
+    npeaks is specified.
     :param xdata: x-data
     :param ydata: y-data
     :param fitparams: [offset, amplitude 1, res freq 1, sigma 1, ...] or [amplitude 1, res freq 1, sigma 1, ...] if no_offset=True
@@ -291,6 +1073,7 @@ def fit_N_gauss(xdata, ydata, fitparams=None, domain=None, showfit=False, showst
     :param showstartfit: True/False
     :param label: String
     :param no_offset: True/False
+    :param npeaks: Number of peaks to fit if fitparams is None. Default is None, i.e. all peaks that are found.
     :return: Optimal fit result (if successful).
     """
     if domain is not None:
@@ -300,7 +1083,9 @@ def fit_N_gauss(xdata, ydata, fitparams=None, domain=None, showfit=False, showst
         fitdatay = ydata
 
     if fitparams is None:
-        print("Please provide some initial guesses.")
+        fitparams = _guess_Ngauss(fitdatax, fitdatay, npeaks=npeaks, no_offset=no_offset)
+        if verbose:
+            print("Found %d peaks" % int(len(fitparams) / 3))
 
     if no_offset:
         params, param_errs = fitbetter(fitdatax, fitdatay, Ngaussfunc_no_offset, fitparams, domain=None,
@@ -340,17 +1125,10 @@ def fit_exp(xdata, ydata, fitparams=None, domain=None, showfit=False, showstartf
         fitdatax = xdata
         fitdatay = ydata
     if fitparams is None:
-        fitparams = [0., 0., 0.]
-        fitparams[0] = fitdatay[-1]
-        fitparams[1] = fitdatay[0] - fitdatay[-1]
-        fitparams[2] = (fitdatax[-1] - fitdatax[0]) / 5.
-
-    # Note that one may use the Jacobian, provided no bounds are supplied. There's still an error in the output covariance.
-    def jacobian(fitparams, xdata, ydata, expfunc):
-        return [np.ones(len(xdata)), np.exp(-xdata/fitparams[2]), fitparams[1]/fitparams[2]**2 * np.exp(-xdata/fitparams[2])]
+        fitparams = get_model(expfunc).guess(fitdatax, fitdatay)
 
     params, param_errs = fitbetter(fitdatax, fitdatay, expfunc, fitparams, domain=None, showfit=showfit,
-                                   showstartfit=showstartfit)#, Dfun=jacobian, col_deriv=1)
+                                   showstartfit=showstartfit, **kwarg)
 
     if verbose:
         parnames = ['Offset', 'Amplitude', chr(964)]
@@ -380,10 +1158,7 @@ def fit_pulse_err(xdata, ydata, fitparams=None, domain=None, showfit=False, show
         fitdatax = xdata
         fitdatay = ydata
     if fitparams is None:
-        fitparams = [0., 0.]
-        fitparams[0] = fitdatay[-1]
-        fitparams[1] = fitdatay[0] - fitdatay[-1]
-        fitparams[1] = fitdatay[0] - fitdatay[-1]
+        fitparams = get_model(pulse_errfunc).guess(fitdatax, fitdatay)
 
     params, param_errs = fitbetter(fitdatax, fitdatay, pulse_errfunc, fitparams, domain=None, showfit=showfit,
                                    showstartfit=showstartfit)
@@ -410,17 +1185,7 @@ def fit_decaysin(xdata, ydata, fitparams=None, domain=None, showfit=False, shows
         fitdatax = xdata
         fitdatay = ydata
     if fitparams is None:
-        FFT = scipy.fft(fitdatay)
-        fft_freqs = scipy.fftpack.fftfreq(len(fitdatay), fitdatax[1] - fitdatax[0])
-        max_ind = np.argmax(abs(FFT[4:len(fitdatay) / 2.])) + 4
-        fft_val = FFT[max_ind]
-
-        fitparams = [0, 0, 0, 0, 0]
-        fitparams[4] = np.mean(fitdatay)
-        fitparams[0] = (max(fitdatay) - min(fitdatay)) / 2.
-        fitparams[1] = fft_freqs[max_ind]
-        fitparams[2] = (cmath.phase(fft_val) - np.pi / 2.) * 180. / np.pi
-        fitparams[3] = (max(fitdatax) - min(fitdatax))
+        fitparams = get_model(decaysin).guess(fitdatax, fitdatay)
 
     params, param_errs = fitbetter(fitdatax, fitdatay, decaysin, fitparams, domain=None, showfit=showfit,
                                    showstartfit=showstartfit, **kwarg)
@@ -453,16 +1218,7 @@ def fit_sin(xdata, ydata, fitparams=None, domain=None, showfit=False, showstartf
         fitdatax = xdata
         fitdatay = ydata
     if fitparams is None:
-        FFT = scipy.fft(fitdatay)
-        fft_freqs = scipy.fftpack.fftfreq(len(fitdatay), fitdatax[1] - fitdatax[0])
-        max_ind = np.argmax(abs(FFT[4:len(fitdatay) / 2.])) + 4
-        fft_val = FFT[max_ind]
-
-        fitparams = [0, 0, 0, 0]
-        fitparams[3] = np.mean(fitdatay)
-        fitparams[0] = (max(fitdatay) - min(fitdatay)) / 2.
-        fitparams[1] = fft_freqs[max_ind]
-        fitparams[2] = (cmath.phase(fft_val) - np.pi / 2.) * 180. / np.pi
+        fitparams = get_model(sinfunc).guess(fitdatax, fitdatay)
 
     params, param_errs = fitbetter(fitdatax, fitdatay, sinfunc, fitparams, domain=None, showfit=showfit,
                                    showstartfit=showstartfit, **kwarg)
@@ -498,11 +1254,7 @@ def fit_gauss(xdata, ydata, fitparams=None, no_offset=False, domain=None, showfi
         fitdatax = xdata
         fitdatay = ydata
     if fitparams is None:
-        fitparams = [0, 0, 0, 0]
-        fitparams[0] = (fitdatay[0] + fitdatay[-1]) / 2.
-        fitparams[1] = max(fitdatay) - min(fitdatay)
-        fitparams[2] = fitdatax[np.argmax(fitdatay)]
-        fitparams[3] = (max(fitdatax) - min(fitdatax)) / 3.
+        fitparams = get_model(gaussfunc).guess(fitdatax, fitdatay)
 
     if no_offset:
         fitfunc = gaussfunc_nooffset
@@ -512,7 +1264,7 @@ def fit_gauss(xdata, ydata, fitparams=None, no_offset=False, domain=None, showfi
         fitfunc = gaussfunc
 
     params, param_errs = fitbetter(fitdatax, fitdatay, fitfunc, fitparams, domain=None, showfit=showfit,
-                                   showstartfit=showstartfit)
+                                   showstartfit=showstartfit, **kwarg)
 
     if verbose:
         if no_offset:
@@ -531,6 +1283,7 @@ def fit_hanger(xdata, ydata, fitparams=None, domain=None, showfit=False, showsta
                verbose=True, **kwarg):
     """
     Fit Hanger Transmission (S21) data taking into account asymmetry. Uses hangerfunc.
+    If the phase of S21 is available as well, fit_complex_resonator with mode='hanger' is much faster.
     :param xdata: Frequency points
     :param ydata: Power in W
     :param fitparams: [f0, Qi, Qc, df, scale]
@@ -547,17 +1300,9 @@ def fit_hanger(xdata, ydata, fitparams=None, domain=None, showfit=False, showsta
         fitdatax = xdata
         fitdatay = ydata
     if fitparams is None:
-        peakloc = np.argmin(fitdatay)
-        ymax = (fitdatay[0] + fitdatay[-1]) / 2.
-        ymin = fitdatay[peakloc]
-        f0 = fitdatax[peakloc]
-        Q0 = abs(fitdatax[peakloc] / ((max(fitdatax) - min(fitdatax)) / 3.))
-        scale = ymax
-        Qi = Q0 * (1. + ymax)
-        Qc = Qi / (ymax)
-        fitparams = [f0, abs(Qi), abs(Qc), 0., scale]
-
-    params, param_errs = fitbetter(fitdatax, fitdatay, hangerfunc, fitparams, domain=domain, showfit=showfit,
+        fitparams = get_model(hangerfunc).guess(fitdatax, fitdatay)
+
+    params, param_errs = fitbetter(fitdatax, fitdatay, hangerfunc, fitparams, domain=None, showfit=showfit,
                                    showstartfit=showstartfit, **kwarg)
 
     if verbose:
@@ -572,29 +1317,53 @@ def fit_hanger(xdata, ydata, fitparams=None, domain=None, showfit=False, showsta
 def fit_parabola(xdata, ydata, fitparams=None, domain=None, showfit=False, showstartfit=False,
                  verbose=True, **kwarg):
     """
-    Fit a parabola. Uses parabolafunc. Specify fitparams as [p0, p1, p2] where y = p0 + p1*(x-p2)**2
+    Fit a parabola y = p0 + p1*(x-p2)**2 (see parabolafunc). The parabola is fitted as a quadratic polynomial
+    c0 + c1*x + c2*x**2 with fitlinear, which needs no initial guess, and converted to [p0, p1, p2]. The errors are
+    propagated using the full covariance matrix of [c0, c1, c2]. If c2 is smaller than twice its error, the data is
+    consistent with a straight line and nan is returned for all parameters and errors.
     :param xdata: x-data
     :param ydata: y-data
-    :param fitparams: [p0, p1, p2] where y = p0 + p1*(x-p2)**2
+    :param fitparams: Not used, the solution follows without initial guess. Kept for backwards compatibility.
     :param domain: Tuple
     :param showfit: True/False
-    :param showstartfit: True/False
+    :param showstartfit: Not used
     :param label: String
     :param verbose: True/False, prints the fitresult
+    :param kwarg: Keyword arguments for fitlinear, e.g. mark_data and mark_fit. Other keyword arguments, such as
+                  parambounds or curve_fit options like maxfev, are passed to fitbetter, which then refines the linear
+                  solution with parabolafunc.
     :return: Fitresult, Fiterror
     """
-    if fitparams is None:
-        print("Please specify fit parameters in function input")
-        return
-
     if domain is not None:
         fitdatax, fitdatay = selectdomain(xdata, ydata, domain)
     else:
         fitdatax = xdata
         fitdatay = ydata
 
-    params, param_errs = fitbetter(fitdatax, fitdatay, parabolafunc, fitparams, domain=None, showfit=showfit,
-                                   showstartfit=showstartfit, **kwarg)
+    linear_kwarg = dict((key, kwarg.pop(key)) for key in ['showdata', 'mark_data', 'mark_fit'] if key in kwarg)
+    coefs, coef_errs, covmatrix = fitlinear(fitdatax, fitdatay, polyfunc, 3, full_output=True, **linear_kwarg)
+    c0, c1, c2 = coefs
+    if not np.abs(c2) > 2 * coef_errs[2]:
+        # The data is consistent with a straight line, so the vertex is undetermined
+        print("Warning: the quadratic coefficient %.2e +/- %.2e is not significant, returning nan" % (c2, coef_errs[2]))
+        return np.full(3, np.nan), np.full(3, np.nan)
+    params = np.array([c0 - c1 ** 2 / (4. * c2), c2, -c1 / (2. * c2)])
+
+    # Jacobian of [p0, p1, p2] with respect to [c0, c1, c2]
+    G = np.array([[1., -c1 / (2. * c2), c1 ** 2 / (4. * c2 ** 2)],
+                  [0., 0., 1.],
+                  [0., -1. / (2. * c2), c1 / (2. * c2 ** 2)]])
+    param_errs = np.sqrt(np.diag(np.dot(G, np.dot(covmatrix, G.T))))
+
+    if kwarg:
+        # Options for curve_fit: use the linear solution as initial guess
+        if kwarg.get('parambounds') is not None:
+            params = np.clip(params, kwarg['parambounds'][0], kwarg['parambounds'][1])
+        params, param_errs = fitbetter(fitdatax, fitdatay, parabolafunc, params, showfit=False, **kwarg)
+
+    if showfit:
+        plt.plot(fitdatax, fitdatay, linear_kwarg.get('mark_data', 'ko'), label="data")
+        plt.plot(fitdatax, parabolafunc(fitdatax, *params), linear_kwarg.get('mark_fit', 'r-'), label="fit")
 
     if verbose:
         parnames = ["a%d" % idx for idx in range(len(params))]
@@ -612,6 +1381,7 @@ def fit_s11(xdata, ydata, mode='oneport', fitparams=None, domain=None, showfit=F
     s11_mag_twoport. In both cases the fit function can fit asymmetric line shapes, represented by the parameter df.
     NB: fits the voltage signal, not a power (i.e. use this functionto fit |S11| instead of |S11|**2.
     For mode='oneport', Note Qi = f0/(2*eps), Qc = f0/kr.
+    If the phase of S11 is available as well, fit_complex_resonator with mode='reflection' is much faster.
     :param xdata: Frequency points
     :param ydata: S11 voltage data
     :param fitparams: [f0, kr, eps, df, scale]
@@ -628,33 +1398,18 @@ def fit_s11(xdata, ydata, mode='oneport', fitparams=None, domain=None, showfit=F
         fitdatax = xdata
         fitdatay = ydata
 
-    if fitparams is None and mode == 'oneport':
-        f0_guess = fitdatax[np.argmin(fitdatay)]
-        kr_guess = (fitdatax[-1] - fitdatax[0]) / 5.
-        eps_guess = (fitdatax[-1] - fitdatax[0]) / 5.
-        df_guess = 0
-        scale_guess = np.max(fitdatay)
-        fitparams = [f0_guess, kr_guess, eps_guess, df_guess, scale_guess]
-    if fitparams is None and mode == 'twoport':
-        f0_guess = fitdatax[np.argmin(fitdatay)]
-        Qc_guess = f0_guess / ((fitdatax[-1] - fitdatax[0]) / 5.)
-        Qi_guess = f0_guess / ((fitdatax[-1] - fitdatax[0]) / 5.)
-        df_guess = 0
-        scale_guess = np.max(fitdatay)
-        fitparams = [f0_guess, Qc_guess, Qi_guess, df_guess, scale_guess]
-
     if mode == 'oneport':
-        params, param_errs = fitbetter(fitdatax, fitdatay, s11_mag_func_asymmetric, fitparams,
-                                       parambounds=([0, 0, 0, -np.inf, -np.inf], np.inf),
-                                       domain=None, showfit=showfit,
-                                       showstartfit=showstartfit, **kwarg)
-        names = ['f0', chr(954), chr(949), 'df', 'scale']
+        model = get_model(s11_mag_func_asymmetric)
     else:
-        params, param_errs = fitbetter(fitdatax, fitdatay, s11_mag_twoport, fitparams,
-                                       parambounds=([0, 0, 0, -np.inf, -np.inf], np.inf),
-                                       domain=None, showfit=showfit,
-                                       showstartfit=showstartfit, **kwarg)
-        names = ['f0', 'Qc', 'Qi', 'df', 'scale']
+        model = get_model(s11_mag_twoport)
+
+    if fitparams is None:
+        fitparams = model.guess(fitdatax, fitdatay)
+
+    # Default bounds [0, 0, 0, -inf, -inf] to [inf, ...] and the analytic Jacobian come from the model registry
+    params, param_errs = fitbetter(fitdatax, fitdatay, model.func, fitparams, domain=None, showfit=showfit,
+                                   showstartfit=showstartfit, **kwarg)
+    names = model.parnames
 
     if verbose:
         print(tabulate(zip(names, params, param_errs), headers=["Parameter", "Value", "Std"],
@@ -664,6 +1419,195 @@ def fit_s11(xdata, ydata, mode='oneport', fitparams=None, domain=None, showfit=F
     return params, param_errs
 
 
+def fit_circle(zdata):
+    """
+    Algebraic circle fit in the complex plane (Pratt's method). This is non-iterative: the circle follows from the
+    eigenvector of the smallest non-negative eigenvalue of a 4x4 generalized eigenvalue problem built from the moments
+    of the data.
+    :param zdata: Complex data points
+    :return: Center (complex number), radius
+    """
+    x = np.real(zdata)
+    y = np.imag(zdata)
+    z = x ** 2 + y ** 2
+
+    # Moment matrix M and Pratt's constraint matrix B
+    W = np.array([z, x, y, np.ones(len(x))])
+    M = np.dot(W, W.T) / len(x)
+    B = np.array([[0, 0, 0, -2.], [0, 1., 0, 0], [0, 0, 1., 0], [-2., 0, 0, 0]])
+
+    eta, A = linalg.eig(M, B)
+    eta = np.real(eta)
+    # Round off errors make the smallest eigenvalue slightly negative for perfect circles
+    idx = np.argmin(np.where(eta > -1E-12 * np.max(np.abs(eta)), eta, np.inf))
+    A = np.real(A[:, idx])
+
+    center = -(A[1] + 1j * A[2]) / (2 * A[0])
+    radius = np.sqrt(A[1] ** 2 + A[2] ** 2 - 4 * A[0] * A[3]) / (2 * np.abs(A[0]))
+    return center, radius
+
+
+def _circle_residual(zdata):
+    center, radius = fit_circle(zdata)
+    return np.sum((np.abs(zdata - center) - radius) ** 2)
+
+
+def fit_complex_resonator(xdata, sdata, mode='reflection', delay=None, domain=None, refine_steps=10, showfit=False,
+                          verbose=True, full_output=False):
+    """
+    Fit the complex S11 (mode='reflection') or S21 (mode='hanger') of a resonator using a circle fit in the complex
+    plane. Unlike fit_s11 and fit_hanger this uses the phase as well as the magnitude, and the result follows largely
+    in closed form:
+    1. The electrical delay is estimated from the phase slope away from the resonance, and refined such that the
+       data lies on a circle.
+    2. An algebraic circle fit (fit_circle) gives the center and radius of the resonance circle.
+    3. The phase around the center of the circle, theta0 + 2*arctan(2*Ql*(1-f/f0)), gives f0 and Ql. This is the only
+       nonlinear fit, limited to refine_steps iterations.
+    4. The off-resonant point of the circle sets the amplitude and phase of the environment. After normalization,
+       the diameter of the circle is 2*Ql/Qc (reflection) or Ql/Qc (hanger), and the asymmetry angle phi follows from
+       the position of the center. Qi = 1/(1/Ql - cos(phi)/Qc).
+    5. Starting from these values, f0, Ql, Qc, phi, the environment and the delay (unless it is given) are refined
+       together with a least squares fit of the full complex model, limited to refine_steps iterations. The errors
+       follow from the Jacobian of this fit, such that the uncertainty of the delay is included.
+    The results are excellent initial guesses for fit_s11 or fit_hanger, if these are still needed.
+    :param xdata: Frequency points
+    :param sdata: Complex S11 or S21 data, e.g. 10**(mags/20.) * np.exp(1j * np.pi * phases / 180.)
+    :param mode: 'reflection' or 'hanger'
+    :param delay: Electrical delay in s. If None, the delay is estimated from the data.
+    :param domain: Tuple
+    :param refine_steps: Maximum number of iterations for the phase fit (step 3) and the complex fit (step 5).
+    :param showfit: True/False. Plots the data and the fit in the complex plane.
+    :param verbose: True/False. Prints the fitresult.
+    :param full_output: True/False. Also return a dictionary with the delay, environment amplitude and phase, the
+                        asymmetry angle phi, the circle center and radius, the rsquare of the fit in the complex plane
+                        and the number of function evaluations nfev of the phase and complex fits.
+    :return: Fitresult [f0, Qc, Qi, Ql], Fiterror
+    """
+    if domain is not None:
+        fitdatax, fitdataz = selectdomain(xdata, sdata, domain)
+    else:
+        fitdatax = xdata
+        fitdataz = sdata
+    fitdatax = np.asarray(fitdatax, dtype=np.float64)
+    fitdataz = np.asarray(fitdataz, dtype=np.complex128)
+
+    if mode == 'reflection':
+        k = 1.
+    elif mode == 'hanger':
+        k = 2.
+    else:
+        raise ValueError("mode should be 'reflection' or 'hanger'")
+
+    # 1. Electrical delay
+    delay_given = delay
+    span = fitdatax[-1] - fitdatax[0]
+    if delay is None:
+        delay = common.estimate_electrical_delay(fitdatax, fitdataz)
+        # Refine in units of 1/span, such that the tolerance of the optimizer is meaningful. On narrow fit windows
+        # the phase slope at the edges still contains part of the resonance, so the estimate can be off by a good
+        # fraction of 1/span.
+        result = optimize.minimize_scalar(
+            lambda u: _circle_residual(common.remove_electrical_delay(fitdatax, fitdataz, delay + u / span)),
+            bounds=(-0.5, 0.5), method='bounded')
+        delay += result.x / span
+    z = common.remove_electrical_delay(fitdatax, fitdataz, delay)
+
+    # 2. Circle fit
+    center, radius = fit_circle(z)
+
+    # 3. Phase fit around the center of the circle
+    theta = common.unwrap_phase(z - center)
+    f0_idx = np.argmin(np.abs(theta - (theta[0] + theta[-1]) / 2.))
+    f0_guess = fitdatax[f0_idx]
+    slope = np.gradient(theta, fitdatax)[max(f0_idx - 2, 0):f0_idx + 3]
+    Ql_guess = max(abs(np.mean(slope)) * f0_guess / 4., 1.)
+
+    def phase_residuals(p):
+        return np.angle(np.exp(1j * (theta - p[0] - 2 * np.arctan(2 * p[1] * (1 - fitdatax / p[2])))))
+
+    result = optimize.least_squares(phase_residuals, [theta[f0_idx], Ql_guess, f0_guess],
+                                    x_scale=[1., Ql_guess, f0_guess / Ql_guess], max_nfev=refine_steps)
+    theta0, Ql, f0 = result.x
+    Ql = abs(Ql)
+    nfev = result.nfev
+
+    # 4. Normalize by the off-resonant point and calculate the quality factors
+    offres_point = center + radius * np.exp(1j * (theta0 + np.pi))
+    r_norm = radius / np.abs(offres_point)
+    phi = np.angle(1 - center / offres_point)
+    Qc = Ql / (k * r_norm)
+
+    # 5. Refine all parameters with the full complex model. The delay is fitted relative to the estimate, in units of
+    # 1/span, and its phase is referenced to the middle of the window, which decorrelates it from alpha.
+    fit_delay = delay_given is None
+    delay_start = delay
+    f_mid = (fitdatax[0] + fitdatax[-1]) / 2.
+
+    def complex_model(p):
+        f0, Ql, Qc, phi, amplitude, alpha = p[:6]
+        phase = alpha - 2 * np.pi * fitdatax * delay_start
+        if fit_delay:
+            phase -= 2 * np.pi * (fitdatax - f_mid) * p[6] / span
+        s = 1 - 2 * Ql / (k * Qc) * np.exp(1j * phi) / (1 + 2j * Ql * (fitdatax / f0 - 1))
+        return amplitude * np.exp(1j * phase) * s
+
+    def complex_residuals(p):
+        res = fitdataz - complex_model(p)
+        return np.concatenate((np.real(res), np.imag(res)))
+
+    start = [f0, Ql, Qc, phi, np.abs(offres_point), np.angle(offres_point)] + ([0.] if fit_delay else [])
+    result = optimize.least_squares(complex_residuals, start, max_nfev=refine_steps,
+                                    x_scale=[f0 / Ql, Ql, Qc, 1., np.abs(offres_point), 1., 1.][:len(start)])
+    f0, Ql, Qc, phi, amplitude, alpha = result.x[:6]
+    if fit_delay:
+        delay = delay_start + result.x[6] / span
+        alpha += 2 * np.pi * f_mid * result.x[6] / span
+    nfev += result.nfev
+    offres_point = amplitude * np.exp(1j * alpha)
+    r_norm = Ql / (k * Qc)
+    center = offres_point * (1 - r_norm * np.exp(1j * phi))
+    radius = np.abs(offres_point) * r_norm
+    with np.errstate(divide='ignore'):
+        # Qi is infinite for a lossless resonator
+        Qi = 1 / (1 / Ql - np.cos(phi) / Qc)
+
+    # Errors from the Jacobian of the complex fit, scaled with the reduced chi squared like curve_fit
+    dof = max(len(result.fun) - len(result.x), 1)
+    try:
+        covmatrix = np.linalg.inv(np.dot(result.jac.T, result.jac)) * np.sum(result.fun ** 2) / dof
+        f0_err, Ql_err, Qc_err = np.sqrt(np.diag(covmatrix))[:3]
+        # Qi = 1/(1/Ql - cos(phi)/Qc) depends on Ql, Qc and phi
+        G = Qi ** 2 * np.array([1 / Ql ** 2, -np.cos(phi) / Qc ** 2, -np.sin(phi) / Qc])
+        Qi_err = np.sqrt(np.dot(G, np.dot(covmatrix[1:4, 1:4], G)))
+    except np.linalg.LinAlgError:
+        print("Error encountered in calculating errors on fit parameters. This may result from a very flat parameter space")
+        f0_err, Ql_err, Qc_err, Qi_err = np.inf, np.inf, np.inf, np.inf
+
+    params = np.array([f0, Qc, Qi, Ql])
+    param_errs = np.array([f0_err, Qc_err, Qi_err, Ql_err])
+
+    fitz = complex_model(result.x)
+
+    if showfit:
+        plt.plot(np.real(fitdataz), np.imag(fitdataz), 'ko', label="data")
+        plt.plot(np.real(fitz), np.imag(fitz), 'r-', label="fit")
+        plt.gca().set_aspect('equal')
+
+    if verbose:
+        parnames = ['f0', 'Qc', 'Qi', 'Ql']
+        print(tabulate(zip(parnames, params, param_errs), headers=["Parameter", "Value", "Std"],
+                       tablefmt="rst", floatfmt="", numalign="center", stralign='left'))
+        print("Electrical delay = %.3e s, asymmetry angle = %.3f rad" % (delay, phi))
+
+    if full_output:
+        info = {'delay': delay, 'amplitude': np.abs(offres_point), 'alpha': np.angle(offres_point), 'phi': phi,
+                'center': center, 'radius': radius, 'nfev': nfev,
+                'rsquare': 1 - np.sum(np.abs(fitdataz - fitz) ** 2) / np.sum(np.abs(fitdataz - np.mean(fitdataz)) ** 2)}
+        return params, param_errs, info
+
+    return params, param_errs
+
+
 def fit_fano(xdata, ydata, fitparams=None, domain=None, showfit=False, showstartfit=False,
              verbose=True, **kwarg):
     """
@@ -684,11 +1628,7 @@ def fit_fano(xdata, ydata, fitparams=None, domain=None, showfit=False, showstart
         fitdatax = xdata
         fitdatay = ydata
     if fitparams is None:
-        fitparams = [0, 0, 0, 0]
-        fitparams[3] = max(fitdatay) - min(fitdatay)
-        fitparams[0] = fitdatax[np.argmax(fitdatay)]
-        fitparams[1] = (max(fitdatax) - min(fitdatax)) / 10.
-        fitparams[2] = 10.
+        fitparams = get_model(fano_func).guess(fitdatax, fitdatay)
 
     params, param_errs = fitbetter(fitdatax, fitdatay, fano_func, fitparams, domain=None, showfit=showfit,
                                    showstartfit=showstartfit, **kwarg)
@@ -723,11 +1663,7 @@ def fit_lor_asym(xdata, ydata, fitparams=None, domain=None, showfit=False, shows
         fitdatax = xdata
         fitdatay = ydata
     if fitparams is None:
-        fitparams = [0, 0, 0, 0]
-        fitparams[3] = max(fitdatay) - min(fitdatay)
-        fitparams[0] = fitdatax[np.argmax(fitdatay)]
-        fitparams[1] = (max(fitdatax) - min(fitdatax)) / 10.
-        fitparams[2] = fitparams[0] / 10.
+        fitparams = get_model(asym_lorfunc).guess(fitdatax, fitdatay)
 
     params, param_errs = fitbetter(fitdatax, fitdatay, asym_lorfunc, fitparams, domain=None, showfit=showfit,
                                    showstartfit=showstartfit, **kwarg)
@@ -746,40 +1682,61 @@ def fit_poly(xdata, ydata, mode=None, fitparams=None, domain=None, showfit=False
     """
     Fit a polynomial. Uses polyfunc. Specify fitparams as [p0, p1, p2, ...] where
     y = p0 + p1*x + p2*x**2 + ...
+    The polynomial is linear in its parameters and is solved directly with fitlinear, so only the length of fitparams
+    (the number of coefficients) matters. If ydata is 2D, the same polynomial is fitted to each row at once.
     :param xdata: x-data
-    :param ydata: y-data
+    :param ydata: y-data; 1D array or 2D array with one trace per row
+    :param mode: None, 'even' or 'odd'. Uses polyfunc, polyfunc_even or polyfunc_odd respectively.
     :param fitparams: [a0, a1, a2, a3, ...] where y = a0 + a1*x + a2*x**2 + ...
     :param domain: Tuple
     :param showfit: True/False
-    :param showstartfit: True/False
+    :param showstartfit: True/False. Only used if the fit is refined with fitbetter (see kwarg), the start fit is then
+                         the linear solution.
     :param label: String
     :param verbose: True/False. Prints the fitresults.
+    :param kwarg: Keyword arguments for fitlinear, e.g. mark_data and mark_fit. Other keyword arguments, such as
+                  parambounds or curve_fit options like maxfev, are passed to fitbetter, which then refines the linear
+                  solution (for each trace if ydata is 2D).
     :return: Fitresult, Fiterror
     """
     if fitparams is None:
         print("Please specify fit parameters in function input")
         return
 
-    if domain is not None:
-        fitdatax, fitdatay = selectdomain(xdata, ydata, domain)
-    else:
-        fitdatax = xdata
-        fitdatay = ydata
-
     if mode == 'even':
         fitfunction = polyfunc_even
         fitfunc_string = "Fit function: y = a0 + a1*x**2 + a2*x**4 + ..."
     elif mode == 'odd':
         fitfunction = polyfunc_odd
-        fitfunc_string = "Fit function: y = a0 + a1*x + ..."
+        fitfunc_string = "Fit function: y = a0 + a1*x + a2*x**3 + ..."
     else:
         fitfunction = polyfunc
-        fitfunc_string = "Fit function: y = a0 + a1*x + a2*x**3 + ..."
+        fitfunc_string = "Fit function: y = a0 + a1*x + a2*x**2 + ..."
+
+    linear_kwarg = dict((key, kwarg.pop(key)) for key in ['showdata', 'mark_data', 'mark_fit'] if key in kwarg)
+    params, param_errs = fitlinear(xdata, ydata, fitfunction, len(fitparams), domain=domain,
+                                   showfit=showfit and not kwarg, **linear_kwarg)
+
+    if kwarg:
+        # Options for curve_fit: use the linear solution as initial guess
+        kwarg.update(linear_kwarg)
+        if kwarg.get('parambounds') is not None:
+            params = np.clip(params, kwarg['parambounds'][0], kwarg['parambounds'][1])
+        if np.ndim(params) == 1:
+            params, param_errs = fitbetter(xdata, ydata, fitfunction, params, domain=domain, showfit=showfit,
+                                           showstartfit=showstartfit, **kwarg)
+        else:
+            for k in range(len(params)):
+                params[k], param_errs[k] = fitbetter(xdata, np.asarray(ydata)[k], fitfunction, params[k], domain=domain,
+                                                     **kwarg)
 
-    params, param_errs = fitbetter(fitdatax, fitdatay, fitfunction, fitparams, domain=None, showfit=showfit,
-                                   showstartfit=showstartfit, **kwarg)
+    if verbose and np.ndim(params) == 1:
+        if domain is not None:
+            fitdatax, fitdatay = selectdomain(xdata, ydata, domain)
+        else:
+            fitdatax = xdata
+            fitdatay = ydata
 
-    if verbose:
         print(fitfunc_string)
         parnames = ["a%d" % idx for idx in range(len(params))]
         print(tabulate(zip(parnames, params, param_errs), headers=["Parameter", "Value", "Std"],
@@ -807,6 +1764,32 @@ def lorfunc(x, *p):
     else:
         return p[0] + p[1] / (1 + (x - p[2]) ** 2 / p[3] ** 2)
 
+def lorfunc_jac(x, *p):
+    """
+    Analytic Jacobian of lorfunc. The parameters may also be arrays of shape (M, 1), in which case the Jacobian of M
+    Lorentzians is evaluated at once (used by fit_lor_batch).
+    :param p: [offset, peak amplitude, center, hwhm] or [peak amplitude, center, hwhm]
+    :param x: Frequency points
+    :return: Array of shape (..., len(x), len(p)) with the derivatives with respect to each of the parameters
+    """
+    if len(p) == 3:
+        amp, f0, hwhm = p
+    else:
+        offset, amp, f0, hwhm = p
+
+    u = (x - f0) / hwhm
+
+    # Fill the derivatives parameter-major so that each of them is a contiguous block in memory
+    jac = np.empty((len(p),) + np.shape(u))
+    if len(p) == 4:
+        jac[0] = 1.
+    np.divide(1., 1 + u**2, out=jac[-3])
+    # df_df0 = 2 * amp * (x-f0) / (hwhm**2 * (1 + (x-f0)**2/hwhm**2)**2) and df_dhwhm = df_df0 * (x-f0)/hwhm
+    np.multiply(2 * amp / hwhm * u, jac[-3]**2, out=jac[-2])
+    np.multiply(jac[-2], u, out=jac[-1])
+    return np.moveaxis(jac, 0, -1)
+
+
 def kinfunc(x, *p):
     """
     Function describing a resonance frequency due to kinetic inductance as function of temperature.
@@ -826,6 +1809,28 @@ def kinfunc(x, *p):
     f0s = f0 * (1 + alpha / (1 - (x / Tc) ** 4)) ** (-1 / 2.)
     return f0s
 
+
+def kinfunc_jac(x, *p):
+    """
+    Analytic Jacobian of kinfunc.
+    :param p: [f0, alpha, Tc] or [f0, alpha]
+    :param x: Temperature points
+    :return: Array of shape (len(x), len(p))
+    """
+    f0, alpha = p[:2]
+    Tc = p[2] if len(p) == 3 else 1.2
+
+    a = 1 - (x/Tc)**4
+    b = (1 + alpha/a)**(-3/2.)
+
+    df_df0 = b**(1/3.)
+    df_dalpha = -f0*b/(2*a)
+    if len(p) == 3:
+        df_dTc = 2 * b * f0 * x**4 * alpha / (a**2 * Tc**5)
+        return np.stack([df_df0, df_dalpha, df_dTc], axis=-1)
+    else:
+        return np.stack([df_df0, df_dalpha], axis=-1)
+
 def twolorfunc(x, *p):
     """
     :param p: [offset, amplitude 1, center 1, hwhm 1, amplitude 2, center 2, hwhm 2]
@@ -835,6 +1840,17 @@ def twolorfunc(x, *p):
     return p[0] + p[1] / (1 + (x - p[2]) ** 2 / p[3] ** 2) + p[4] / (1 + (x - p[5]) ** 2 / p[6] ** 2)
 
 
+def twolorfunc_jac(x, *p):
+    """
+    Analytic Jacobian of twolorfunc.
+    :param p: [offset, amplitude 1, center 1, hwhm 1, amplitude 2, center 2, hwhm 2]
+    :param x: Frequency points
+    :return: Array of shape (len(x), 7)
+    """
+    df_doffset = np.ones(np.shape(x) + (1,))
+    return np.concatenate([df_doffset, lorfunc_jac(x, *p[1:4]), lorfunc_jac(x, *p[4:7])], axis=-1)
+
+
 def asym_lorfunc(x, *p):
     """
     Asymmetric Lorentzian profile derived with capacitor in parallel.
@@ -845,6 +1861,27 @@ def asym_lorfunc(x, *p):
     return np.abs(np.sqrt(p[0]) / (1 + 1j * 2 * (x - p[1]) / p[2]) + np.sqrt(p[0]) * 2 * x * p[3] / p[1] / (+1j + 2 * x * p[3] / p[1])) ** 2
 
 
+def asym_lorfunc_jac(x, *p):
+    """
+    Analytic Jacobian of asym_lorfunc.
+    :param x: Frequency points
+    :param p: [peak amplitude, f0, fwhm, parallel capacitance]
+    :return: Array of shape (len(x), 4)
+    """
+    amp, f0, fwhm, C = p
+    E = 1 + 1j * 2 * (x - f0) / fwhm
+    u = 2 * x * C / f0
+    G = 1 / E + u / (+1j + u)
+    dT2_du = 1j / (1j + u) ** 2
+
+    dG_df0 = 2j / (fwhm * E ** 2) - dT2_du * u / f0
+    dG_dfwhm = 2j * (x - f0) / (fwhm ** 2 * E ** 2)
+    dG_dC = dT2_du * 2 * x / f0
+
+    df_damp = np.abs(G) ** 2
+    return np.stack([df_damp] + [2 * amp * np.real(np.conj(G) * dG) for dG in [dG_df0, dG_dfwhm, dG_dC]], axis=-1)
+
+
 def fano_func(x, *p):
     """
     Fano function. q describes the asymmetry.
@@ -855,6 +1892,24 @@ def fano_func(x, *p):
     return p[3] * (p[2] * p[1] / 2. + (x - p[0])) ** 2 / ((p[1] / 2.) ** 2 + (x - p[0]) ** 2)
 
 
+def fano_func_jac(x, *p):
+    """
+    Analytic Jacobian of fano_func.
+    :param x: Frequency points
+    :param p: [w0, fwhm, q, scale]
+    :return: Array of shape (len(x), 4)
+    """
+    w0, fwhm, q, scale = p
+    A = q * fwhm / 2. + (x - w0)
+    B = (fwhm / 2.) ** 2 + (x - w0) ** 2
+
+    df_dw0 = scale * (-2 * A * B + 2 * (x - w0) * A ** 2) / B ** 2
+    df_dfwhm = scale * (A * q * B - A ** 2 * fwhm / 2.) / B ** 2
+    df_dq = scale * A * fwhm / B
+    df_dscale = A ** 2 / B
+    return np.stack([df_dw0, df_dfwhm, df_dq, df_dscale], axis=-1)
+
+
 def print_cavity_Q(fit):
     """
     Prints the Q values given center and HWHM
@@ -874,6 +1929,16 @@ def gaussfunc(x, *p):
     return p[0] + p[1] * math.e ** (-1. / 2. * (x - p[2]) ** 2 / p[3] ** 2)
 
 
+def gaussfunc_jac(x, *p):
+    """
+    Analytic Jacobian of gaussfunc.
+    :param p: [offset, amplitude, center, standard deviation]
+    :return: Array of shape (len(x), 4)
+    """
+    df_doffset = np.ones(np.shape(x) + (1,))
+    return np.concatenate([df_doffset, gaussfunc_nooffset_jac(x, *p[1:])], axis=-1)
+
+
 def gaussfunc_nooffset(x, *p):
     """
     Gaussian function, no offset
@@ -883,30 +1948,73 @@ def gaussfunc_nooffset(x, *p):
     return p[0] * math.e ** (-1. / 2. * (x - p[1]) ** 2 / p[2] ** 2)
 
 
+def gaussfunc_nooffset_jac(x, *p):
+    """
+    Analytic Jacobian of gaussfunc_nooffset.
+    :param p: [amplitude, center, standard deviation]
+    :return: Array of shape (len(x), 3)
+    """
+    amp, center, sigma = p
+    df_damp = np.exp(-1. / 2. * (x - center) ** 2 / sigma ** 2)
+    df_dcenter = amp * df_damp * (x - center) / sigma ** 2
+    df_dsigma = df_dcenter * (x - center) / sigma
+    return np.stack([df_damp, df_dcenter, df_dsigma], axis=-1)
+
+
+def _Ngauss_terms(x, p):
+    """
+    Evaluates the N Gaussian peaks at once by broadcasting the points against the peaks.
+    :param x: x-data
+    :param p: [A1, f1, sigma1, A2, f2, sigma2, ...]
+    :return: amplitudes (N,), widths (N,), (x-f)/sigma and exp(-(x-f)**2/(2*sigma**2)), both of shape (len(x), N)
+    """
+    N = int(len(p) / 3.)
+    amp, center, sigma = np.transpose(np.reshape(np.asarray(p[:3 * N], dtype=np.float64), (N, 3)))
+    u = (np.asarray(x, dtype=np.float64)[..., np.newaxis] - center) / sigma
+    return amp, sigma, u, np.exp(-0.5 * u ** 2)
+
+
 def Ngaussfunc(x, *p):
     """
     Gaussian function with N peaks, including an offset
     :param p: [offset, A1, f1, sigma1, A2, f2, sigma2, ...]
-    :return: p[3*n+1]*math.e**(-1./2.*(x-p[3*n+2])**2/p[3*n+3]**2)
+    :return: p[0] + sum over n of p[3*n+1]*exp(-1./2.*(x-p[3*n+2])**2/p[3*n+3]**2)
+    """
+    return p[0] + Ngaussfunc_no_offset(x, *p[1:])
+
+
+def Ngaussfunc_jac(x, *p):
+    """
+    Analytic Jacobian of Ngaussfunc.
+    :param p: [offset, A1, f1, sigma1, A2, f2, sigma2, ...]
+    :return: Array of shape (len(x), len(p))
     """
-    N = int((len(p) - 1) / 3.)
-    Ngauss = p[0]
-    for n in range(N):
-        Ngauss += p[3 * n + 1] * math.e ** (-1. / 2. * (x - p[3 * n + 2]) ** 2 / p[3 * n + 3] ** 2)
-    return Ngauss
+    return np.concatenate([np.ones(np.shape(x) + (1,)), Ngaussfunc_no_offset_jac(x, *p[1:])], axis=-1)
 
 
 def Ngaussfunc_no_offset(x, *p):
     """
     Gaussian function with N peaks, no offset
     :param p: [A1, f1, sigma1, A2, f2, sigma2, ...]
-    :return: p[3*n+1]*math.e**(-1./2.*(x-p[3*n+2])**2/p[3*n+3]**2)
+    :return: sum over n of p[3*n]*exp(-1./2.*(x-p[3*n+1])**2/p[3*n+2]**2)
     """
-    N = int((len(p) - 1) / 3.)
-    Ngauss = 0
-    for n in range(N):
-        Ngauss += p[3 * n + 1] * math.e ** (-1. / 2. * (x - p[3 * n + 2]) ** 2 / p[3 * n + 3] ** 2)
-    return Ngauss
+    amp, sigma, u, gauss = _Ngauss_terms(x, p)
+    return np.dot(gauss, amp)
+
+
+def Ngaussfunc_no_offset_jac(x, *p):
+    """
+    Analytic Jacobian of Ngaussfunc_no_offset. Each peak only depends on its own three parameters, so the Jacobian
+    is filled for all peaks at once as a (len(x), N, 3) block.
+    :param p: [A1, f1, sigma1, A2, f2, sigma2, ...]
+    :return: Array of shape (len(x), len(p))
+    """
+    amp, sigma, u, gauss = _Ngauss_terms(x, p)
+    jac = np.empty(np.shape(gauss) + (3,))
+    jac[..., 0] = gauss
+    np.multiply(gauss, amp * u / sigma, out=jac[..., 1])
+    np.multiply(jac[..., 1], u, out=jac[..., 2])
+    return np.reshape(jac, np.shape(gauss)[:-1] + (3 * len(amp),))
 
 
 def expfunc(x, *p):
@@ -919,6 +2027,18 @@ def expfunc(x, *p):
     return p[0] + p[1] * math.e ** (-x / p[2])
 
 
+def expfunc_jac(x, *p):
+    """
+    Analytic Jacobian of expfunc.
+    :param p: [offset, amplitude, tau]
+    :param x: time
+    :return: Array of shape (len(x), 3)
+    """
+    df_damp = np.exp(-x / p[2])
+    df_dtau = p[1] * df_damp * x / p[2] ** 2
+    return np.stack([np.ones(np.shape(df_damp)), df_damp, df_dtau], axis=-1)
+
+
 def pulse_errfunc(x, *p):
     """
     Pulse error function
@@ -929,6 +2049,17 @@ def pulse_errfunc(x, *p):
     return p[0] + 0.5 * (1 - ((1 - p[1]) ** x))
 
 
+def pulse_errfunc_jac(x, *p):
+    """
+    Analytic Jacobian of pulse_errfunc.
+    :param p: [offset, ?]
+    :param x: x-axis
+    :return: Array of shape (len(x), 2)
+    """
+    df_dp1 = 0.5 * x * (1 - p[1]) ** (x - 1)
+    return np.stack([np.ones(np.shape(df_dp1)), df_dp1], axis=-1)
+
+
 def decaysin(x, *p):
     """
     Exponential decaying sine function.
@@ -939,6 +2070,23 @@ def decaysin(x, *p):
     return p[0] * np.sin(2. * np.pi * p[1] * x + p[2] * np.pi / 180.) * np.e ** (-1. * (x - p[5]) / p[3]) + p[4]
 
 
+def decaysin_jac(x, *p):
+    """
+    Analytic Jacobian of decaysin.
+    :param p: [A, f, phi (deg), tau, offset, t0]
+    :param x: Time
+    :return: Array of shape (len(x), 6)
+    """
+    A, f, phi, tau, offset, t0 = p
+    arg = 2. * np.pi * f * x + phi * np.pi / 180.
+    decay = np.exp(-1. * (x - t0) / tau)
+    sin_decay = np.sin(arg) * decay
+    cos_decay = A * np.cos(arg) * decay
+
+    return np.stack([sin_decay, cos_decay * 2. * np.pi * x, cos_decay * np.pi / 180.,
+                     A * sin_decay * (x - t0) / tau ** 2, np.ones(np.shape(sin_decay)), A * sin_decay / tau], axis=-1)
+
+
 def sinfunc(x, *p):
     """
     Sine function
@@ -949,6 +2097,18 @@ def sinfunc(x, *p):
     return p[0] * np.sin(2. * np.pi * p[1] * x + p[2] * np.pi / 180.) + p[3]
 
 
+def sinfunc_jac(x, *p):
+    """
+    Analytic Jacobian of sinfunc.
+    :param p: [Amplitude, Frequency (Hz), Phi (deg), Offset]
+    :param x: Time points
+    :return: Array of shape (len(x), 4)
+    """
+    arg = 2. * np.pi * p[1] * x + p[2] * np.pi / 180.
+    cos = p[0] * np.cos(arg)
+    return np.stack([np.sin(arg), cos * 2. * np.pi * x, cos * np.pi / 180., np.ones(np.shape(arg))], axis=-1)
+
+
 def hangerfunc(x, *p):
     """
     Hanger function
@@ -964,19 +2124,104 @@ def hangerfunc(x, *p):
         Qc ** 2 * (1. + 4. * Q0 ** 2. * a ** 2.))
 
 
-def polynomial(x, *p):
+def hangerfunc_jac(x, *p):
+    """
+    Analytic Jacobian of hangerfunc.
+    :param p: [f0, Qi, Qc, df, scale]
+    :param x: Frequency points
+    :return: Array of shape (len(x), 5)
+    """
+    f0, Qi, Qc, df, scale = p
+    a = (x - (f0 + df)) / (f0 + df)
+    b = 2 * df / f0
+    s = 2. * a + b
+    Q0 = 1. / (1. / Qi + 1. / Qc)
+    num = -2. * Q0 * Qc + Qc ** 2. + Q0 ** 2. * (1. + Qc ** 2. * s ** 2.)
+    den = Qc ** 2 * (1. + 4. * Q0 ** 2. * a ** 2.)
+
+    # Partial derivatives of numerator and denominator with respect to the intermediate quantities
+    dnum_dQ0 = -2. * Qc + 2. * Q0 * (1. + Qc ** 2. * s ** 2.)
+    dnum_dQc = -2. * Q0 + 2. * Qc + 2. * Q0 ** 2. * Qc * s ** 2.
+    dnum_ds = 2. * Q0 ** 2. * Qc ** 2. * s
+    dden_dQ0 = 8. * Qc ** 2 * Q0 * a ** 2.
+    dden_dQc = 2. * Qc * (1. + 4. * Q0 ** 2. * a ** 2.)
+    dden_da = 8. * Qc ** 2 * Q0 ** 2. * a
+    da_df0 = -x / (f0 + df) ** 2
+    dQ0_dQi = Q0 ** 2 / Qi ** 2
+    dQ0_dQc = Q0 ** 2 / Qc ** 2
+
+    def quotient_rule(dnum, dden):
+        return scale * (dnum * den - num * dden) / den ** 2
+
+    df_df0 = quotient_rule(dnum_ds * (2. * da_df0 - 2. * df / f0 ** 2), dden_da * da_df0)
+    df_dQi = quotient_rule(dnum_dQ0 * dQ0_dQi, dden_dQ0 * dQ0_dQi)
+    df_dQc = quotient_rule(dnum_dQc + dnum_dQ0 * dQ0_dQc, dden_dQc + dden_dQ0 * dQ0_dQc)
+    df_ddf = quotient_rule(dnum_ds * (2. * da_df0 + 2. / f0), dden_da * da_df0)
+    return np.stack([df_df0, df_dQi, df_dQc, df_ddf, num / den], axis=-1)
+
+
+def _horner(coefs, t, out):
+    """
+    Evaluate coefs[0] + coefs[1]*t + coefs[2]*t**2 + ... in place using Horner's scheme: one multiplication and one
+    addition per order, without temporary arrays.
+    :param coefs: Polynomial coefficients, lowest order first
+    :param t: Points where the polynomial is evaluated
+    :param out: Array with the same shape as t to which the result is written
+    :return: out
+    """
+    out[...] = coefs[-1] if len(coefs) else 0.
+    for c in coefs[-2::-1]:
+        out *= t
+        out += c
+    return out
+
+
+def _poly_buffer(x, p, out, nparams=None):
+    """
+    Returns out, or a new array that fits the result of a polynomial (nparams=None) or its Jacobian if out is None.
+    """
+    if out is None:
+        shape = np.shape(x) if nparams is None else np.shape(x) + (nparams,)
+        out = np.empty(shape, dtype=np.result_type(x, 1., *p))
+    return out
+
+
+def _poly_result(y, out):
+    """
+    Returns y, or a scalar if x was a scalar and no out array was given.
+    """
+    return y if out is not None or np.ndim(y) else y[()]
+
+
+def polynomial(x, *p, **kwargs):
     """
     Polynomial of order 9.
     :param p: [offset (a0), linear (a1), quadratic (a2), ..., a9, center]
     :param x: x-axis
+    :param out: Optional array with the same shape as x to which the result is written
     :return: a0 + a1*(x-center) + a2*(x-center)**2 + ... + a9*(x-center)**9
     """
-    return p[0] + p[1] * (x - p[-1]) + p[2] * (x - p[-1]) ** 2 + p[3] * (x - p[-1]) ** 3 + p[4] * (x - p[-1]) ** 4 + p[
-                                                                                                                         5] * (
-                                                                                                                                  x -
-                                                                                                                                  p[
-                                                                                                                                      -1]) ** 5 + \
-           p[6] * (x - p[-1]) ** 6 + p[7] * (x - p[-1]) ** 7 + p[8] * (x - p[-1]) ** 8 + p[9] * (x - p[-1]) ** 9
+    out = kwargs.pop('out', None)
+    return _poly_result(_horner(p[:10], np.subtract(x, p[-1]), _poly_buffer(x, p, out)), out)
+
+
+def polynomial_jac(x, *p, **kwargs):
+    """
+    Analytic Jacobian of polynomial.
+    :param p: [offset (a0), linear (a1), quadratic (a2), ..., a9, center]
+    :param x: x-axis
+    :param out: Optional array of shape (len(x), 11) to which the result is written
+    :return: Array of shape (len(x), 11)
+    """
+    out = kwargs.pop('out', None)
+    out = _poly_buffer(x, p, out, nparams=11)
+    dx = np.subtract(x, p[-1])
+    out[..., 0] = 1.
+    for k in range(1, 10):
+        np.multiply(out[..., k - 1], dx, out=out[..., k])
+    # df/dcenter = -(a1 + 2*a2*(x-center) + ... + 9*a9*(x-center)**8)
+    _horner([-k * p[k] for k in range(1, 10)], dx, out[..., 10])
+    return out
 
 
 def s11_mag_func(x, *p):
@@ -990,6 +2235,53 @@ def s11_mag_func(x, *p):
         (p[1] + p[2]) / p[2] + 2 * 1j * (x - p[0]) * p[1] / p[0]))
 
 
+def _s11_complex(x, *p):
+    """
+    Complex reflection coefficient of s11_mag_func and s11_phase_func, and its derivatives.
+    :param x: Frequency points
+    :param p: [w0, Qi, Qc]
+    :return: S11, [dS11/dw0, dS11/dQi, dS11/dQc]
+    """
+    w0, Qi, Qc = p[:3]
+    num = (Qc - Qi) / Qc + 2 * 1j * (x - w0) * Qi / w0
+    den = (Qi + Qc) / Qc + 2 * 1j * (x - w0) * Qi / w0
+    S = num / den
+
+    dnum = [-2 * 1j * Qi * x / w0 ** 2, -1. / Qc + 2 * 1j * (x - w0) / w0, Qi / Qc ** 2]
+    dden = [-2 * 1j * Qi * x / w0 ** 2, 1. / Qc + 2 * 1j * (x - w0) / w0, -Qi / Qc ** 2]
+    return S, [(dn - S * dd) / den for dn, dd in zip(dnum, dden)]
+
+
+def _abs_jac(S, dS):
+    """
+    Jacobian of |S| given the derivatives dS of the complex function S.
+    :param S: Complex function values
+    :param dS: List of derivatives of S with respect to each of the parameters
+    :return: Array of shape (len(S), len(dS))
+    """
+    return np.stack([np.real(np.conj(S) * d) / np.abs(S) for d in dS], axis=-1)
+
+
+def _phase_jac(S, dS):
+    """
+    Jacobian of the phase of S given the derivatives dS of the complex function S.
+    :param S: Complex function values
+    :param dS: List of derivatives of S with respect to each of the parameters
+    :return: Array of shape (len(S), len(dS))
+    """
+    return np.stack([np.imag(d / S) * np.ones(np.shape(S)) for d in dS], axis=-1)
+
+
+def s11_mag_func_jac(x, *p):
+    """
+    Analytic Jacobian of s11_mag_func.
+    :param x: Frequency points
+    :param p: [w0, Qi, Qc]
+    :return: Array of shape (len(x), 3)
+    """
+    return _abs_jac(*_s11_complex(x, *p))
+
+
 def s11_phase_func(x, *p):
     """
     Symmetric S11 phase function (reflection from resonator) in radians.
@@ -1001,6 +2293,16 @@ def s11_phase_func(x, *p):
         (p[1] + p[2]) / p[2] + 2 * 1j * (x - p[0]) * p[1] / p[0]))
 
 
+def s11_phase_func_jac(x, *p):
+    """
+    Analytic Jacobian of s11_phase_func.
+    :param x: Frequency points
+    :param p: [w0, Qi, Qc]
+    :return: Array of shape (len(x), 3)
+    """
+    return _phase_jac(*_s11_complex(x, *p))
+
+
 def s11_mag_func_asymmetric(x, *p):
     """
     Asymmetric S11 magnitude function (reflection from 1 port resonator), in voltage!
@@ -1011,6 +2313,34 @@ def s11_mag_func_asymmetric(x, *p):
     return p[4] * np.abs((1j * (x - p[0]) + (p[2] - p[1] / 2.)) / (1j * (x - p[0]) + 1j * p[3] + (p[2] + p[1] / 2.)))
 
 
+def _s11_asymmetric_complex(x, *p):
+    """
+    Complex reflection coefficient of s11_mag_func_asymmetric (without scale) and its derivatives.
+    :param x: Frequency points
+    :param p: [f0, kr, eps, df, scale]
+    :return: S11, [dS11/df0, dS11/dkr, dS11/deps, dS11/ddf]
+    """
+    f0, kr, eps, df = p[:4]
+    num = 1j * (x - f0) + (eps - kr / 2.)
+    den = 1j * (x - f0) + 1j * df + (eps + kr / 2.)
+    S = num / den
+
+    dnum = [-1j, -0.5, 1., 0.]
+    dden = [-1j, 0.5, 1., 1j]
+    return S, [(dn - S * dd) / den for dn, dd in zip(dnum, dden)]
+
+
+def s11_mag_func_asymmetric_jac(x, *p):
+    """
+    Analytic Jacobian of s11_mag_func_asymmetric.
+    :param x: Frequency points
+    :param p: [f0, kr, eps, df, scale]
+    :return: Array of shape (len(x), 5)
+    """
+    S, dS = _s11_asymmetric_complex(x, *p)
+    return np.concatenate([p[4] * _abs_jac(S, dS), np.abs(S)[..., np.newaxis]], axis=-1)
+
+
 def s11_phase_func_asymmetric(x, *p):
     """
     Asymmetric S11 phase function (reflection from 1 port resonator)
@@ -1021,6 +2351,17 @@ def s11_phase_func_asymmetric(x, *p):
     return common.get_phase((1j * (x - p[0]) + (p[2] - p[1] / 2.)) / (1j * (x - p[0]) + 1j * p[3] + (p[2] + p[1] / 2.)))
 
 
+def s11_phase_func_asymmetric_jac(x, *p):
+    """
+    Analytic Jacobian of s11_phase_func_asymmetric. The phase does not depend on scale.
+    :param x: Frequency points
+    :param p: [f0, kr, eps, df, scale]
+    :return: Array of shape (len(x), 5)
+    """
+    S, dS = _s11_asymmetric_complex(x, *p)
+    return _phase_jac(S, dS + [0.])
+
+
 def s11_mag_twoport(x, *p):
     """
     Reflection off a 2 port resonator
@@ -1036,6 +2377,35 @@ def s11_mag_twoport(x, *p):
     return scale * np.abs((-1j * dw + 1j * ki - eps) / (1j * dw + kr + eps))
 
 
+def _s11_twoport_complex(x, *p):
+    """
+    Complex reflection coefficient of s11_mag_twoport (without scale) and its derivatives.
+    :param x: fpoints
+    :param p: [f0, Qc, Qi, df, scale]
+    :return: S11, [dS11/df0, dS11/dQc, dS11/dQi, dS11/ddf]
+    """
+    f0, Qc, Qi, df = p[:4]
+    dw = x - f0
+    num = -1j * dw + 1j * df - f0 / Qi
+    den = 1j * dw + f0 / Qc + f0 / Qi
+    S = num / den
+
+    dnum = [1j - 1. / Qi, 0., f0 / Qi ** 2, 1j]
+    dden = [-1j + 1. / Qc + 1. / Qi, -f0 / Qc ** 2, -f0 / Qi ** 2, 0.]
+    return S, [(dn - S * dd) / den for dn, dd in zip(dnum, dden)]
+
+
+def s11_mag_twoport_jac(x, *p):
+    """
+    Analytic Jacobian of s11_mag_twoport.
+    :param x: fpoints
+    :param p: [f0, Qc, Qi, df, scale]
+    :return: Array of shape (len(x), 5)
+    """
+    S, dS = _s11_twoport_complex(x, *p)
+    return np.concatenate([p[4] * _abs_jac(S, dS), np.abs(S)[..., np.newaxis]], axis=-1)
+
+
 def s11_phase_twoport(x, *p):
     """
     Reflection off a 2 port resonator
@@ -1051,6 +2421,17 @@ def s11_phase_twoport(x, *p):
     return common.get_phase((-1j * dw + 1j * ki - eps) / (1j * dw + kr + eps))
 
 
+def s11_phase_twoport_jac(x, *p):
+    """
+    Analytic Jacobian of s11_phase_twoport. The phase does not depend on scale.
+    :param x: fpoints
+    :param p: [f0, Qc, Qi, df, scale]
+    :return: Array of shape (len(x), 5)
+    """
+    S, dS = _s11_twoport_complex(x, *p)
+    return _phase_jac(S, dS + [0.])
+
+
 def parabolafunc(x, *p):
     """
     Parabola function
@@ -1061,43 +2442,328 @@ def parabolafunc(x, *p):
     return p[0] + p[1] * (x - p[2]) ** 2
 
 
-def polyfunc(x, *p):
+def parabolafunc_jac(x, *p):
+    """
+    Analytic Jacobian of parabolafunc.
+    :param x: x-data
+    :param p: [a0, a1, a2] where y = a0 + a1 * (x-a2)**2
+    :return: Array of shape (len(x), 3)
+    """
+    return np.stack([np.ones(np.shape(x)), (x - p[2]) ** 2, -2 * p[1] * (x - p[2])], axis=-1)
+
+
+def polyfunc(x, *p, **kwargs):
     """
     Polynomial of arbitrary order. Order is specified by the length of p
     :param x: x-data
     :param p: [a0, a1, a2, a3, ...] where y = a0 + a1*x + a2*x**2 + ...
+    :param out: Optional array with the same shape as x to which the result is written
     :return: p[0] + p[1]*x + p[2]*x**2 + ...
     """
-    y = 0
-    for n, P in enumerate(p):
-        y += P * x ** n
-    return y
+    out = kwargs.pop('out', None)
+    return _poly_result(_horner(p, x, _poly_buffer(x, p, out)), out)
 
 
-def polyfunc_even(x, *p):
+def polyfunc_jac(x, *p, **kwargs):
+    """
+    Analytic Jacobian of polyfunc.
+    :param x: x-data
+    :param p: [a0, a1, a2, a3, ...] where y = a0 + a1*x + a2*x**2 + ...
+    :param out: Optional array of shape (len(x), len(p)) to which the result is written
+    :return: Array of shape (len(x), len(p)): 1, x, x**2, ...
+    """
+    out = kwargs.pop('out', None)
+    out = _poly_buffer(x, p, out, nparams=len(p))
+    if len(p):
+        out[..., 0] = 1.
+    for n in range(1, len(p)):
+        np.multiply(out[..., n - 1], x, out=out[..., n])
+    return out
+
+
+def polyfunc_even(x, *p, **kwargs):
     """
     Even polynomial of arbitrary order. Order is specified by the length of p
     :param x: x-data
     :param p: [a0, a1, a2, a3, ...] where y = a0 + a1*x**2 + a2*x**4 + ...
+    :param out: Optional array with the same shape as x to which the result is written
     :return: p[0] + p[1]*x**2 + p[2]*x**4 + ...
     """
-    y = 0
-    for n, P in enumerate(p):
-        y += P * x ** (2*n)
-    return y
+    out = kwargs.pop('out', None)
+    return _poly_result(_horner(p, np.square(x), _poly_buffer(x, p, out)), out)
+
+
+def polyfunc_even_jac(x, *p, **kwargs):
+    """
+    Analytic Jacobian of polyfunc_even.
+    :param x: x-data
+    :param p: [a0, a1, a2, a3, ...] where y = a0 + a1*x**2 + a2*x**4 + ...
+    :param out: Optional array of shape (len(x), len(p)) to which the result is written
+    :return: Array of shape (len(x), len(p)): 1, x**2, x**4, ...
+    """
+    out = kwargs.pop('out', None)
+    out = _poly_buffer(x, p, out, nparams=len(p))
+    x2 = np.square(x)
+    if len(p):
+        out[..., 0] = 1.
+    for n in range(1, len(p)):
+        np.multiply(out[..., n - 1], x2, out=out[..., n])
+    return out
 
 
-def polyfunc_odd(x, *p):
+def polyfunc_odd(x, *p, **kwargs):
     """
     Odd polynomial of arbitrary order. Order is specified by the length of p
     :param x: x-data
     :param p: [a0, a1, a2, a3, ...] where y = a0 + a1*x + a2*x**3 + ...
+    :param out: Optional array with the same shape as x to which the result is written
     :return: p[0] + p[1]*x + p[2]*x**3 + ...
     """
-    y = p[0]
-    for n, P in enumerate(p[1:]):
-        y += P * x ** (2*n+1)
-    return y
+    out = kwargs.pop('out', None)
+    # a0 + x * (a1 + a2*x**2 + a3*x**4 + ...)
+    y = _horner(p[1:], np.square(x), _poly_buffer(x, p, out))
+    y *= x
+    y += p[0]
+    return _poly_result(y, out)
+
+
+def polyfunc_odd_jac(x, *p, **kwargs):
+    """
+    Analytic Jacobian of polyfunc_odd.
+    :param x: x-data
+    :param p: [a0, a1, a2, a3, ...] where y = a0 + a1*x + a2*x**3 + ...
+    :param out: Optional array of shape (len(x), len(p)) to which the result is written
+    :return: Array of shape (len(x), len(p)): 1, x, x**3, ...
+    """
+    out = kwargs.pop('out', None)
+    out = _poly_buffer(x, p, out, nparams=len(p))
+    x2 = np.square(x)
+    out[..., 0] = 1.
+    if len(p) > 1:
+        out[..., 1] = x
+    for n in range(2, len(p)):
+        np.multiply(out[..., n - 1], x2, out=out[..., n])
+    return out
+
+
+#######################################################################
+#######################################################################
+######################## MODEL REGISTRY ###############################
+#######################################################################
+#######################################################################
+
+class FitModel(object):
+    """
+    Bundles a fit function with everything that is needed to fit it: the analytic Jacobian, the parameter names,
+    the default parameter bounds and a routine that makes an initial guess from the data. Models are stored in
+    fit_models and can be retrieved with get_model. fitbetter uses the Jacobian and bounds of a registered model
+    automatically, which avoids the finite difference evaluations of curve_fit.
+    """
+    def __init__(self, func, jac=None, parnames=None, bounds=None, guess=None, name=None):
+        """
+        :param func: Fit function of the form func(x, *p)
+        :param jac: Analytic Jacobian of the form jac(x, *p), returning an array of shape (len(x), len(p))
+        :param parnames: List of parameter names
+        :param bounds: Default parameter bounds, same format as parambounds in fitbetter. None means unbounded.
+        :param guess: Function of the form guess(xdata, ydata) that returns a list of initial parameters
+        :param name: Name of the model. Default is the name of func.
+        """
+        self.func = func
+        self.jac = jac
+        self.parnames = parnames
+        self.bounds = bounds
+        self._guess = guess
+        self.name = func.__name__ if name is None else name
+
+    def __call__(self, x, *p):
+        return self.func(x, *p)
+
+    def __repr__(self):
+        return "FitModel(%s)" % self.name
+
+    def guess(self, xdata, ydata):
+        """
+        Initial guess for the fit parameters from the data.
+        :param xdata: x-data
+        :param ydata: y-data
+        :return: List of initial parameters
+        """
+        if self._guess is None:
+            raise ValueError("Model %s has no initial guess routine, please provide fitparams." % self.name)
+        return self._guess(xdata, ydata)
+
+
+fit_models = dict()
+
+
+def register_model(func, jac=None, parnames=None, bounds=None, guess=None, name=None):
+    """
+    Add a fit function to the model registry, such that fitbetter picks up its Jacobian and bounds.
+    :param func: Fit function of the form func(x, *p)
+    :param jac: Analytic Jacobian of the form jac(x, *p)
+    :param parnames: List of parameter names
+    :param bounds: Default parameter bounds
+    :param guess: Function of the form guess(xdata, ydata) that returns a list of initial parameters
+    :param name: Name of the model. Default is the name of func.
+    :return: FitModel instance
+    """
+    model = FitModel(func, jac=jac, parnames=parnames, bounds=bounds, guess=guess, name=name)
+    fit_models[model.name] = model
+    return model
+
+
+def get_model(fitfunc):
+    """
+    Look up a model in the registry.
+    :param fitfunc: Fit function, name of the fit function or FitModel instance
+    :return: FitModel instance, or None if the fit function is not registered
+    """
+    if isinstance(fitfunc, FitModel):
+        return fitfunc
+    if isinstance(fitfunc, str):
+        return fit_models.get(fitfunc)
+    model = fit_models.get(getattr(fitfunc, '__name__', None))
+    if model is not None and model.func is fitfunc:
+        return model
+
+
+def _guess_lor(xdata, ydata):
+    f0, fwhm, Q = common.find_fwhm(xdata, ydata, dB=False)
+    hwhm = fwhm / 2. if np.isfinite(fwhm) and fwhm > 0 else (max(xdata) - min(xdata)) / 10.
+    return [(ydata[0] + ydata[-1]) / 2., max(ydata) - min(ydata), f0, hwhm]
+
+
+def _guess_gauss(xdata, ydata):
+    return [(ydata[0] + ydata[-1]) / 2., max(ydata) - min(ydata), xdata[np.argmax(ydata)],
+            (max(xdata) - min(xdata)) / 3.]
+
+
+def _guess_exp(xdata, ydata):
+    return [ydata[-1], ydata[0] - ydata[-1], (xdata[-1] - xdata[0]) / 5.]
+
+
+def _guess_pulse_err(xdata, ydata):
+    return [ydata[-1], ydata[0] - ydata[-1]]
+
+
+def _guess_fft(xdata, ydata):
+    """
+    Amplitude, frequency, phase (deg) and offset of the strongest Fourier component of ydata.
+    """
+    FFT = np.fft.fft(ydata)
+    fft_freqs = np.fft.fftfreq(len(ydata), xdata[1] - xdata[0])
+    max_ind = np.argmax(abs(FFT[4:len(ydata) // 2])) + 4
+    fft_val = FFT[max_ind]
+    return [(max(ydata) - min(ydata)) / 2., fft_freqs[max_ind], (cmath.phase(fft_val) - np.pi / 2.) * 180. / np.pi,
+            np.mean(ydata)]
+
+
+def _guess_decaysin(xdata, ydata):
+    amp, freq, phi, offset = _guess_fft(xdata, ydata)
+    return [amp, freq, phi, max(xdata) - min(xdata), offset, 0.]
+
+
+def _guess_Ngauss(xdata, ydata, npeaks=None, no_offset=False, prominence=None):
+    """
+    Initial guess for Ngaussfunc from peak detection. Finds the peaks (or dips, if the data is mostly above its
+    median) with scipy.signal.find_peaks and estimates the widths from the full width at half maximum.
+    :param xdata: x-data
+    :param ydata: y-data
+    :param npeaks: Number of peaks. Default is None, which uses all peaks that pass the prominence threshold.
+                   Otherwise the npeaks most prominent peaks are used.
+    :param no_offset: True/False. Return guesses for Ngaussfunc_no_offset.
+    :param prominence: Minimum prominence of a peak. Default is 8 times the noise level, estimated from the median
+                       absolute difference of neighbouring points, but at least 5% of the peak to peak value of ydata.
+    :return: [offset, A1, f1, sigma1, A2, f2, sigma2, ...] or [A1, f1, sigma1, ...] if no_offset=True
+    """
+    xdata = np.asarray(xdata, dtype=np.float64)
+    ydata = np.asarray(ydata, dtype=np.float64)
+    offset = 0. if no_offset else np.median(ydata)
+    sign = 1. if np.max(ydata) - np.median(ydata) >= np.median(ydata) - np.min(ydata) else -1.
+
+    if prominence is None:
+        # Robust estimate of the noise from the point to point differences, which is insensitive to the peaks
+        noise = 1.4826 * np.median(np.abs(np.diff(ydata))) / np.sqrt(2)
+        prominence = max(0.05 * np.ptp(ydata), 8 * noise)
+    peaks, properties = scipy.signal.find_peaks(sign * ydata, prominence=prominence)
+    if npeaks is not None:
+        peaks = np.sort(peaks[np.argsort(properties['prominences'])[::-1][:npeaks]])
+    if len(peaks) == 0:
+        raise ValueError("No peaks found, please provide some initial guesses.")
+
+    widths = scipy.signal.peak_widths(sign * ydata, peaks, rel_height=0.5)
+    idx = np.arange(len(xdata))
+    fwhm = np.abs(np.interp(widths[3], idx, xdata) - np.interp(widths[2], idx, xdata))
+    # Avoid zero widths for peaks that are a single point wide
+    fwhm = np.maximum(fwhm, np.min(np.abs(np.diff(xdata))))
+
+    guess = np.transpose([ydata[peaks] - offset, xdata[peaks], fwhm / (2 * np.sqrt(2 * np.log(2)))])
+    guess = list(np.ravel(guess))
+    return guess if no_offset else [offset] + guess
+
+
+def _guess_hanger(xdata, ydata):
+    peakloc = np.argmin(ydata)
+    ymax = (ydata[0] + ydata[-1]) / 2.
+    f0 = xdata[peakloc]
+    Q0 = abs(xdata[peakloc] / ((max(xdata) - min(xdata)) / 3.))
+    Qi = Q0 * (1. + ymax)
+    Qc = Qi / ymax
+    return [f0, abs(Qi), abs(Qc), 0., ymax]
+
+
+def _guess_s11_oneport(xdata, ydata):
+    return [xdata[np.argmin(ydata)], (xdata[-1] - xdata[0]) / 5., (xdata[-1] - xdata[0]) / 5., 0, np.max(ydata)]
+
+
+def _guess_s11_twoport(xdata, ydata):
+    f0_guess = xdata[np.argmin(ydata)]
+    Q_guess = f0_guess / ((xdata[-1] - xdata[0]) / 5.)
+    return [f0_guess, Q_guess, Q_guess, 0, np.max(ydata)]
+
+
+def _guess_fano(xdata, ydata):
+    return [xdata[np.argmax(ydata)], (max(xdata) - min(xdata)) / 10., 10., max(ydata) - min(ydata)]
+
+
+def _guess_lor_asym(xdata, ydata):
+    return [max(ydata) - min(ydata), xdata[np.argmax(ydata)], (max(xdata) - min(xdata)) / 10., 0.]
+
+
+register_model(lorfunc, jac=lorfunc_jac, parnames=['Offset', 'Amplitude', 'f0', 'HWHM'], guess=_guess_lor)
+register_model(kinfunc, jac=kinfunc_jac, parnames=['f0', 'Kinetic Inductance fraction', 'Tc'])
+register_model(twolorfunc, jac=twolorfunc_jac, parnames=['Offset', 'A1', 'f1', 'HWHM1', 'A2', 'f2', 'HWHM2'])
+register_model(asym_lorfunc, jac=asym_lorfunc_jac, parnames=['Amplitude', 'f0', 'FWHM', 'Parallel capacitance'],
+               guess=_guess_lor_asym)
+register_model(fano_func, jac=fano_func_jac, parnames=['f0', 'FWHM', 'Fano factor', 'Amplitude'], guess=_guess_fano)
+register_model(gaussfunc, jac=gaussfunc_jac, parnames=['Offset', 'Amplitude', u'\u03bc', u'\u03c3'], guess=_guess_gauss)
+register_model(gaussfunc_nooffset, jac=gaussfunc_nooffset_jac, parnames=['Amplitude', u'\u03bc', u'\u03c3'],
+               guess=lambda x, y: _guess_gauss(x, y)[1:])
+register_model(Ngaussfunc, jac=Ngaussfunc_jac, guess=_guess_Ngauss)
+register_model(Ngaussfunc_no_offset, jac=Ngaussfunc_no_offset_jac,
+               guess=lambda x, y: _guess_Ngauss(x, y, no_offset=True))
+register_model(expfunc, jac=expfunc_jac, parnames=['Offset', 'Amplitude', u'\u03c4'], guess=_guess_exp)
+register_model(pulse_errfunc, jac=pulse_errfunc_jac, parnames=['Offset', 'p1'], guess=_guess_pulse_err)
+register_model(decaysin, jac=decaysin_jac, parnames=['Amplitude', 'Frequency', u'\u03c6', u'\u03c4', 'Offset',
+                                                     'Start time'], guess=_guess_decaysin)
+register_model(sinfunc, jac=sinfunc_jac, parnames=['Amplitude', 'Frequency (Hz)', u'\u03c6', 'Offset'],
+               guess=_guess_fft)
+register_model(hangerfunc, jac=hangerfunc_jac, parnames=['f0', 'Qi', 'Qc', 'df', 'scale'], guess=_guess_hanger)
+register_model(polynomial, jac=polynomial_jac, parnames=["a%d" % idx for idx in range(10)] + ['center'])
+register_model(s11_mag_func, jac=s11_mag_func_jac, parnames=['f0', 'Qi', 'Qc'])
+register_model(s11_phase_func, jac=s11_phase_func_jac, parnames=['f0', 'Qi', 'Qc'])
+register_model(s11_mag_func_asymmetric, jac=s11_mag_func_asymmetric_jac,
+               parnames=['f0', u'\u03ba', u'\u03b5', 'df', 'scale'], bounds=([0, 0, 0, -np.inf, -np.inf], np.inf),
+               guess=_guess_s11_oneport)
+register_model(s11_phase_func_asymmetric, jac=s11_phase_func_asymmetric_jac,
+               parnames=['f0', u'\u03ba', u'\u03b5', 'df', 'scale'])
+register_model(s11_mag_twoport, jac=s11_mag_twoport_jac, parnames=['f0', 'Qc', 'Qi', 'df', 'scale'],
+               bounds=([0, 0, 0, -np.inf, -np.inf], np.inf), guess=_guess_s11_twoport)
+register_model(s11_phase_twoport, jac=s11_phase_twoport_jac, parnames=['f0', 'Qc', 'Qi', 'df', 'scale'])
+register_model(parabolafunc, jac=parabolafunc_jac, parnames=['a0', 'a1', 'a2'])
+register_model(polyfunc, jac=polyfunc_jac)
+register_model(polyfunc_even, jac=polyfunc_even_jac)
+register_model(polyfunc_odd, jac=polyfunc_odd_jac)
 
 
 if __name__ == '__main__':
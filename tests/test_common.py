@@ -0,0 +1,32 @@
+import numpy as np
+from scipy.signal import convolve2d
+from .. import common
+
+
+def test_moving_average_2d_large_window():
+    ydata = np.random.RandomState(0).randn(5, 40)
+    for window_size in [(7, 3), (9, 8), (50, 12)]:
+        window = np.ones((window_size[1], window_size[0])) / float(window_size[0] * window_size[1])
+        np.testing.assert_allclose(common.moving_average_2d(ydata, window_size),
+                                   convolve2d(ydata, window, mode='same'), atol=1E-12)
+
+
+def test_mapped_color_plot_plot_opt():
+    import matplotlib.pyplot as plt
+    x = np.linspace(0, 1, 50)
+    artist = common.mapped_color_plot(x, x ** 2, **common.plot_opt('r'))
+    assert len(artist.get_offsets()) == 50
+    artist = common.mapped_color_plot(x, x ** 2, mfc='none', markevery=3)
+    plt.gcf().canvas.draw()
+    assert len(artist.get_facecolors()) == 0 and len(artist.get_edgecolors()) == 50
+    plt.close('all')
+
+
+def test_q_finder_2d():
+    f = np.linspace(4.9, 5.1, 2001)
+    hwhm = np.array([0.01, 0.02, 0.005])
+    magnitudes = 10 * np.log10(1 / (1 + ((f - 5.) / hwhm[:, np.newaxis]) ** 2))
+    magnitudes[2, :1500] = 0.
+    Q = common.q_finder(magnitudes, f, debug=True)
+    np.testing.assert_allclose(Q[:2], 5. / (2 * hwhm[:2]), rtol=5E-3)
+    assert np.isnan(Q[2])
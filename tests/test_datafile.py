@@ -0,0 +1,23 @@
+import numpy as np
+import h5py
+from .. import datafile
+
+
+def test_stack_array_reads_requested_rows(tmpdir):
+    filename = str(tmpdir.join('stacks.h5'))
+    data = np.random.RandomState(0).randn(3, 4, 2 * datafile.StackArray.default_blocksize + 10)
+    with h5py.File(filename, 'w') as f:
+        for idx in range(len(data)):
+            # Not chunked, i.e. contiguous
+            f.create_dataset('stack_%d/averaged_fft' % idx, data=data[idx])
+
+    with datafile.StackArray(filename, 'averaged_fft') as ffts:
+        assert ffts.blocksize == datafile.StackArray.default_blocksize
+        np.testing.assert_array_equal(ffts[:, 1, 100:200], data[:, 1, 100:200])
+        # Only one block of the selected row was read from each stack
+        assert len(ffts._cache) == 3
+        assert all(block.shape == (1, ffts.blocksize) for block in ffts._cache.values())
+
+        np.testing.assert_array_equal(ffts[1, ::-1, -5:], data[1, ::-1, -5:])
+        np.testing.assert_array_equal(ffts[:, [0, 2], 7], data[:, [0, 2], 7])
+        np.testing.assert_array_equal(ffts[2], data[2])
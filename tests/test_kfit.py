@@ -0,0 +1,126 @@
+import numpy as np
+from .. import kfit
+
+
+def resonator(f, f0, Qc, Qi, k=1., phi=0.2, delay=50E-9, amplitude=0.3, alpha=1.):
+    """
+    S11 (k=1) or S21 (k=2) of a resonator with asymmetry angle phi, environment and electrical delay, in the
+    convention of fit_complex_resonator: Qi = 1/(1/Ql - cos(phi)/Qc)
+    """
+    Ql = 1 / (1 / Qi + np.cos(phi) / Qc)
+    s = 1 - 2 * Ql / (k * Qc) * np.exp(1j * phi) / (1 + 2j * Ql * (f / f0 - 1))
+    return amplitude * np.exp(1j * alpha) * np.exp(-2j * np.pi * f * delay) * s, Ql
+
+
+def test_fit_complex_resonator_narrow_window():
+    # Fit window of +/- 1 FWHM, as for the default fitspan of process_level_meter_s11(fitmode='circle')
+    f0, Qc, Qi = 5E9, 2E4, 3E4
+    f = np.linspace(f0 - 0.01 * f0, f0 + 0.01 * f0, 4001)
+    for mode, k in [('reflection', 1.), ('hanger', 2.)]:
+        sdata, Ql = resonator(f, f0, Qc, Qi, k=k)
+        fwhm = f0 / Ql
+        params, errors = kfit.fit_complex_resonator(f, sdata, mode=mode, domain=[f0 - fwhm, f0 + fwhm],
+                                                    verbose=False)
+        np.testing.assert_allclose(params, [f0, Qc, Qi, Ql], rtol=1E-3)
+
+
+def test_fit_complex_resonator_noise():
+    # With 1% complex noise the reported errors should match the scatter of the results, also with the estimated delay
+    f0, Qc, Qi = 5E9, 2E4, 2E4
+    f = np.linspace(f0 * (1 - 5E-4), f0 * (1 + 5E-4), 401)
+    sdata, Ql = resonator(f, f0, Qc, Qi)
+    noise = np.random.RandomState(0)
+    params, errors = list(), list()
+    for k in range(20):
+        noisy = sdata + 0.01 * 0.3 * (noise.randn(len(f)) + 1j * noise.randn(len(f)))
+        p, e = kfit.fit_complex_resonator(f, noisy, verbose=False)
+        params.append(p)
+        errors.append(e)
+    params, errors = np.array(params), np.array(errors)
+    scatter = np.std(params, axis=0)
+    mean_error = np.mean(errors, axis=0)
+    assert np.all(scatter < 2 * mean_error) and np.all(scatter > 0.5 * mean_error)
+    assert np.all(np.abs(np.mean(params, axis=0) - [f0, Qc, Qi, Ql]) < 3 * mean_error)
+
+
+def test_fit_cache_closures(tmpdir):
+    # On Python 2 functions have no __qualname__, which is mimicked here, such that a closure can't be recognized by
+    # its name. Fits with closures that differ only in a captured value or default must not share a cache entry.
+    def make_closure(c):
+        def f(x, a, b):
+            return a * x + b + c
+        return f
+
+    def make_default(c):
+        def f(x, a, b, c=c):
+            return a * x + b + c
+        return f
+
+    x = np.linspace(0, 1, 21)
+    y = 2 * x + 1
+    kfit.enable_fit_cache(str(tmpdir.join('cache.sqlite')))
+    try:
+        for make in [make_closure, make_default]:
+            for c in [0., 5.]:
+                f = make(c)
+                f.__qualname__ = f.__name__
+                params, errors = kfit.fitbetter(x, y, f, [1., 0.])
+                np.testing.assert_allclose(params, [2., 1. - c], atol=1E-8)
+    finally:
+        kfit.disable_fit_cache()
+
+
+def test_fit_results_save_load(tmpdir):
+    # The registered parameter names of gaussfunc contain greek letters
+    parnames = kfit.get_model(kfit.gaussfunc).parnames
+    results = kfit.FitResults(len(parnames), size=2, parnames=parnames)
+    results.extend(np.arange(12.).reshape(3, 4), np.ones((3, 4)), rsquare=0.9, nfev=10)
+    for filename in ['fits.npz', 'fits.h5']:
+        path = str(tmpdir.join(filename))
+        results.save(path)
+        loaded = kfit.FitResults.load(path)
+        assert loaded.parnames == parnames
+        assert len(loaded) == 3
+        for field in results.dtype.names:
+            np.testing.assert_array_equal(loaded[field], results[field])
+
+
+def test_fit_poly_curve_fit_options():
+    x = np.linspace(-1, 1, 101)
+    y = 1 + 2 * x + 3 * x ** 2
+    params, errors = kfit.fit_poly(x, y, fitparams=[0, 0, 0], verbose=False, maxfev=1000,
+                                   parambounds=([0, 0, 0], [10, 10, 10]))
+    np.testing.assert_allclose(params, [1, 2, 3], atol=1E-8)
+
+
+def test_fit_lor_batch_bad_rows():
+    x = np.linspace(-1, 1, 201)
+    y = np.array([kfit.lorfunc(x, 0.1, 1., 0.05 * k, 0.1) for k in range(4)])
+    y[1, 50] = np.nan
+    y[2] = 1.
+    params, errors, info = kfit.fit_lor_batch(x, y, full_output=True)
+    np.testing.assert_allclose(params[[0, 3]], [[0.1, 1., 0., 0.1], [0.1, 1., 0.15, 0.1]], atol=1E-6)
+    assert np.all(np.isfinite(errors[[0, 3]]))
+    assert np.all(np.isnan(params[1])) and np.all(np.isnan(errors[1]))
+    assert np.all(np.isinf(errors[2]))
+    np.testing.assert_array_equal(info['converged'], [True, False, False, True])
+
+
+def test_fit_tracking_frequency_jump():
+    # The resonance jumps out of the fit window of the warm start after the third trace
+    x = np.linspace(-10, 10, 2001)
+    noise = np.random.RandomState(1)
+    centers = [0.05, 0.06, 0.07, 6., 6.01, 6.02]
+    y = np.array([kfit.lorfunc(x, 0., 1., c, 0.1) + 0.01 * noise.randn(len(x)) for c in centers])
+    for fitspan in [4., None]:
+        params, errors = kfit.fit_tracking(x, y, fitspan=fitspan)
+        np.testing.assert_allclose(params[:, 2], centers, atol=5E-3)
+        np.testing.assert_allclose(params[:, 1], 1., rtol=0.02)
+
+
+def test_fit_parabola_straight_line():
+    x = np.linspace(-1, 1, 101)
+    params, errors = kfit.fit_parabola(x, 1 + 2 * (x - 0.3) ** 2, verbose=False)
+    np.testing.assert_allclose(params, [1, 2, 0.3], atol=1E-8)
+    params, errors = kfit.fit_parabola(x, 3 + 2 * x, verbose=False)
+    assert np.all(np.isnan(params)) and np.all(np.isnan(errors))